@@ -0,0 +1,6 @@
+"""Benchmarks for the image-matching pipeline
+
+    python -m benchmarks --photos 200 --queries 20 --output bench.json
+
+Runs against a throwaway SQLite database and media directory, never the configured MySQL one.
+"""
@@ -0,0 +1,54 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+
+
+def main():
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from find.features import FEATURE_BACKENDS, RESIZE_FILTERS
+
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Benchmark the image-matching pipeline')
+    parser.add_argument('--photos', type=int, default=100, help='PhotoLost rows seeded before pic_check')
+    parser.add_argument('--queries', type=int, default=10, help='pic_check calls with rotated/scaled/cropped variants')
+    parser.add_argument('--image-size', type=int, default=480)
+    parser.add_argument('--python-sift-size', type=int, default=160, help='side of the image fed to the pure-Python SIFT')
+    parser.add_argument('--decode-size', type=int, default=3000, help='side of the photo used by the decode stages')
+    parser.add_argument('--resize-filter', choices=list(RESIZE_FILTERS), default='lanczos')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backend', choices=list(FEATURE_BACKENDS), default='sift', help='FIND_FEATURE_BACKEND for the extract, seed and pic_check stages')
+    parser.add_argument('--mode', choices=['exhaustive', 'ann', 'shortlist'], default='exhaustive')
+    parser.add_argument('--matcher', choices=['dense', 'bf'], default='dense', help='FIND_MATCHER for the pic_check stage')
+    parser.add_argument('--no-cascade', dest='cascade', action='store_false', help='pic_check with FIND_CASCADE off')
+    parser.add_argument('--stages', nargs='+', help='subset of: decode decode_reduced sift_opencv extract codecs sift_python calculate_similarity seed pic_check')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    # 不沿用 shell 里的 DJANGO_SETTINGS_MODULE(部署机上通常指向生产库)，基准测试会清空 PhotoLost
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'benchmarks.settings'
+    import django
+    django.setup()
+    from django.conf import settings
+    from benchmarks.run import run_benchmarks
+
+    try:
+        report = run_benchmarks(photos=args.photos, queries=args.queries, image_size=args.image_size,
+                                python_sift_size=args.python_sift_size, repeat=args.repeat, seed=args.seed,
+                                mode=args.mode, stages=args.stages, decode_size=args.decode_size,
+                                resize_filter=args.resize_filter, backend=args.backend, matcher=args.matcher,
+                                cascade=args.cascade)
+    finally:
+        if not os.environ.get('BENCHMARK_ROOT'):
+            shutil.rmtree(settings.BENCHMARK_ROOT, ignore_errors=True)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
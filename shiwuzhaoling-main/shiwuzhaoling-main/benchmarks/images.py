@@ -0,0 +1,48 @@
+import cv2
+import numpy as np
+
+
+def make_scene(seed, size=480):
+    """Deterministic textured RGB image: gradient background plus random rectangles, circles and lines
+    """
+    rng = np.random.default_rng(seed)
+    ramp = np.linspace(0, 1, size, dtype=np.float32)
+    image = np.empty((size, size, 3), dtype=np.uint8)
+    for channel in range(3):
+        angle = rng.uniform(0, np.pi)
+        image[:, :, channel] = (np.outer(ramp, np.ones(size)) * np.cos(angle) * 120
+                                + np.outer(np.ones(size), ramp) * np.sin(angle) * 120 + 60).astype(np.uint8)
+    for _ in range(40):
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        x, y = (int(v) for v in rng.integers(0, size, 2))
+        shape = rng.integers(3)
+        if shape == 0:
+            w, h = (int(v) for v in rng.integers(size // 20, size // 4, 2))
+            cv2.rectangle(image, (x, y), (x + w, y + h), color, -1)
+        elif shape == 1:
+            cv2.circle(image, (x, y), int(rng.integers(size // 40, size // 8)), color, -1)
+        else:
+            x2, y2 = (int(v) for v in rng.integers(0, size, 2))
+            cv2.line(image, (x, y), (x2, y2), color, int(rng.integers(1, 6)))
+    noise = rng.normal(0, 4, image.shape)
+    return np.clip(image + noise, 0, 255).astype(np.uint8)
+
+
+def make_variant(image, seed):
+    """Rotated, scaled and cropped copy of an image, as a finder would photograph the same item
+    """
+    rng = np.random.default_rng(seed)
+    height, width = image.shape[:2]
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), rng.uniform(-30, 30), rng.uniform(0.8, 1.2))
+    warped = cv2.warpAffine(image, matrix, (width, height), borderMode=cv2.BORDER_REFLECT)
+    crop = rng.uniform(0, 0.15, 4)
+    top, bottom = int(crop[0] * height), height - int(crop[1] * height)
+    left, right = int(crop[2] * width), width - int(crop[3] * width)
+    return warped[top:bottom, left:right]
+
+
+def encode_jpeg(image, quality=90):
+    ok, buffer = cv2.imencode('.jpg', cv2.cvtColor(image, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise RuntimeError('JPEG encoding failed')
+    return buffer.tobytes()
@@ -0,0 +1,40 @@
+import io
+import multiprocessing
+import resource
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from find.features import load_gray_image
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _high_water_mark():
+    # fork+exec 出来的子进程，ru_maxrss 仍带着父进程的峰值；Linux 上改读本进程自己的 VmHWM
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return peak_rss_bytes()
+
+
+def _decode_rss(jpeg, options):
+    # 在全新的进程里解码一次，峰值内存的增量就是解码本身占用的内存
+    before = _high_water_mark()
+    load_gray_image(io.BytesIO(jpeg), **options)
+    return _high_water_mark() - before
+
+
+def decode_peak_rss(jpeg, options):
+    """Peak RSS added by a single load_gray_image call, measured in a fresh process
+
+    ru_maxrss only ever grows, so it cannot tell two decode modes apart inside one process.
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(_decode_rss, jpeg, options).result()
@@ -0,0 +1,217 @@
+import collections
+import io
+import os
+import platform
+import statistics
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test.utils import override_settings
+
+from find import metrics, sift_utils
+from find.codecs import RAW_CODEC, UINT8_CODEC, PcaCodec
+from find.features import FEATURE_BACKENDS, extract_descriptors, load_gray_image
+from find.models import PhotoLost
+from find.pipeline import process_photo
+from find.matching import score_candidates
+from find.views import calculate_similarity, pic_check
+
+from .images import encode_jpeg, make_scene, make_variant
+from .memory import decode_peak_rss, peak_rss_bytes
+
+STAGES = ['decode', 'decode_reduced', 'sift_opencv', 'extract', 'codecs', 'sift_python', 'calculate_similarity', 'seed', 'pic_check']
+
+MODES = {
+    'exhaustive': {'FIND_ANN_INDEX': False, 'FIND_SHORTLIST_K': 0},
+    'ann': {'FIND_ANN_INDEX': True},
+    'shortlist': {'FIND_ANN_INDEX': False},
+}
+
+
+def summarize(timings, items_per_run=1):
+    ordered = sorted(timings)
+    total = sum(ordered)
+    return {
+        'runs': len(ordered),
+        'mean_s': statistics.fmean(ordered),
+        'p50_s': ordered[len(ordered) // 2],
+        'p90_s': ordered[min(len(ordered) - 1, int(len(ordered) * 0.9))],
+        'min_s': ordered[0],
+        'max_s': ordered[-1],
+        'throughput_per_s': len(ordered) * items_per_run / total if total > 0 else None,
+    }
+
+
+def measure(fn, repeat, trace_memory=True):
+    """Time fn() `repeat` times, then run it once more under tracemalloc for the peak Python-side allocation
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    result = summarize(timings)
+    if trace_memory:
+        tracemalloc.start()
+        fn()
+        result['peak_traced_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def measure_decode(jpeg, options, repeat):
+    result = measure(lambda: load_gray_image(io.BytesIO(jpeg), **options), repeat, trace_memory=False)
+    result['peak_rss_delta_bytes'] = decode_peak_rss(jpeg, options)
+    result.update(options)
+    return result
+
+
+def codec_accuracy(pairs, seed, image_size, components=64, threshold=0.1):
+    """Similarity of matching and non-matching pairs under each compact codec versus full-precision SIFT
+
+    threshold is pic_check's match threshold; `agreement` is how often a codec takes the same decision.
+    """
+    sift = FEATURE_BACKENDS['sift']
+
+    def raw(image):
+        return extract_descriptors(load_gray_image(io.BytesIO(encode_jpeg(image))), sift, RAW_CODEC)
+
+    training = [raw(make_scene(seed + 5000 + index, image_size)) for index in range(20)]
+    pca = PcaCodec.train(np.concatenate([t for t in training if t is not None]), components)
+
+    cases = []
+    for index in range(pairs):
+        scene = make_scene(seed + 2000 + index, image_size)
+        query = raw(make_variant(scene, seed + index))
+        cases.append((query, raw(scene)))
+        cases.append((query, raw(make_scene(seed + 3000 + index, image_size))))
+
+    report = {}
+    reference = [score_candidates(query, [(0, None, stored)])[0] for query, stored in cases]
+    for codec in (RAW_CODEC, UINT8_CODEC, pca):
+        timings, similarities = [], []
+        for query, stored in cases:
+            query, stored = codec.encode(query), codec.encode(stored)
+            start = time.perf_counter()
+            similarities.append(score_candidates(query, [(0, None, stored)])[0])
+            timings.append(time.perf_counter() - start)
+        errors = np.abs(np.array(similarities) - np.array(reference))
+        report[codec.tag] = {
+            'bytes_per_descriptor': codec.encode(cases[0][0][:1]).nbytes,
+            'mean_abs_error': float(errors.mean()),
+            'max_abs_error': float(errors.max()),
+            'agreement': float(np.mean([(a > threshold) == (b > threshold) for a, b in zip(similarities, reference)])),
+            'mean_match_s': statistics.fmean(timings),
+        }
+    return report
+
+
+def check_sandboxed():
+    """Refuse to run unless the database and media directory live under BENCHMARK_ROOT (benchmarks.settings)
+    """
+    root = getattr(settings, 'BENCHMARK_ROOT', None)
+    if not root:
+        raise ImproperlyConfigured('Benchmarks must run with benchmarks.settings, they delete every PhotoLost row')
+    root = os.path.realpath(root)
+    for name, path in (('database', settings.DATABASES['default']['NAME']), ('MEDIA_ROOT', settings.MEDIA_ROOT)):
+        path = os.path.realpath(str(path))
+        if os.path.commonpath([root, path]) != root:
+            raise ImproperlyConfigured(f'Benchmark {name} {path} is outside BENCHMARK_ROOT {root}')
+
+
+def run_benchmarks(photos=100, queries=10, image_size=480, python_sift_size=160, repeat=3, seed=0, mode='exhaustive',
+                   stages=None, decode_size=3000, resize_filter='lanczos', backend='sift', matcher='dense',
+                   cascade=True):
+    stages = stages or STAGES
+    check_sandboxed()
+    call_command('migrate', verbosity=0)
+    PhotoLost.objects.all().delete()
+
+    scene = make_scene(seed, image_size)
+    variant = make_variant(scene, seed + 1)
+    scene_jpeg, variant_jpeg = encode_jpeg(scene), encode_jpeg(variant)
+    gray = load_gray_image(io.BytesIO(scene_jpeg))
+    results = {}
+
+    if 'decode' in stages or 'decode_reduced' in stages:
+        photo_jpeg = encode_jpeg(make_scene(seed, decode_size))
+        if 'decode' in stages:
+            results['decode'] = measure_decode(photo_jpeg, {'reduced': False, 'resize_filter': resize_filter}, repeat)
+        if 'decode_reduced' in stages:
+            results['decode_reduced'] = measure_decode(photo_jpeg, {'reduced': True, 'resize_filter': resize_filter}, repeat)
+    if 'sift_opencv' in stages:
+        results['sift_opencv'] = measure(lambda: extract_descriptors(gray, FEATURE_BACKENDS['sift']), repeat)
+    if 'extract' in stages:
+        descriptors = extract_descriptors(gray, FEATURE_BACKENDS[backend])
+        results['extract'] = measure(lambda: extract_descriptors(gray, FEATURE_BACKENDS[backend]), repeat)
+        results['extract'].update({'backend': backend, 'descriptors': len(descriptors), 'bytes': descriptors.nbytes})
+    if 'codecs' in stages:
+        results['codecs'] = codec_accuracy(max(queries, 2), seed, image_size)
+    if 'sift_python' in stages:
+        small = cv2.resize(gray, (python_sift_size, python_sift_size))
+        results['sift_python'] = measure(lambda: sift_utils.computeKeypointsAndDescriptors(small), 1)
+    if 'calculate_similarity' in stages:
+        desc_a, desc_b = extract_descriptors(gray), extract_descriptors(load_gray_image(io.BytesIO(variant_jpeg)))
+        results['calculate_similarity'] = measure(lambda: calculate_similarity(desc_a, desc_b), repeat)
+
+    with override_settings(FIND_FEATURE_BACKEND=backend, FIND_MATCHER=matcher, FIND_CASCADE=cascade, **MODES[mode]):
+        if 'seed' in stages or 'pic_check' in stages:
+            timings = []
+            for index in range(photos):
+                content = ContentFile(encode_jpeg(make_scene(seed + 1000 + index, image_size)), name=f'bench_{index}.jpg')
+                start = time.perf_counter()
+                # 上传后的后台处理在这里同步完成，计时包含特征提取
+                process_photo(PhotoLost.objects.create(image=content, phone='13800000000'))
+                timings.append(time.perf_counter() - start)
+            results['seed'] = summarize(timings)
+            results['seed']['photos'] = photos
+
+        if mode == 'shortlist' and 'pic_check' in stages:
+            start = time.perf_counter()
+            call_command('train_vocabulary', verbosity=0, stdout=io.StringIO())
+            results['train_vocabulary'] = {'seconds': time.perf_counter() - start}
+
+        if 'pic_check' in stages and photos:
+            rng = np.random.default_rng(seed)
+            targets = rng.integers(0, photos, queries)
+            expected = {photo.image.name.rsplit('/', 1)[-1]: photo.image.name for photo in PhotoLost.objects.all()}
+            timings, hits = [], 0
+            stage_seconds = collections.defaultdict(list)
+            for query_index, target in enumerate(targets):
+                query = encode_jpeg(make_variant(make_scene(seed + 1000 + int(target), image_size), seed + query_index))
+                upload = SimpleUploadedFile(f'query_{query_index}.jpg', query, content_type='image/jpeg')
+                with metrics.compare_trace('benchmark') as trace:
+                    start = time.perf_counter()
+                    result = pic_check(upload)
+                    timings.append(time.perf_counter() - start)
+                for name, seconds in trace.stages.items():
+                    stage_seconds[name].append(seconds)
+                hits += result[0] == 1 and result[1] == expected.get(f'bench_{target}.jpg')
+            results['pic_check'] = summarize(timings)
+            results['pic_check'].update({'database_photos': photos, 'recall': hits / len(targets),
+                                         'stage_mean_seconds': {name: statistics.fmean(values) for name, values in stage_seconds.items()}})
+
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'cpu_count': os.cpu_count(),
+            'platform': platform.platform(),
+        },
+        'config': {
+            'photos': photos, 'queries': queries, 'image_size': image_size, 'python_sift_size': python_sift_size,
+            'decode_size': decode_size, 'resize_filter': resize_filter, 'backend': backend, 'matcher': matcher, 'cascade': cascade,
+            'repeat': repeat, 'seed': seed, 'mode': mode,
+            'stages': stages,
+        },
+        'stages': results,
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
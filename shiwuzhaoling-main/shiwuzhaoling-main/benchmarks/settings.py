@@ -0,0 +1,27 @@
+import os
+import tempfile
+
+from shiwuzhaoling.settings import *  # noqa: F401,F403
+
+BENCHMARK_ROOT = os.environ.get('BENCHMARK_ROOT') or tempfile.mkdtemp(prefix='shiwuzhaoling-bench-')
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BENCHMARK_ROOT, 'db.sqlite3'),
+    }
+}
+
+MEDIA_ROOT = os.path.join(BENCHMARK_ROOT, 'media')
+FIND_VOCABULARY_PATH = os.path.join(BENCHMARK_ROOT, 'vocabulary.npz')
+FIND_PCA_PATH = os.path.join(BENCHMARK_ROOT, 'descriptor_pca.npz')
+FIND_DESCRIPTOR_ARENA_DIR = os.path.join(BENCHMARK_ROOT, 'arena')
+# 种子图片在 run.py 中同步处理，不启动后台 worker
+FIND_FEATURE_WORKERS = 0
+# 计时时不输出每次比对的汇总日志
+LOGGING['loggers']['find']['level'] = 'WARNING'
+CACHES = {
+    **CACHES,
+    'find': {**CACHES['find'], 'LOCATION': os.path.join(BENCHMARK_ROOT, 'cache')},
+    'find-state': {**CACHES['find-state'], 'LOCATION': os.path.join(BENCHMARK_ROOT, 'cache-state')},
+}
@@ -0,0 +1,248 @@
+import contextlib
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: 没有 flock，退回各进程自己的内存缓存
+    fcntl = None
+
+RECORD_DTYPE = np.dtype([('photo_id', '<i8'), ('start', '<i8'), ('rows', '<i8'), ('image_hash', '<u8')])
+
+
+def image_hash(image_name):
+    # 数据库自增 id 可能被复用(如 MySQL 重启后)，记录里带上图片名的哈希，避免读到旧照片的描述符
+    return int.from_bytes(hashlib.blake2b(image_name.encode(), digest_size=8).digest(), 'little')
+
+
+class DescriptorArena:
+    """Append-only on-disk descriptor store that every worker process maps read-only
+
+    Files in `directory` (one arena per descriptor space, so dtype and width never change):
+
+        meta.json          dtype and width of a row
+        CURRENT            generation of the live files
+        data-<gen>.bin     descriptor rows back to back
+        offsets-<gen>.bin  append-only (photo_id, start, rows, image_hash) records; rows == -1 tombstones photo_id
+        lock               flock'ed by writers
+
+    Data is written before its record, so readers never see a half-written entry. Compaction
+    writes the live rows to the next generation and swaps CURRENT; processes that still map the
+    old files keep reading them until their next refresh.
+    """
+
+    def __init__(self, directory, compact_ratio=0.5):
+        self.directory = str(directory)
+        self.compact_ratio = compact_ratio
+        self.dtype = None
+        self.width = None
+        self._generation = None
+        self._data = None
+        self._entries = {}
+        self._offsets_read = 0
+        self.total_rows = 0
+        self.dead_rows = 0
+        self._lock = threading.RLock()
+        os.makedirs(self.directory, exist_ok=True)
+        self._load_meta()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, photo_id):
+        return photo_id in self._entries
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load_meta(self):
+        try:
+            with open(self._path('meta.json')) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return
+        self.dtype, self.width = np.dtype(meta['dtype']), meta['width']
+
+    def _current_generation(self):
+        try:
+            with open(self._path('CURRENT')) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def refresh(self):
+        """Pick up records appended (or a compaction finished) by any process since the last call
+        """
+        with self._lock:
+            if self.dtype is None:
+                self._load_meta()
+            generation = self._current_generation()
+            if generation != self._generation:
+                self._generation = generation
+                self._data = None
+                self._entries = {}
+                self._offsets_read = 0
+                self.total_rows = self.dead_rows = 0
+            offsets_path = self._path(f'offsets-{generation}.bin')
+            try:
+                size = os.path.getsize(offsets_path)
+            except OSError:
+                return
+            available = (size - self._offsets_read) // RECORD_DTYPE.itemsize
+            if available <= 0:
+                return
+            with open(offsets_path, 'rb') as f:
+                f.seek(self._offsets_read)
+                records = np.frombuffer(f.read(available * RECORD_DTYPE.itemsize), dtype=RECORD_DTYPE)
+            self._offsets_read += available * RECORD_DTYPE.itemsize
+            for record in records.tolist():
+                self._apply(*record)
+
+    def _apply(self, photo_id, start, rows, key):
+        previous = self._entries.pop(photo_id, None)
+        if previous is not None:
+            self.dead_rows += previous[1]
+        if rows >= 0:
+            self._entries[photo_id] = (start, rows, key)
+            self.total_rows += rows
+
+    def get(self, photo_id, image_name):
+        """Read-only view of a photo's descriptors in the shared mapping, or None
+        """
+        key = image_hash(image_name)
+        with self._lock:
+            for _ in range(3):
+                entry = self._entries.get(photo_id)
+                if entry is None or entry[2] != key:
+                    # 可能是其他进程刚写入的
+                    self.refresh()
+                    entry = self._entries.get(photo_id)
+                    if entry is None or entry[2] != key:
+                        return None
+                start, rows, _ = entry
+                if (self._data is None or len(self._data) < start + rows) and not self._map():
+                    # 其他进程压缩后删除了这一代的文件，记录已切换到新一代，重新查找
+                    continue
+                return self._data[start:start + rows]
+            return None
+
+    def _map(self):
+        """Map this generation's data file; False (after refreshing to the live generation) when it is gone
+        """
+        path = self._path(f'data-{self._generation}.bin')
+        try:
+            rows = os.path.getsize(path) // (self.dtype.itemsize * self.width)
+            self._data = np.memmap(path, dtype=self.dtype, mode='r', shape=(rows, self.width)) if rows else None
+        except FileNotFoundError:
+            self._data = None
+            self.refresh()
+            return False
+        return True
+
+    @contextlib.contextmanager
+    def _writing(self):
+        with self._lock, open(self._path('lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self.refresh()
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def add(self, photo_id, image_name, descriptors):
+        if descriptors is None or len(descriptors) == 0:
+            return
+        with self._writing():
+            if self.dtype is None:
+                self.dtype, self.width = np.dtype(descriptors.dtype), descriptors.shape[1]
+                with open(self._path('meta.json.tmp'), 'w') as f:
+                    json.dump({'dtype': self.dtype.str, 'width': self.width}, f)
+                os.replace(self._path('meta.json.tmp'), self._path('meta.json'))
+            descriptors = np.ascontiguousarray(descriptors, dtype=self.dtype)
+            with open(self._path(f'data-{self._generation}.bin'), 'ab') as f:
+                start = f.tell() // (self.dtype.itemsize * self.width)
+                f.write(descriptors.tobytes())
+            self._append_record(photo_id, start, len(descriptors), image_hash(image_name))
+
+    def remove(self, photo_id):
+        with self._writing():
+            if photo_id not in self._entries:
+                return
+            self._append_record(photo_id, 0, -1, 0)
+            if self.dead_rows > self.compact_ratio * (self.total_rows or 1):
+                self._compact()
+
+    def compact(self, live_ids=None):
+        """Rewrite the arena without dead rows (and without photos outside live_ids, when given)
+        """
+        with self._writing():
+            self._compact(live_ids)
+
+    def _append_record(self, photo_id, start, rows, key):
+        record = np.array([(photo_id, start, rows, key)], dtype=RECORD_DTYPE)
+        with open(self._path(f'offsets-{self._generation}.bin'), 'ab') as f:
+            f.write(record.tobytes())
+        self._offsets_read += RECORD_DTYPE.itemsize
+        self._apply(photo_id, start, rows, key)
+
+    def _compact(self, live_ids=None):
+        old = self._generation
+        new = old + 1
+        keep = [(photo_id, entry) for photo_id, entry in self._entries.items()
+                if live_ids is None or photo_id in live_ids]
+        if keep:
+            self._map()
+        records = []
+        with open(self._path(f'data-{new}.bin'), 'wb') as data_file:
+            start = 0
+            for photo_id, (old_start, rows, key) in keep:
+                data_file.write(self._data[old_start:old_start + rows].tobytes())
+                records.append((photo_id, start, rows, key))
+                start += rows
+            data_file.flush()
+            os.fsync(data_file.fileno())
+        with open(self._path(f'offsets-{new}.bin'), 'wb') as offsets_file:
+            offsets_file.write(np.array(records, dtype=RECORD_DTYPE).tobytes())
+            offsets_file.flush()
+            os.fsync(offsets_file.fileno())
+        with open(self._path('CURRENT.tmp'), 'w') as f:
+            f.write(str(new))
+        os.replace(self._path('CURRENT.tmp'), self._path('CURRENT'))
+        # 已映射旧文件的进程在 POSIX 上仍可继续读取，直到它们 refresh
+        for name in (f'data-{old}.bin', f'offsets-{old}.bin'):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._path(name))
+        self.refresh()
+
+
+_arenas = {}
+_arenas_lock = threading.Lock()
+
+
+def get_descriptor_arena():
+    """Arena for the configured descriptor space under FIND_DESCRIPTOR_ARENA_DIR, or None when disabled
+    """
+    from django.conf import settings
+    from .codecs import get_descriptor_codec
+    from .features import get_feature_backend
+    root = getattr(settings, 'FIND_DESCRIPTOR_ARENA_DIR', None)
+    if not root or fcntl is None:
+        return None
+    backend = get_feature_backend()
+    space = get_descriptor_codec(backend).space(backend)
+    directory = os.path.join(root, space.replace('/', '-'))
+    with _arenas_lock:
+        arena = _arenas.get(directory)
+        if arena is None:
+            arena = _arenas[directory] = DescriptorArena(directory)
+        return arena
+
+
+def reset_descriptor_arenas():
+    """Forget this process's arenas, e.g. after FIND_DESCRIPTOR_ARENA_DIR changed"""
+    with _arenas_lock:
+        _arenas.clear()
@@ -0,0 +1,101 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+class ImageCache:
+    """LRU cache of per-photo arrays (grayscale image, descriptors) bounded by total bytes
+
+    Entries are keyed by (path, mtime, kind) so a file replaced on disk is never served stale.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self._entries = OrderedDict()
+        self._keys_by_path = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def get(self, path, kind):
+        key = (path, self._mtime(path), kind)
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, path, kind, value):
+        mtime = self._mtime(path)
+        if value is None or mtime is None or value.nbytes > self.max_bytes:
+            return
+        key = (path, mtime, kind)
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = value
+            self._keys_by_path.setdefault(path, set()).add(key)
+            self.size += value.nbytes
+            while self.size > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, path):
+        with self._lock:
+            for key in list(self._keys_by_path.get(path, ())):
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_path.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _discard(self, key):
+        value = self._entries.pop(key, None)
+        if value is None:
+            return
+        self.size -= value.nbytes
+        keys = self._keys_by_path.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_path[key[0]]
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_image_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            from django.conf import settings
+            _cache = ImageCache(getattr(settings, 'FIND_IMAGE_CACHE_BYTES', 256 * 1024 * 1024))
+        return _cache
@@ -0,0 +1,116 @@
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+
+class DescriptorCodec:
+    """How descriptors are stored, cached and matched: encode() maps extracted descriptors to that form
+    """
+    tag = None
+    # 无损格式之间可以直接转码，不必重新解码原图
+    lossless = True
+
+    def encode(self, descriptors):
+        return descriptors
+
+    def space(self, backend):
+        """Name of the vector space encoded descriptors live in; vocabularies are only valid within one space
+        """
+        return backend.name
+
+
+class RawCodec(DescriptorCodec):
+    tag = 'raw'
+
+
+class Uint8Codec(DescriptorCodec):
+    """OpenCV's SIFT values are already integers in 0..255 (clamped at descriptor_max_value=0.2, then scaled
+    by 512), so uint8 storage is lossless and L2 distances, hence match scores, are unchanged at 1/4 the size
+    """
+    tag = 'uint8'
+
+    def encode(self, descriptors):
+        return np.clip(np.rint(descriptors), 0, 255).astype(np.uint8)
+
+
+class PcaCodec(DescriptorCodec):
+    """Projection onto the leading principal components of the stored descriptors, kept as float16
+    """
+    lossless = False
+
+    def __init__(self, mean, components):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.ascontiguousarray(components, dtype=np.float32)
+        digest = hashlib.sha1(self.mean.tobytes() + self.components.tobytes()).hexdigest()[:8]
+        self.tag = f'pca{len(self.components)}-{digest}'
+
+    @classmethod
+    def train(cls, samples, components):
+        samples = np.asarray(samples, dtype=np.float64)
+        mean = samples.mean(axis=0)
+        _, _, vt = np.linalg.svd(samples - mean, full_matrices=False)
+        return cls(mean, vt[:components])
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['mean'], data['components'])
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'wb') as f:
+            np.savez(f, mean=self.mean, components=self.components)
+
+    def encode(self, descriptors):
+        return ((np.asarray(descriptors, dtype=np.float32) - self.mean) @ self.components.T).astype(np.float16)
+
+    def space(self, backend):
+        return f'{backend.name}/{self.tag}'
+
+
+RAW_CODEC = RawCodec()
+UINT8_CODEC = Uint8Codec()
+LOSSLESS_CODECS = {RAW_CODEC.tag, UINT8_CODEC.tag}
+
+_pca = None
+_pca_mtime = None
+_pca_lock = threading.Lock()
+
+
+def get_pca_codec():
+    """PCA codec trained at FIND_PCA_PATH, or None while none has been trained
+    """
+    global _pca, _pca_mtime
+    from django.conf import settings
+    path = getattr(settings, 'FIND_PCA_PATH', None)
+    with _pca_lock:
+        if not path or not os.path.exists(path):
+            _pca = _pca_mtime = None
+            return None
+        mtime = os.path.getmtime(path)
+        if _pca is None or mtime != _pca_mtime:
+            _pca = PcaCodec.load(path)
+            _pca_mtime = mtime
+        return _pca
+
+
+def get_descriptor_codec(backend=None):
+    """Codec selected by FIND_DESCRIPTOR_CODEC ('raw', 'uint8' or 'pca16') for the given feature backend
+
+    Binary backends are always stored raw. 'pca16' falls back to raw until train_descriptor_pca
+    has produced a model; raw rows are transcoded once it exists.
+    """
+    from django.conf import settings
+    from django.core.exceptions import ImproperlyConfigured
+    from .features import get_feature_backend
+    backend = backend or get_feature_backend()
+    name = getattr(settings, 'FIND_DESCRIPTOR_CODEC', 'raw')
+    if backend.binary or name == 'raw':
+        return RAW_CODEC
+    if name == 'uint8':
+        return UINT8_CODEC
+    if name == 'pca16':
+        return get_pca_codec() or RAW_CODEC
+    raise ImproperlyConfigured(f"Unknown FIND_DESCRIPTOR_CODEC {name!r}, expected 'raw', 'uint8' or 'pca16'")
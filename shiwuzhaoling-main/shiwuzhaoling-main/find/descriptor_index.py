@@ -0,0 +1,246 @@
+import threading
+
+import cv2
+import numpy as np
+
+FLANN_INDEX_KDTREE = 1
+FLANN_INDEX_LSH = 6
+RATIO = 0.75
+
+
+class _Segment:
+    """An immutable block of descriptors with its own FLANN KD-forest
+    """
+
+    def __init__(self, descriptors, owners, index_params):
+        self.descriptors = descriptors
+        self.owners = owners
+        self.dead = 0
+        self.flann = cv2.flann_Index(descriptors, index_params)
+
+    def __len__(self):
+        return len(self.owners)
+
+    def search(self, query, k, checks):
+        indices, distances = self.flann.knnSearch(query, min(k, len(self)), params=dict(checks=checks))
+        distances = distances.astype(np.float32, copy=False)
+        # LSH finds fewer than k neighbours when the probed buckets run dry and pads with -1
+        missing = indices < 0
+        owners = self.owners[np.where(missing, 0, indices)]
+        if missing.any():
+            owners[missing] = -1
+            distances[missing] = np.inf
+        return distances, owners
+
+
+class DescriptorIndex:
+    """Approximate nearest-neighbour index over the descriptors of every stored photo
+
+    New descriptors land in a small brute-force buffer that is frozen into a FLANN segment once
+    it is full, and the two smallest segments are merged when there are too many of them.
+    Removed photos are tombstoned; a segment is only rebuilt once half of its rows are dead,
+    so neither inserts nor deletes rebuild the whole index.
+
+    Float descriptors (SIFT) go into KD-forests; binary ones (ORB/AKAZE, binary=True) into
+    multi-probe LSH tables and are compared by Hamming distance.
+    """
+
+    def __init__(self, buffer_size=8192, max_segments=8, trees=4, checks=64, k=6,
+                 binary=False, lsh_tables=6, lsh_key_size=12, lsh_probe_level=1):
+        self.buffer_size = buffer_size
+        self.max_segments = max_segments
+        self.checks = checks
+        self.k = k
+        self.binary = binary
+        if binary:
+            self.dtype = np.uint8
+            self.index_params = dict(algorithm=FLANN_INDEX_LSH, table_number=lsh_tables, key_size=lsh_key_size,
+                                     multi_probe_level=lsh_probe_level)
+            self.ratio = RATIO
+        else:
+            self.dtype = np.float32
+            self.index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=trees)
+            # FLANN returns squared L2 distances, hence the squared ratio
+            self.ratio = RATIO ** 2
+        self.synced = False
+        self._segments = []
+        self._buffer = {}
+        self._counts = {}
+        self._locations = {}
+        self._tombstones = set()
+        self._lock = threading.RLock()
+
+    def __contains__(self, photo_id):
+        return photo_id in self._counts
+
+    def __len__(self):
+        return len(self._counts)
+
+    def photo_ids(self):
+        return set(self._counts)
+
+    def descriptor_count(self, photo_id):
+        return self._counts.get(photo_id, 0)
+
+    def get_descriptors(self, photo_id):
+        with self._lock:
+            if photo_id in self._buffer:
+                return self._buffer[photo_id]
+            segment = self._locations.get(photo_id)
+            if segment is None:
+                return None
+            return segment.descriptors[segment.owners == photo_id]
+
+    def add(self, photo_id, descriptors):
+        if descriptors is None or len(descriptors) == 0:
+            return
+        with self._lock:
+            self.remove(photo_id)
+            if photo_id in self._tombstones:
+                # the id is coming back: its old rows must be physically gone before it is live again
+                self._rebuild(next(s for s in self._segments if photo_id in s.owners))
+            self._buffer[photo_id] = np.ascontiguousarray(descriptors, dtype=self.dtype)
+            self._counts[photo_id] = len(descriptors)
+            if sum(len(d) for d in self._buffer.values()) >= self.buffer_size:
+                self._flush_buffer()
+
+    def remove(self, photo_id):
+        with self._lock:
+            count = self._counts.pop(photo_id, None)
+            if count is None:
+                return
+            if self._buffer.pop(photo_id, None) is not None:
+                return
+            segment = self._locations.pop(photo_id)
+            segment.dead += count
+            self._tombstones.add(photo_id)
+            if segment.dead * 2 >= len(segment):
+                self._rebuild(segment)
+
+    def sync(self, photo_ids, load_descriptors):
+        """Bring the index in line with the given ids: drop rows that are gone, load the missing ones
+
+        load_descriptors receives the missing ids and yields (photo_id, descriptors) pairs.
+        """
+        photo_ids = set(photo_ids)
+        with self._lock:
+            for photo_id in self.photo_ids() - photo_ids:
+                self.remove(photo_id)
+            missing = photo_ids - self.photo_ids()
+            if missing:
+                for photo_id, descriptors in load_descriptors(missing):
+                    self.add(photo_id, descriptors)
+            self.synced = True
+
+    def search(self, query):
+        """Return {photo_id: votes}, a vote being a query descriptor that passes the ratio test against that photo
+        """
+        query = np.ascontiguousarray(query, dtype=self.dtype)
+        with self._lock:
+            distances, owners = self._knn(query)
+            tombstones = list(self._tombstones)
+        if distances is None:
+            return {}
+
+        order = np.argsort(distances, axis=1, kind='stable')
+        distances = np.take_along_axis(distances, order, axis=1)
+        owners = np.take_along_axis(owners, order, axis=1)
+        if tombstones:
+            dead = np.isin(owners, tombstones)
+            distances[dead] = np.inf
+            owners[dead] = -1
+        # an image whose second neighbour did not make the list is at least this far away
+        farthest = np.where(np.isfinite(distances), distances, -np.inf).max(axis=1)
+
+        votes = {}
+        ratio = self.ratio
+        num_cols = distances.shape[1]
+        for col in range(num_cols):
+            owner = owners[:, col]
+            first = owner >= 0
+            for prev in range(col):
+                first &= owners[:, prev] != owner
+            if not first.any():
+                continue
+            second = farthest.copy()
+            found = np.zeros(len(owner), dtype=bool)
+            for nxt in range(col + 1, num_cols):
+                hit = ~found & (owners[:, nxt] == owner)
+                second[hit] = distances[hit, nxt]
+                found |= hit
+            has_second = found | (farthest > distances[:, col])
+            good = first & has_second & (distances[:, col] < ratio * second)
+            for photo_id, count in zip(*np.unique(owner[good], return_counts=True)):
+                votes[int(photo_id)] = votes.get(int(photo_id), 0) + int(count)
+        return votes
+
+    def _knn(self, query):
+        parts = [segment.search(query, self.k, self.checks) for segment in self._segments]
+        if self._buffer:
+            descriptors = np.concatenate(list(self._buffer.values()))
+            owners = np.concatenate([np.full(len(d), pid, dtype=np.int64) for pid, d in self._buffer.items()])
+            k = min(self.k, len(owners))
+            if self.binary:
+                distances, nearest = cv2.batchDistance(query, descriptors, cv2.CV_32S, normType=cv2.NORM_HAMMING, K=k)
+                parts.append((distances.astype(np.float32), owners[nearest]))
+            else:
+                squared = (np.einsum('ij,ij->i', query, query)[:, None]
+                           - 2 * query @ descriptors.T
+                           + np.einsum('ij,ij->i', descriptors, descriptors)[None, :])
+                nearest = np.argpartition(squared, k - 1, axis=1)[:, :k]
+                parts.append((np.maximum(np.take_along_axis(squared, nearest, axis=1), 0), owners[nearest]))
+        if not parts:
+            return None, None
+        return np.hstack([d for d, _ in parts]), np.hstack([o for _, o in parts])
+
+    def _flush_buffer(self):
+        descriptors = np.concatenate(list(self._buffer.values()))
+        owners = np.concatenate([np.full(len(d), pid, dtype=np.int64) for pid, d in self._buffer.items()])
+        self._buffer = {}
+        self._install(_Segment(descriptors, owners, self.index_params))
+        while len(self._segments) > self.max_segments:
+            self._segments.sort(key=len)
+            self._merge(self._segments[0], self._segments[1])
+
+    def _merge(self, first, second):
+        self._segments.remove(first)
+        self._segments.remove(second)
+        self._install_live(np.concatenate([first.descriptors, second.descriptors]),
+                           np.concatenate([first.owners, second.owners]))
+
+    def _rebuild(self, segment):
+        self._segments.remove(segment)
+        self._install_live(segment.descriptors, segment.owners)
+
+    def _install_live(self, descriptors, owners):
+        dead = np.isin(owners, list(self._tombstones))
+        self._tombstones.difference_update(np.unique(owners[dead]).tolist())
+        if dead.all():
+            return
+        self._install(_Segment(np.ascontiguousarray(descriptors[~dead]), owners[~dead], self.index_params))
+
+    def _install(self, segment):
+        self._segments.append(segment)
+        for photo_id in np.unique(segment.owners).tolist():
+            self._locations[photo_id] = segment
+
+
+_index = None
+_index_space = None
+_index_lock = threading.Lock()
+
+
+def get_descriptor_index():
+    """Index for the configured feature backend and codec, rebuilt from scratch when either changes space
+    """
+    global _index, _index_space
+    from django.conf import settings
+    from .features import get_feature_backend
+    from .codecs import get_descriptor_codec
+    backend = get_feature_backend()
+    space = get_descriptor_codec(backend).space(backend)
+    with _index_lock:
+        if _index is None or _index_space != space:
+            _index = DescriptorIndex(binary=backend.binary, **getattr(settings, 'FIND_ANN_INDEX_OPTIONS', {}))
+            _index_space = space
+        return _index
@@ -0,0 +1,190 @@
+import io
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# 特征提取参数变化时递增，旧版本的描述符会在下次使用时重新计算
+FEATURE_VERSION = 1
+
+MAX_IMAGE_SIZE = 600
+SIFT_FEATURES = 500
+BINARY_FEATURES = 500
+
+
+RESIZE_FILTERS = {
+    'nearest': Image.Resampling.NEAREST,
+    'box': Image.Resampling.BOX,
+    'bilinear': Image.Resampling.BILINEAR,
+    'hamming': Image.Resampling.HAMMING,
+    'bicubic': Image.Resampling.BICUBIC,
+    'lanczos': Image.Resampling.LANCZOS,
+}
+
+
+def load_gray_image(source, max_size=MAX_IMAGE_SIZE, reduced=False, resize_filter='lanczos'):
+    """Open an image (path or file object), shrink it to max_size and return it as a grayscale array
+
+    With reduced=True a JPEG is decoded straight to grayscale at the smallest 1/2, 1/4 or 1/8
+    DCT scale that still covers max_size, so a phone photo is never decoded at full resolution.
+    """
+    pil_img = Image.open(source)
+    resample = RESIZE_FILTERS[resize_filter]
+
+    if reduced:
+        if pil_img.width > max_size or pil_img.height > max_size:
+            scale = max_size / max(pil_img.width, pil_img.height)
+            pil_img.draft('L', (int(pil_img.width * scale), int(pil_img.height * scale)))
+        if pil_img.mode != 'L':
+            pil_img = pil_img.convert('L')
+
+    if pil_img.width > max_size or pil_img.height > max_size:
+        scale = max_size / max(pil_img.width, pil_img.height)
+        new_width = int(pil_img.width * scale)
+        new_height = int(pil_img.height * scale)
+        pil_img = pil_img.resize((new_width, new_height), resample)
+
+    if reduced:
+        return np.array(pil_img)
+
+    if pil_img.mode != 'RGB':
+        pil_img = pil_img.convert('RGB')
+
+    img = cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+
+def get_decode_options():
+    """load_gray_image keyword arguments configured by FIND_REDUCED_DECODE / FIND_RESIZE_FILTER
+    """
+    from django.conf import settings
+    return {
+        'reduced': getattr(settings, 'FIND_REDUCED_DECODE', False),
+        'resize_filter': getattr(settings, 'FIND_RESIZE_FILTER', 'lanczos'),
+    }
+
+
+class FeatureBackend:
+    """A keypoint detector/descriptor extractor plus the norm its descriptors are compared with
+    """
+    name = None
+    norm = cv2.NORM_L2
+    binary = False
+    # 每个后端的版本号互不重叠：切换后端后，其它后端留下的描述符会被当作过期重新提取
+    feature_version = None
+
+    def create(self):
+        raise NotImplementedError
+
+    def extract(self, gray):
+        keypoints, descriptors = self.create().detectAndCompute(gray, None)
+        if descriptors is None or len(keypoints) == 0:
+            return None
+        return descriptors
+
+    def as_float(self, descriptors):
+        """Float32 vectors for the vocabulary k-means, which only works in Euclidean space
+        """
+        return np.asarray(descriptors, dtype=np.float32)
+
+
+class SiftBackend(FeatureBackend):
+    name = 'sift'
+    feature_version = FEATURE_VERSION
+
+    def create(self):
+        return cv2.SIFT_create(nfeatures=SIFT_FEATURES)
+
+
+class BinaryBackend(FeatureBackend):
+    """32-byte uint8 descriptors compared by Hamming distance, 16x smaller than SIFT's float32
+    """
+    norm = cv2.NORM_HAMMING
+    binary = True
+
+    def as_float(self, descriptors):
+        return np.unpackbits(np.asarray(descriptors, dtype=np.uint8), axis=1).astype(np.float32)
+
+
+class OrbBackend(BinaryBackend):
+    name = 'orb'
+    feature_version = 101
+
+    def create(self):
+        return cv2.ORB_create(nfeatures=BINARY_FEATURES)
+
+
+class AkazeBackend(BinaryBackend):
+    name = 'akaze'
+    feature_version = 201
+
+    def create(self):
+        factory = getattr(cv2, 'AKAZE_create', None) or getattr(getattr(cv2, 'xfeatures2d', None), 'AKAZE_create', None)
+        if factory is None:
+            raise RuntimeError('AKAZE is not available in this OpenCV build (OpenCV 5 ships it in opencv-contrib-python)')
+        # 256 位 MLDB 描述符，与 ORB 一样是 32 字节
+        return factory(descriptor_size=256)
+
+    def extract(self, gray):
+        # AKAZE 没有 nfeatures 参数，按响应值保留最强的关键点
+        akaze = self.create()
+        keypoints = sorted(akaze.detect(gray, None), key=lambda kp: kp.response, reverse=True)[:BINARY_FEATURES]
+        if not keypoints:
+            return None
+        keypoints, descriptors = akaze.compute(gray, keypoints)
+        if descriptors is None or len(keypoints) == 0:
+            return None
+        return descriptors
+
+
+FEATURE_BACKENDS = {backend.name: backend for backend in (SiftBackend(), OrbBackend(), AkazeBackend())}
+
+
+def get_feature_backend():
+    """Backend selected by FIND_FEATURE_BACKEND ('sift', 'orb' or 'akaze')
+    """
+    from django.conf import settings
+    from django.core.exceptions import ImproperlyConfigured
+    name = getattr(settings, 'FIND_FEATURE_BACKEND', 'sift')
+    try:
+        return FEATURE_BACKENDS[name]
+    except KeyError:
+        raise ImproperlyConfigured(f'Unknown FIND_FEATURE_BACKEND {name!r}, expected one of {sorted(FEATURE_BACKENDS)}') from None
+
+
+def extract_descriptors(gray, backend=None, codec=None):
+    """Run the configured feature backend on a grayscale image and encode the result with the descriptor codec
+
+    Returns None when no keypoint is found.
+    """
+    from .codecs import get_descriptor_codec
+    backend = backend or get_feature_backend()
+    codec = codec or get_descriptor_codec(backend)
+    descriptors = backend.extract(gray)
+    if descriptors is None:
+        return None
+    return codec.encode(descriptors)
+
+
+def current_feature_tag():
+    """(feature_version, feature_codec) a PhotoLost row must carry for its stored descriptors to be usable as is
+    """
+    from .codecs import get_descriptor_codec
+    backend = get_feature_backend()
+    return backend.feature_version, get_descriptor_codec(backend).tag
+
+
+def serialize_descriptors(descriptors):
+    """Pack a descriptor matrix into bytes (.npy format, keeps shape and dtype)
+    """
+    buffer = io.BytesIO()
+    np.save(buffer, descriptors, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def deserialize_descriptors(data):
+    """Inverse of serialize_descriptors, returns None for empty data
+    """
+    if not data:
+        return None
+    return np.load(io.BytesIO(bytes(data)), allow_pickle=False)
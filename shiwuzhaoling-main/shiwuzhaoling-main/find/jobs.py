@@ -0,0 +1,164 @@
+"""Background compare jobs: uploads queued in the compare_job table and matched by worker threads"""
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import close_old_connections
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import CompareJob
+
+logger = logging.getLogger(__name__)
+
+FINISHED = (CompareJob.DONE, CompareJob.FAILED)
+
+
+def claimable(job_timeout):
+    # 运行超时的任务视为所在进程已退出，允许重新领取
+    stale = timezone.now() - timedelta(seconds=job_timeout)
+    return Q(status=CompareJob.PENDING) | Q(status=CompareJob.RUNNING, started_at__lt=stale)
+
+
+def claim_next_job(job_timeout, max_attempts=3):
+    """Atomically move the oldest claimable job to running and return it, or None when the queue is empty
+
+    The conditional UPDATE is the claim, so workers in any number of processes never
+    run a job concurrently; a job running longer than job_timeout is assumed orphaned and claimed
+    again, up to max_attempts claims in all, after which it fails (e.g. a photo that kills the worker).
+    """
+    CompareJob.objects.filter(claimable(job_timeout), attempts__gte=max_attempts).update(
+        status=CompareJob.FAILED,
+        result={'code': 500, 'msg': '比对失败: 多次执行未完成'},
+        photo=None,
+        finished_at=timezone.now()
+    )
+    for pk in CompareJob.objects.filter(claimable(job_timeout)).order_by('id').values_list('id', flat=True)[:8]:
+        claimed = CompareJob.objects.filter(claimable(job_timeout), pk=pk, attempts__lt=max_attempts).update(
+            status=CompareJob.RUNNING, started_at=timezone.now(), attempts=F('attempts') + 1
+        )
+        if claimed:
+            return CompareJob.objects.get(pk=pk)
+    return None
+
+
+def run_job(job):
+    from .views import run_compare
+    try:
+        result, status = run_compare(SimpleUploadedFile(job.photo_name, bytes(job.photo or b'')), job.media_base)
+    except Exception as e:
+        logger.exception('[比对任务] 任务 %s 执行失败: %s', job.job_id, e)
+        result, status = {'code': 500, 'msg': f'比对失败: {str(e)}'}, 500
+    CompareJob.objects.filter(pk=job.pk).update(
+        status=CompareJob.FAILED if status >= 500 else CompareJob.DONE,
+        result=result,
+        photo=None,
+        finished_at=timezone.now()
+    )
+
+
+def queue_position(job):
+    """1 for the next job to be claimed, 0 once it is running or finished"""
+    if job.status != CompareJob.PENDING:
+        return 0
+    return CompareJob.objects.filter(status=CompareJob.PENDING, pk__lte=job.pk).count()
+
+
+def purge_finished_jobs(ttl):
+    CompareJob.objects.filter(finished_at__lt=timezone.now() - timedelta(seconds=ttl)).delete()
+
+
+class QueueWorkers:
+    """Daemon threads that repeatedly claim() an item from a table-backed queue and run() it
+
+    Work queued by this process wakes the workers at once through notify(); work queued by
+    other processes is picked up within poll_interval seconds.
+    """
+
+    def __init__(self, name, claim, run, workers, poll_interval=1.0):
+        self.name = name
+        self.claim = claim
+        self.run = run
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._threads = []
+        self._changed = threading.Condition()
+
+    def start(self):
+        with self._changed:
+            if self._threads:
+                return self
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'{self.name}-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        return self
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def notify(self):
+        with self._changed:
+            self._changed.notify_all()
+
+    def wait(self, timeout):
+        with self._changed:
+            self._changed.wait(timeout)
+
+    def _run(self):
+        while True:
+            item = None
+            try:
+                close_old_connections()
+                item = self.claim()
+                if item is not None:
+                    self.run(item)
+            except Exception as e:
+                logger.exception('[%s] worker 异常: %s', self.name, e)
+            finally:
+                close_old_connections()
+            if item is None:
+                self.wait(self.poll_interval)
+            else:
+                self.notify()
+
+
+def compare_workers(workers):
+    from django.conf import settings
+    job_timeout = getattr(settings, 'FIND_COMPARE_JOB_TIMEOUT', 600)
+    max_attempts = getattr(settings, 'FIND_COMPARE_MAX_ATTEMPTS', 3)
+    return QueueWorkers('比对任务', lambda: claim_next_job(job_timeout, max_attempts), run_job, workers,
+                        getattr(settings, 'FIND_COMPARE_POLL_SECONDS', 1.0))
+
+
+_workers = None
+_workers_lock = threading.Lock()
+
+
+def get_compare_workers():
+    """This process's compare worker threads (started on first use), sized by FIND_COMPARE_WORKERS
+    """
+    global _workers
+    with _workers_lock:
+        if _workers is None:
+            from django.conf import settings
+            _workers = compare_workers(getattr(settings, 'FIND_COMPARE_WORKERS', 2))
+        return _workers.start()
+
+
+def wait_for_job(job, timeout):
+    """Re-read the job until it finishes or timeout seconds pass (long polling), return the latest state
+    """
+    workers = get_compare_workers()
+    deadline = time.monotonic() + timeout
+    while job.status not in FINISHED:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        # 本进程的 worker 完成任务时会立即唤醒；其他进程的 worker 完成时靠定时重读
+        workers.wait(min(remaining, workers.poll_interval))
+        job.refresh_from_db(fields=['status', 'result', 'started_at', 'finished_at'])
+    return job
@@ -0,0 +1,78 @@
+"""Cached item list responses with ETags, invalidated through a table version kept in Django's cache"""
+import hashlib
+import uuid
+
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags
+
+VERSION_KEY = 'find:items:version'
+
+
+def get_list_cache():
+    from django.conf import settings
+    from django.core.cache import caches
+    return caches[getattr(settings, 'FIND_LIST_CACHE', 'default')]
+
+
+def get_version_cache():
+    # 版本被淘汰后 ETag 全部失效，因此放在不淘汰的 FIND_STATE_CACHE(未配置时用列表缓存)
+    from django.conf import settings
+    from django.core.cache import caches
+    alias = getattr(settings, 'FIND_STATE_CACHE', None)
+    return caches[alias] if alias else get_list_cache()
+
+
+def items_version():
+    cache = get_version_cache()
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # 版本被淘汰后换一个从未用过的值，旧版本下缓存的响应不会再被读到
+        version = uuid.uuid4().hex
+        if not cache.add(VERSION_KEY, version, timeout=None):
+            version = cache.get(VERSION_KEY, version)
+    return version
+
+
+def bump_items_version():
+    """Invalidate every cached list response; call after any change to photo_lost that the lists show
+    """
+    # 每次写入新的随机值而不是自增：并发写入时无论谁最后写入，版本都与之前的不同
+    get_version_cache().set(VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def cached_list(request, scope, build, private=False):
+    """build()'s response for this request, served from the cache, or 304 while the table is unchanged
+
+    scope separates responses that differ for the same URL (e.g. per user). Only 200 responses
+    are cached; the ETag is derived from the table version, so a matching If-None-Match is
+    answered without touching the rows or the cached body.
+    """
+    from django.conf import settings
+    cache = get_list_cache()
+    version = items_version()
+    key = hashlib.sha1(f'{scope}\0{request.build_absolute_uri()}'.encode()).hexdigest()
+    etag = f'"{hashlib.sha1(f"{version}:{key}".encode()).hexdigest()}"'
+
+    if_none_match = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    if etag in if_none_match or '*' in if_none_match:
+        response = HttpResponseNotModified()
+    else:
+        cache_key = f'find:items:{version}:{key}'
+        body = cache.get(cache_key)
+        if body is None:
+            response = build()
+            if response.status_code != 200:
+                return response
+            body = response.content
+            cache.set(cache_key, body, getattr(settings, 'FIND_LIST_CACHE_SECONDS', 300))
+        response = HttpResponse(body, content_type='application/json')
+
+    response['ETag'] = etag
+    # 客户端可以缓存，但每次都要带 If-None-Match 重新验证
+    if private:
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ['Authorization'])
+    else:
+        patch_cache_control(response, no_cache=True)
+    return response
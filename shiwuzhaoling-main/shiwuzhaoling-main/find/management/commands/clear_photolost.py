@@ -1,5 +1,9 @@
+from django.core.files.storage import default_storage
 from django.core.management.base import BaseCommand
+from find.cache import get_image_cache
+from find.list_cache import bump_items_version
 from find.models import PhotoLost
+from find.views import unindex_photo
 
 
 class Command(BaseCommand):
@@ -7,8 +11,14 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         count = PhotoLost.objects.count()
-        for obj in PhotoLost.objects.all():
-            if obj.image:
-                obj.image.delete(save=False)
-            obj.delete()
+        # 只取 id 和文件名，不把每行的描述符读进内存
+        rows = PhotoLost.objects.values_list('id', 'image', 'thumbnail')
+        for photo_id, image_name, thumbnail_name in rows.iterator():
+            for name in (image_name, thumbnail_name):
+                if name:
+                    default_storage.delete(name)
+            PhotoLost.objects.filter(pk=photo_id).delete()
+            unindex_photo(photo_id, image_name)
+        bump_items_version()
+        get_image_cache().clear()
         self.stdout.write(self.style.SUCCESS(f'Cleared {count} PhotoLost records'))
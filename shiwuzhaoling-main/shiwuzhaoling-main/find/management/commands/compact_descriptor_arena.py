@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand, CommandError
+from find.arena import get_descriptor_arena
+from find.models import PhotoLost
+
+
+class Command(BaseCommand):
+    help = 'Rewrite the shared descriptor arena without deleted photos'
+
+    def handle(self, *args, **options):
+        arena = get_descriptor_arena()
+        if arena is None:
+            raise CommandError('The descriptor arena is disabled (FIND_DESCRIPTOR_ARENA_DIR is not set or flock is unavailable)')
+        arena.refresh()
+        before = arena.total_rows
+        arena.compact(live_ids=set(PhotoLost.objects.values_list('id', flat=True)))
+        self.stdout.write(self.style.SUCCESS(f'Compacted {arena.directory}: {before} -> {arena.total_rows} rows, '
+                                             f'{len(arena)} photos'))
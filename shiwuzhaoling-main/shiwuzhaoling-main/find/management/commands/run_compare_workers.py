@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from find.jobs import compare_workers
+
+
+class Command(BaseCommand):
+    help = 'Run compare job workers in a dedicated process (use with FIND_COMPARE_WORKERS = 0 in the web processes)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=max(1, getattr(settings, 'FIND_COMPARE_WORKERS', 2)))
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1')
+        workers = compare_workers(options['workers']).start()
+        self.stdout.write(self.style.SUCCESS(f'Running {options["workers"]} compare workers, Ctrl+C to stop'))
+        try:
+            workers.join()
+        except KeyboardInterrupt:
+            pass
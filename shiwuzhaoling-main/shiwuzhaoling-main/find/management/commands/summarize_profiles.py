@@ -0,0 +1,72 @@
+import glob
+import os
+import pstats
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+def describe(func):
+    filename, line, name = func
+    if filename == '~':
+        return name
+    return f'{os.path.basename(filename)}:{line}({name})'
+
+
+def heaviest_path(stats, func, depth=40):
+    """Callers from the outermost frame down to func, following the caller that accounts for most of its time
+    """
+    path = [func]
+    seen = {func}
+    while len(path) < depth:
+        callers = stats[path[-1]][4]
+        if not callers:
+            break
+        caller = max(callers, key=lambda c: callers[c][3])
+        if caller in seen:
+            break
+        seen.add(caller)
+        path.append(caller)
+    return path[::-1]
+
+
+class Command(BaseCommand):
+    help = 'Summarize the slowest call paths across request profiles written by find.profiling.ProfilingMiddleware'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*',
+                            help='.prof files or directories (default: FIND_PROFILE_DIR)')
+        parser.add_argument('--endpoint', default='',
+                            help='Only dumps whose file name contains this, e.g. api-compare')
+        parser.add_argument('--sort', choices=('tottime', 'cumulative'), default='tottime',
+                            help='Rank functions by own time or by time including callees')
+        parser.add_argument('--limit', type=int, default=15)
+        parser.add_argument('--full', action='store_true',
+                            help='Show every frame of a call path, not only the project\'s and the slow function')
+
+    def handle(self, *args, **options):
+        paths = options['paths'] or [getattr(settings, 'FIND_PROFILE_DIR', None)]
+        if not paths[0]:
+            raise CommandError('FIND_PROFILE_DIR is not configured, pass profile files or directories')
+        files = []
+        for path in map(str, paths):
+            files.extend(sorted(glob.glob(os.path.join(path, '*.prof'))) if os.path.isdir(path) else [path])
+        files = [f for f in files if options['endpoint'] in os.path.basename(f)]
+        if not files:
+            raise CommandError('No profiles found')
+
+        stats = pstats.Stats(*files)
+        index = 2 if options['sort'] == 'tottime' else 3
+        ranked = sorted(stats.stats, key=lambda func: stats.stats[func][index], reverse=True)
+        project = str(settings.BASE_DIR)
+
+        self.stdout.write(f'{len(files)} profiles, {stats.total_tt:.3f}s profiled in total\n')
+        for func in ranked[:options['limit']]:
+            calls, _, tottime, cumtime, _ = stats.stats[func]
+            self.stdout.write(self.style.SUCCESS(
+                f'{describe(func)}  own {tottime:.3f}s  total {cumtime:.3f}s  calls {calls}'))
+            path = heaviest_path(stats.stats, func)
+            if not options['full']:
+                # 只保留项目内的栈帧，框架和标准库的调用链对定位慢点帮助不大
+                path = [frame for frame in path[:-1] if frame[0].startswith(project)] + path[-1:]
+            self.stdout.write('    ' + ' > '.join(describe(frame) for frame in path))
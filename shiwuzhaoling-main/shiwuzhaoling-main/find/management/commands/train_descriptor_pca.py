@@ -0,0 +1,55 @@
+import os
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from find.codecs import LOSSLESS_CODECS, RAW_CODEC, PcaCodec
+from find.features import get_feature_backend, extract_descriptors, load_gray_image, get_decode_options, deserialize_descriptors
+from find.models import PhotoLost
+
+
+class Command(BaseCommand):
+    help = 'Train the PCA projection used by FIND_DESCRIPTOR_CODEC = "pca16"'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--components', type=int, default=getattr(settings, 'FIND_PCA_COMPONENTS', 64),
+                            help='Dimensions kept after projection')
+        parser.add_argument('--sample', type=int, default=100000,
+                            help='Maximum number of descriptors fed to PCA')
+        parser.add_argument('--output', default=getattr(settings, 'FIND_PCA_PATH', None))
+
+    def handle(self, *args, **options):
+        if not options['output']:
+            raise CommandError('FIND_PCA_PATH is not configured, pass --output')
+        backend = get_feature_backend()
+        if backend.binary:
+            raise CommandError(f'PCA only applies to float descriptors, FIND_FEATURE_BACKEND is {backend.name!r}')
+
+        # PCA 要在全精度描述符上训练：无损格式直接读库，其余从原图重新提取
+        descriptor_sets = []
+        rows = PhotoLost.objects.values_list('image', 'descriptors', 'feature_version', 'feature_codec')
+        for image, data, feature_version, feature_codec in rows.iterator():
+            if feature_version == backend.feature_version and feature_codec in LOSSLESS_CODECS:
+                descriptors = deserialize_descriptors(data)
+            else:
+                path = os.path.join(settings.MEDIA_ROOT, image)
+                if not os.path.exists(path):
+                    continue
+                descriptors = extract_descriptors(load_gray_image(path, **get_decode_options()), backend, RAW_CODEC)
+            if descriptors is not None:
+                descriptor_sets.append(descriptors)
+        if not descriptor_sets:
+            raise CommandError('No stored descriptors to train on')
+
+        rng = np.random.default_rng(0)
+        per_photo = max(1, options['sample'] // len(descriptor_sets))
+        samples = np.concatenate([d if len(d) <= per_photo else d[rng.choice(len(d), per_photo, replace=False)]
+                                  for d in descriptor_sets])
+        components = min(options['components'], samples.shape[1])
+
+        self.stdout.write(f'Training a {components}-component PCA on {len(samples)} descriptors '
+                          f'from {len(descriptor_sets)} photos...')
+        codec = PcaCodec.train(samples, components)
+        codec.save(options['output'])
+        self.stdout.write(self.style.SUCCESS(f'Saved {codec.tag} to {options["output"]}; stored descriptors are '
+                                             f'converted on next use'))
@@ -0,0 +1,46 @@
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from find.codecs import get_descriptor_codec
+from find.features import get_feature_backend
+from find.views import get_database_images, load_stored_descriptors
+from find.vocabulary import Vocabulary
+
+
+class Command(BaseCommand):
+    help = 'Train the visual-word vocabulary used to shortlist compare candidates'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=getattr(settings, 'FIND_VOCABULARY_SIZE', 256),
+                            help='Number of visual words')
+        parser.add_argument('--sample', type=int, default=200000,
+                            help='Maximum number of descriptors fed to k-means')
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--output', default=getattr(settings, 'FIND_VOCABULARY_PATH', None))
+
+    def handle(self, *args, **options):
+        if not options['output']:
+            raise CommandError('FIND_VOCABULARY_PATH is not configured, pass --output')
+
+        descriptor_sets = []
+        for product in get_database_images():
+            descriptors = load_stored_descriptors(product)
+            if descriptors is not None:
+                descriptor_sets.append(descriptors)
+        if not descriptor_sets:
+            raise CommandError('No stored descriptors to train on')
+
+        # 每张图片抽取相同数量的描述符，避免特征点多的图片主导词典
+        rng = np.random.default_rng(0)
+        per_photo = max(1, options['sample'] // len(descriptor_sets))
+        samples = np.concatenate([d if len(d) <= per_photo else d[rng.choice(len(d), per_photo, replace=False)]
+                                  for d in descriptor_sets])
+
+        backend = get_feature_backend()
+        space = get_descriptor_codec(backend).space(backend)
+        self.stdout.write(f'Training {options["size"]} words on {len(samples)} {space} descriptors '
+                          f'from {len(descriptor_sets)} photos...')
+        vocabulary = Vocabulary.train(samples, options['size'], descriptor_sets, iterations=options['iterations'],
+                                      backend=backend.name, space=space)
+        vocabulary.save(options['output'])
+        self.stdout.write(self.style.SUCCESS(f'Saved {len(vocabulary)}-word vocabulary to {options["output"]}'))
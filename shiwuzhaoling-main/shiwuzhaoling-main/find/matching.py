@@ -0,0 +1,347 @@
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+RATIO = 0.75
+# 稠密匹配每块距离矩阵的元素个数上限(float32，32MB)
+DENSE_BLOCK_ELEMENTS = 1 << 23
+# 级联比对每轮完整打分的候选数
+CASCADE_BLOCK = 32
+
+
+def as_matchable(descriptors, norm):
+    """Descriptors in the dtype BFMatcher handles best for this norm
+
+    Compact float codecs (uint8, float16) are widened to float32 for the match only: OpenCV has no
+    float16 kernel and its uint8 L2 kernel is several times slower than the float32 one. The widening
+    is exact, so scores are the same. Binary descriptors stay uint8 for NORM_HAMMING.
+    """
+    if norm == cv2.NORM_HAMMING or descriptors.dtype == np.float32:
+        return descriptors
+    return descriptors.astype(np.float32)
+
+
+def count_good_matches(bf, desc1, desc2):
+    matches = bf.knnMatch(desc1, desc2, k=2)
+
+    good_matches = 0
+    for match_pair in matches:
+        if len(match_pair) == 2:
+            m, n = match_pair
+            if m.distance < RATIO * n.distance:
+                good_matches += 1
+    return good_matches
+
+
+def score_candidates(desc1, candidates, verbose=False, norm=cv2.NORM_L2):
+    """Ratio-test every (photo_id, image, descriptors) candidate, return the best (similarity, image, photo_id)
+
+    norm is the feature backend's: NORM_L2 for SIFT, NORM_HAMMING for the binary backends.
+    """
+    bf = cv2.BFMatcher(norm)
+    desc1 = as_matchable(desc1, norm)
+    # 逐张日志只在 DEBUG 级别输出，热路径上不做字符串格式化
+    verbose = verbose and logger.isEnabledFor(logging.DEBUG)
+    best = (0, None, None)
+    for photo_id, image, desc2 in candidates:
+        try:
+            good_matches = count_good_matches(bf, desc1, as_matchable(desc2, norm))
+        except cv2.error as e:
+            logger.warning('[图片对比] 图片(ID:%s)处理失败: %s', photo_id, e)
+            continue
+        similarity = good_matches / min(len(desc1), len(desc2))
+        if verbose:
+            logger.debug('[图片对比] 图片(ID:%s): 特征点=%d, 匹配=%d, 相似度=%.4f', photo_id, len(desc2), good_matches, similarity)
+        if similarity > best[0]:
+            best = (similarity, image, photo_id)
+    return best
+
+
+def score_candidates_batch(queries, candidates, norm=cv2.NORM_L2):
+    """Similarity of every (photo_id, image, descriptors) candidate to each of several query descriptor sets
+
+    The queries are stacked so each candidate costs one knnMatch call for all of them; a query row's
+    two nearest neighbours do not depend on the other rows, so every score equals score_candidates'.
+    Returns [(photo_id, image, [similarity per query])].
+    """
+    bf = cv2.BFMatcher(norm)
+    lengths = np.array([len(query) for query in queries])
+    segments = np.repeat(np.arange(len(queries)), lengths)
+    stacked = as_matchable(np.concatenate(queries), norm)
+    results = []
+    for photo_id, image, desc2 in candidates:
+        try:
+            matches = bf.knnMatch(stacked, as_matchable(desc2, norm), k=2)
+        except cv2.error as e:
+            logger.warning('[图片对比] 图片(ID:%s)处理失败: %s', photo_id, e)
+            continue
+        good = [pair[0].queryIdx for pair in matches if len(pair) == 2 and pair[0].distance < RATIO * pair[1].distance]
+        counts = np.bincount(segments[good], minlength=len(queries))
+        results.append((photo_id, image, (counts / np.minimum(lengths, len(desc2))).tolist()))
+    return results
+
+
+def dense_operands(descriptors, norm):
+    """float32 rows whose squared Euclidean distances give the norm's distances
+
+    Binary descriptors are unpacked to 0/1 bits, so the squared distance is the Hamming distance.
+    """
+    if norm == cv2.NORM_HAMMING:
+        return np.unpackbits(descriptors, axis=1).astype(np.float32)
+    return as_matchable(descriptors, norm)
+
+
+def _dense_good_matches(queries, queries_sq, block, norm):
+    """(query rows x candidates) ratio-test outcome for one block of candidates stacked into a matrix
+    """
+    sizes = np.array([len(descriptors) for _, _, descriptors in block])
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    database = np.concatenate([dense_operands(descriptors, norm) for _, _, descriptors in block])
+
+    # |q|^2 + |d|^2 - 2 q.d：SIFT 与二进制描述符都是整数，float32 下每一步都精确
+    distances = queries @ database.T
+    distances *= -2
+    distances += queries_sq[:, None]
+    distances += np.einsum('ij,ij->i', database, database)[None, :]
+    np.maximum(distances, 0, out=distances)
+
+    # 每个候选图片(连续的一段列)内的最近和次近距离；最小值出现两次时次近距离等于最近距离
+    first = np.minimum.reduceat(distances, starts, axis=1)
+    at_first = distances == np.repeat(first, sizes, axis=1)
+    repeated = np.add.reduceat(at_first.view(np.uint8), starts, axis=1, dtype=np.uint16) > 1
+    np.putmask(distances, at_first, np.inf)
+    second = np.minimum.reduceat(distances, starts, axis=1)
+    second[repeated] = first[repeated]
+
+    if norm != cv2.NORM_HAMMING:
+        # 与 BFMatcher 一样在 float32 下开方，再按 m.distance < 0.75 * n.distance 比较
+        first, second = np.sqrt(first), np.sqrt(second)
+    good = first.astype(np.float64) < RATIO * second.astype(np.float64)
+    # 只有一个特征点的图片，knnMatch 给不出次近邻
+    good &= sizes[None, :] > 1
+    return good
+
+
+def dense_good_counts(queries, candidates, norm=cv2.NORM_L2):
+    """(queries x candidates) array of ratio-test good matches; candidates must all have descriptors
+
+    Candidate descriptors are stacked block by block (a candidate never spans two blocks) and the
+    query x database distances come from one BLAS product per block; per-image top-2 distances and
+    the ratio test are then computed on whole arrays. For integer-valued descriptors (SIFT raw/uint8,
+    binary) every distance is exact, so the counts equal BFMatcher's.
+    """
+    lengths = np.array([len(query) for query in queries])
+    query_starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    stacked = dense_operands(np.concatenate(queries), norm)
+    stacked_sq = np.einsum('ij,ij->i', stacked, stacked)
+    max_columns = max(1, DENSE_BLOCK_ELEMENTS // len(stacked))
+
+    counts = np.zeros((len(queries), len(candidates)), dtype=np.int64)
+    start = 0
+    while start < len(candidates):
+        end, columns = start + 1, len(candidates[start][2])
+        while end < len(candidates) and columns + len(candidates[end][2]) <= max_columns:
+            columns += len(candidates[end][2])
+            end += 1
+        good = _dense_good_matches(stacked, stacked_sq, candidates[start:end], norm)
+        counts[:, start:end] = np.add.reduceat(good.astype(np.int64), query_starts, axis=0)
+        start = end
+    return counts
+
+
+def usable(candidates):
+    return [candidate for candidate in candidates if candidate[2] is not None and len(candidate[2])]
+
+
+def dense_scores(queries, candidates, norm=cv2.NORM_L2):
+    """Same similarities as score_candidates_batch, from blocked matrix products instead of per-image knnMatch
+    """
+    candidates = usable(candidates)
+    if not candidates:
+        return []
+    counts = dense_good_counts(queries, candidates, norm)
+    lengths = np.array([len(query) for query in queries])
+    sizes = np.array([len(descriptors) for _, _, descriptors in candidates])
+    similarities = counts / np.minimum(lengths[:, None], sizes[None, :])
+    return [(photo_id, image, similarities[:, column].tolist()) for column, (photo_id, image, _) in enumerate(candidates)]
+
+
+def dense_best_match(desc1, candidates, verbose=False, norm=cv2.NORM_L2):
+    """Best (similarity, image, photo_id) like score_candidates, computed with dense_scores
+    """
+    verbose = verbose and logger.isEnabledFor(logging.DEBUG)
+    best = (0, None, None)
+    for photo_id, image, (similarity,) in dense_scores([desc1], candidates, norm):
+        if verbose:
+            logger.debug('[图片对比] 图片(ID:%s): 相似度=%.4f', photo_id, similarity)
+        if similarity > best[0]:
+            best = (similarity, image, photo_id)
+    return best
+
+
+def cascade_best_match(desc1, candidates, norm=cv2.NORM_L2, subset_size=64, prune_margin=None, confident=None, stats=None):
+    """Best (similarity, image, photo_id) like dense_best_match, skipping candidates that cannot win
+
+    Every candidate is first pre-scored with an evenly spaced subset of the query keypoints, which
+    costs subset_size / len(desc1) of a full scan. Candidates are then fully scored, best estimate
+    first, in blocks of CASCADE_BLOCK; only the remaining query rows are matched, since each row's
+    ratio test does not depend on the others. Before each block a candidate is pruned when
+
+    * even if all its remaining rows matched it could not beat the best so far (never changes the result), or
+    * its pre-score extrapolated to all rows is below prune_margin x the best so far (heuristic, None to disable);
+
+    and the scan stops once the best reaches confident (None to disable). With both heuristics off
+    the result is exactly dense_best_match's. stats, when given, receives the per-stage counts.
+    """
+    candidates = usable(candidates)
+    if stats is not None:
+        stats.update(candidates=len(candidates), scanned=0, pruned=0, stopped_early=0)
+    if not candidates:
+        return 0, None, None
+    if len(desc1) <= subset_size:
+        if stats is not None:
+            stats['scanned'] = len(candidates)
+        return dense_best_match(desc1, candidates, norm=norm)
+
+    rows = np.zeros(len(desc1), dtype=bool)
+    rows[np.linspace(0, len(desc1) - 1, subset_size).round().astype(int)] = True
+    head_good = dense_good_counts([desc1[rows]], candidates, norm)[0]
+    tail = desc1[~rows]
+    sizes = np.array([len(descriptors) for _, _, descriptors in candidates])
+    denominators = np.minimum(len(desc1), sizes)
+    estimates = head_good * (len(desc1) / rows.sum()) / denominators
+    bounds = (head_good + len(tail)) / denominators
+    # 预估分数高的先算，尽早抬高当前最优；同分按原顺序
+    order = np.lexsort((np.arange(len(candidates)), -estimates))
+
+    best_similarity, best_index = 0, None
+    scanned = pruned = 0
+    position = 0
+    while position < len(order):
+        if confident is not None and best_similarity >= confident:
+            break
+        block = order[position:position + CASCADE_BLOCK]
+        position += len(block)
+        keep = [i for i in block
+                if (bounds[i] > best_similarity or (bounds[i] == best_similarity and best_index is not None and i < best_index))
+                and (prune_margin is None or estimates[i] >= prune_margin * best_similarity)]
+        pruned += len(block) - len(keep)
+        if not keep:
+            continue
+        tail_good = dense_good_counts([tail], [candidates[i] for i in keep], norm)[0]
+        scanned += len(keep)
+        for i, similarity in zip(keep, (head_good[keep] + tail_good) / denominators[keep]):
+            # 与逐张扫描一样：相似度最高者胜出，同分取原顺序靠前的
+            if similarity > best_similarity or (similarity == best_similarity and similarity > 0 and i < best_index):
+                best_similarity, best_index = similarity, i
+
+    if stats is not None:
+        stats.update(scanned=scanned, pruned=pruned, stopped_early=len(order) - position)
+    if best_index is None:
+        return 0, None, None
+    photo_id, image, _ = candidates[best_index]
+    return float(best_similarity), image, photo_id
+
+
+def _init_worker():
+    # 每个进程单线程，避免 OpenCV 线程池和进程池叠加后超订 CPU
+    cv2.setNumThreads(1)
+
+
+_pool = None
+_pool_workers = None
+_pool_lock = threading.Lock()
+
+
+def get_process_pool(workers):
+    """Long-lived pool shared by all requests of this process, recreated if the worker count changes
+    """
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            # spawn: 不继承父进程的数据库连接和 OpenCV 线程状态
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=_init_worker)
+            _pool_workers = workers
+        return _pool
+
+
+def shutdown_process_pool():
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+        _pool = _pool_workers = None
+
+
+def map_chunks(score, query, candidates, *args):
+    """score(query, chunk, *args) for each FIND_MATCH_CHUNK_SIZE chunk of candidates on the process pool
+
+    Returns None when the candidates should be scored serially in this process instead:
+    FIND_MATCH_WORKERS <= 1, no more than one chunk, or a broken pool.
+    """
+    from django.conf import settings
+    workers = getattr(settings, 'FIND_MATCH_WORKERS', 0)
+    chunk_size = max(1, getattr(settings, 'FIND_MATCH_CHUNK_SIZE', 32))
+    if workers <= 1 or len(candidates) <= chunk_size:
+        return None
+
+    chunks = [candidates[i:i + chunk_size] for i in range(0, len(candidates), chunk_size)]
+    try:
+        return list(get_process_pool(workers).map(score, repeat(query), chunks, *map(repeat, args)))
+    except BrokenProcessPool as e:
+        logger.warning('[图片对比] 进程池异常，改为串行匹配: %s', e)
+        shutdown_process_pool()
+        return None
+
+
+def find_best_match(desc1, candidates, norm=cv2.NORM_L2, stats=None):
+    """Best (similarity, image, photo_id) over the candidates
+
+    FIND_MATCHER = 'dense' scores them with blocked matrix products in this process, through the
+    pruning cascade when FIND_CASCADE is on (stats then receives its counts). 'bf' runs
+    BFMatcher per image, fanned out over the process pool when it pays off: FIND_MATCH_WORKERS <= 1
+    keeps everything in the calling process, and candidate lists no longer than one
+    FIND_MATCH_CHUNK_SIZE chunk are matched serially as well.
+    """
+    from django.conf import settings
+    if getattr(settings, 'FIND_MATCHER', 'dense') == 'dense':
+        if getattr(settings, 'FIND_CASCADE', False):
+            return cascade_best_match(desc1, candidates, norm,
+                                      subset_size=getattr(settings, 'FIND_CASCADE_SUBSET', 64),
+                                      prune_margin=getattr(settings, 'FIND_CASCADE_PRUNE_MARGIN', None),
+                                      confident=getattr(settings, 'FIND_CONFIDENT_SIMILARITY', None),
+                                      stats=stats)
+        return dense_best_match(desc1, candidates, verbose=True, norm=norm)
+    results = map_chunks(score_candidates, desc1, candidates, False, norm)
+    if results is None:
+        return score_candidates(desc1, candidates, verbose=True, norm=norm)
+
+    # 按块顺序归约，并列时与串行一样保留先出现的候选
+    best = (0, None, None)
+    for result in results:
+        if result[0] > best[0]:
+            best = result
+    return best
+
+
+def score_all(queries, candidates, norm=cv2.NORM_L2):
+    """Per-query similarities of every candidate (see score_candidates_batch), computed like find_best_match
+    """
+    from django.conf import settings
+    if getattr(settings, 'FIND_MATCHER', 'dense') == 'dense':
+        return dense_scores(queries, candidates, norm)
+    results = map_chunks(score_candidates_batch, queries, candidates, norm)
+    if results is None:
+        return score_candidates_batch(queries, candidates, norm)
+    return [scored for chunk in results for scored in chunk]
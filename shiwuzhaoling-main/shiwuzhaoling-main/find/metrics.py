@@ -0,0 +1,211 @@
+"""Process-local compare metrics (per-stage timings, candidate counts) in the Prometheus text format"""
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self.samples())
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        with self._lock:
+            self._values[self._key(labels)] += amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}' for key, value in values]
+
+
+class Gauge(Metric):
+    """Gauge (or a counter kept elsewhere, with kind='counter') whose value is read from callback() at scrape time"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, callback, kind='gauge'):
+        super().__init__(name, documentation)
+        self.callback = callback
+        self.kind = kind
+
+    def samples(self):
+        return [f'{self.name} {_format_value(self.callback())}']
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, (None, 0))
+            if counts is None:
+                counts = [0] * len(self.buckets)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        lines = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(float(total))}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+REGISTRY = []
+
+
+def render():
+    """All metrics of this process in the Prometheus text exposition format (0.0.4)"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+COMPARE_SECONDS = Histogram('find_compare_seconds', 'End-to-end compare latency', ['endpoint', 'result'])
+COMPARE_STAGE_SECONDS = Histogram('find_compare_stage_seconds', 'Time spent per compare stage', ['endpoint', 'stage'])
+COMPARE_CANDIDATES = Histogram('find_compare_candidates', 'Stored photos per compare request by outcome',
+                               ['endpoint', 'outcome'], buckets=COUNT_BUCKETS)
+COMPARE_CANDIDATES_TOTAL = Counter('find_compare_candidates_total', 'Stored photos by compare outcome',
+                                   ['endpoint', 'outcome'])
+
+
+def _cache_stat(name):
+    def read():
+        from .cache import get_image_cache
+        return get_image_cache().stats()[name]
+    return read
+
+
+for _stat in ('entries', 'bytes'):
+    Gauge(f'find_image_cache_{_stat}', f'Image/descriptor LRU cache {_stat}', _cache_stat(_stat))
+for _stat in ('hits', 'misses', 'evictions'):
+    Gauge(f'find_image_cache_{_stat}_total', f'Image/descriptor LRU cache {_stat}', _cache_stat(_stat), kind='counter')
+
+_local = threading.local()
+
+
+class CompareTrace:
+    """Timings and candidate counts of one compare request, published when the request ends"""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.result = 'unknown'
+        self.stages = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.start = time.perf_counter()
+
+    def finish(self):
+        elapsed = time.perf_counter() - self.start
+        COMPARE_SECONDS.observe(elapsed, endpoint=self.endpoint, result=self.result)
+        for outcome, count in self.counts.items():
+            COMPARE_CANDIDATES.observe(count, endpoint=self.endpoint, outcome=outcome)
+            COMPARE_CANDIDATES_TOTAL.inc(count, endpoint=self.endpoint, outcome=outcome)
+        logger.info('[%s] 结果=%s 耗时=%.3fs 阶段=%s 候选=%s', self.endpoint, self.result, elapsed,
+                    {stage: round(seconds, 4) for stage, seconds in self.stages.items()}, dict(self.counts))
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def compare_trace(endpoint):
+    """Trace the enclosed compare; nested calls (pic_check inside run_compare) join the outer trace
+    """
+    trace = current_trace()
+    if trace is not None:
+        yield trace
+        return
+    trace = _local.trace = CompareTrace(endpoint)
+    try:
+        yield trace
+    except Exception:
+        trace.result = 'error'
+        raise
+    finally:
+        _local.trace = None
+        trace.finish()
+
+
+@contextmanager
+def stage(name):
+    """Time a compare stage (decode, extract, load, match, delete) into the current trace and the stage histogram
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        trace = current_trace()
+        endpoint = trace.endpoint if trace is not None else ''
+        COMPARE_STAGE_SECONDS.observe(elapsed, endpoint=endpoint, stage=name)
+        if trace is not None:
+            trace.stages[name] += elapsed
+
+
+def count(outcome, amount=1):
+    """Add to the current request's candidate count for outcome (scanned, pruned, skipped, missing_file..)
+    """
+    trace = current_trace()
+    if trace is not None and amount:
+        trace.counts[outcome] += amount
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.20 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('find', '0004_photolost_phone'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photolost',
+            name='descriptors',
+            field=models.BinaryField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='photolost',
+            name='feature_version',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+    ]
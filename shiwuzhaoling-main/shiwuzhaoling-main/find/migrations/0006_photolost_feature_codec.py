@@ -0,0 +1,18 @@
+# Generated by Django 3.2.20 on 2026-10-18 11:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('find', '0005_photolost_descriptors'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photolost',
+            name='feature_codec',
+            field=models.CharField(default='raw', editable=False, max_length=32),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.2.20 on 2026-10-18 11:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('find', '0006_photolost_feature_codec'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompareJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job_id', models.CharField(max_length=32, unique=True)),
+                ('photo', models.BinaryField(blank=True, editable=False, null=True)),
+                ('photo_name', models.CharField(max_length=255)),
+                ('media_base', models.CharField(max_length=255)),
+                ('status', models.CharField(choices=[('pending', '排队中'), ('running', '比对中'), ('done', '已完成'), ('failed', '失败')], db_index=True, default='pending', max_length=16)),
+                ('result', models.JSONField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='find.user')),
+            ],
+            options={
+                'db_table': 'compare_job',
+            },
+        ),
+    ]
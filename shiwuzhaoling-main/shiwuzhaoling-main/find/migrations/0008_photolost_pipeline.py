@@ -0,0 +1,55 @@
+# Generated by Django 3.2.20 on 2026-10-18 11:40
+
+from django.db import migrations, models
+
+
+def mark_existing_ready(apps, schema_editor):
+    # 已有的图片在保存时已提取过特征(或在比对时按需提取)，直接参与比对
+    PhotoLost = apps.get_model('find', 'PhotoLost')
+    PhotoLost.objects.update(status='ready')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('find', '0007_comparejob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photolost',
+            name='thumbnail',
+            field=models.ImageField(blank=True, editable=False, null=True, upload_to='photo_lost/thumbs/'),
+        ),
+        migrations.AddField(
+            model_name='photolost',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='photolost',
+            name='perceptual_hash',
+            field=models.CharField(blank=True, default='', editable=False, max_length=16),
+        ),
+        migrations.AddField(
+            model_name='photolost',
+            name='status',
+            field=models.CharField(choices=[('pending', '待处理'), ('processing', '处理中'), ('ready', '已就绪'), ('failed', '处理失败')], db_index=True, default='pending', editable=False, max_length=16),
+        ),
+        migrations.AddField(
+            model_name='photolost',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='photolost',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='photolost',
+            name='last_error',
+            field=models.CharField(blank=True, default='', editable=False, max_length=255),
+        ),
+        migrations.RunPython(mark_existing_ready, migrations.RunPython.noop),
+    ]
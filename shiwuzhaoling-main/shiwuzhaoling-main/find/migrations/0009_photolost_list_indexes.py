@@ -0,0 +1,21 @@
+# Generated by Django 3.2.20 on 2026-10-18 12:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('find', '0008_photolost_pipeline'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='photolost',
+            index=models.Index(fields=['created_at', 'id'], name='photo_lost_created_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='photolost',
+            index=models.Index(fields=['phone', 'created_at'], name='photo_lost_phone_created_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.20 on 2026-10-18 12:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('find', '0009_photolost_list_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comparejob',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
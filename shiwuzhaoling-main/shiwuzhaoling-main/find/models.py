@@ -1,13 +1,60 @@
 from django.db import models
 
+from .codecs import get_descriptor_codec
+from .features import get_feature_backend, load_gray_image, get_decode_options, extract_descriptors, serialize_descriptors
+
 
 class PhotoLost(models.Model):
+    # 上传后由后台流水线(find/pipeline.py)提取特征、生成缩略图和哈希，完成后标记为 ready
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    READY = 'ready'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, '待处理'), (PROCESSING, '处理中'), (READY, '已就绪'), (FAILED, '处理失败')]
+
     image = models.ImageField(upload_to='photo_lost/')
     phone = models.CharField(max_length=11, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # 上传时提取的SIFT描述符(.npy格式)，对比时直接读取，避免重复提取
+    descriptors = models.BinaryField(null=True, blank=True, editable=False)
+    feature_version = models.PositiveSmallIntegerField(default=0, editable=False)
+    # 描述符的存储格式(raw / uint8 / pca..)，见 find/codecs.py
+    feature_codec = models.CharField(max_length=32, default='raw', editable=False)
+    thumbnail = models.ImageField(upload_to='photo_lost/thumbs/', null=True, blank=True, editable=False)
+    # 文件内容的 sha256 和灰度图的 64 位差值哈希(dHash)，用于查重
+    content_hash = models.CharField(max_length=64, blank=True, default='', db_index=True, editable=False)
+    perceptual_hash = models.CharField(max_length=16, blank=True, default='', editable=False)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING, db_index=True, editable=False)
+    attempts = models.PositiveSmallIntegerField(default=0, editable=False)
+    # 待处理：最早可以领取的时间(失败重试的退避)；处理中：租约到期时间，过期视为 worker 已退出
+    next_attempt_at = models.DateTimeField(null=True, blank=True, editable=False)
+    last_error = models.CharField(max_length=255, blank=True, default='', editable=False)
 
     class Meta:
         db_table = 'photo_lost'
+        # 列表接口按 (created_at, id) 游标分页，我的发布按 phone 过滤后同样排序
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='photo_lost_created_id_idx'),
+            models.Index(fields=['phone', 'created_at'], name='photo_lost_phone_created_idx'),
+        ]
+
+    def compute_features(self, gray=None):
+        """Extract descriptors from the stored image (or its already decoded gray) and persist them without save()
+        """
+        backend = get_feature_backend()
+        codec = get_descriptor_codec(backend)
+        if gray is None:
+            gray = load_gray_image(self.image.path, **get_decode_options())
+        descriptors = extract_descriptors(gray, backend, codec)
+        self.descriptors = serialize_descriptors(descriptors) if descriptors is not None else None
+        self.feature_version = backend.feature_version
+        self.feature_codec = codec.tag
+        PhotoLost.objects.filter(pk=self.pk).update(
+            descriptors=self.descriptors,
+            feature_version=self.feature_version,
+            feature_codec=self.feature_codec
+        )
+        return descriptors
 
 
 class User(models.Model):
@@ -26,3 +73,32 @@ class UserToken(models.Model):
 
     class Meta:
         db_table = 'user_token'
+
+
+class CompareJob(models.Model):
+    """A queued compare: the upload waits here until a worker (find/jobs.py) claims and matches it
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, '排队中'), (RUNNING, '比对中'), (DONE, '已完成'), (FAILED, '失败')]
+
+    job_id = models.CharField(max_length=32, unique=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # 上传的图片原样存表，任何进程的 worker 都能领取；比对完成后清空
+    photo = models.BinaryField(null=True, blank=True, editable=False)
+    photo_name = models.CharField(max_length=255)
+    # 结果里图片地址的前缀(提交请求的 MEDIA_URL 绝对地址)
+    media_base = models.CharField(max_length=255)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    # 与同步接口 /api/compare/ 相同的响应内容
+    result = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # 被领取的次数；worker 进程在执行中退出后任务会被重新领取，达到上限后标记为失败
+    attempts = models.PositiveSmallIntegerField(default=0)
+
+    class Meta:
+        db_table = 'compare_job'
@@ -0,0 +1,151 @@
+"""Post-upload processing: descriptors, thumbnail and hashes computed by background workers"""
+import hashlib
+import io
+import logging
+import os
+import threading
+from datetime import timedelta
+
+import cv2
+import numpy as np
+from django.core.files.base import ContentFile
+from django.db.models import F, Q
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from .features import load_gray_image, get_decode_options
+from .jobs import QueueWorkers
+from .list_cache import bump_items_version
+from .models import PhotoLost
+
+logger = logging.getLogger(__name__)
+
+
+def claimable():
+    # 待处理且已过退避时间，或处理中但租约已过期(所在 worker 已退出)
+    return Q(status__in=(PhotoLost.PENDING, PhotoLost.PROCESSING)) & (
+        Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=timezone.now())
+    )
+
+
+def claim_next_photo(lease_seconds, max_attempts=3):
+    """Atomically lease the oldest photo waiting for processing, or None when there is nothing to do
+
+    A photo whose lease expired after its last allowed attempt (the worker died on it) is marked failed.
+    """
+    exhausted = PhotoLost.objects.filter(claimable(), attempts__gte=max_attempts).update(
+        status=PhotoLost.FAILED,
+        next_attempt_at=None,
+        last_error='处理超时'
+    )
+    if exhausted:
+        bump_items_version()
+    for pk in PhotoLost.objects.filter(claimable()).order_by('id').values_list('id', flat=True)[:8]:
+        claimed = PhotoLost.objects.filter(claimable(), pk=pk, attempts__lt=max_attempts).update(
+            status=PhotoLost.PROCESSING,
+            attempts=F('attempts') + 1,
+            next_attempt_at=timezone.now() + timedelta(seconds=lease_seconds)
+        )
+        if claimed:
+            return PhotoLost.objects.defer('descriptors').get(pk=pk)
+    return None
+
+
+def file_hash(field):
+    digest = hashlib.sha256()
+    with field.open('rb') as f:
+        for chunk in f.chunks():
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def difference_hash(gray):
+    """64-bit dHash of a grayscale image as 16 hex digits: near-identical photos differ in few bits
+    """
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return f'{int.from_bytes(np.packbits(bits).tobytes(), "big"):016x}'
+
+
+def make_thumbnail(field, size):
+    with field.open('rb') as f:
+        img = Image.open(f)
+        # JPEG 直接按 DCT 缩放解码，不必解出整张原图
+        img.draft('RGB', (size, size))
+        img = ImageOps.exif_transpose(img).convert('RGB')
+        img.thumbnail((size, size), Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        img.save(buffer, 'JPEG', quality=85)
+    return ContentFile(buffer.getvalue())
+
+
+def process_photo(photo):
+    """Compute descriptors, thumbnail and hashes for a stored photo, mark it ready and index it here
+    """
+    from django.conf import settings
+    from .views import index_photo
+    gray = load_gray_image(photo.image.path, **get_decode_options())
+    descriptors = photo.compute_features(gray)
+
+    if photo.thumbnail:
+        photo.thumbnail.delete(save=False)
+    name = os.path.splitext(os.path.basename(photo.image.name))[0] + '.jpg'
+    photo.thumbnail.save(name, make_thumbnail(photo.image, getattr(settings, 'FIND_THUMBNAIL_SIZE', 256)), save=False)
+
+    updated = PhotoLost.objects.filter(pk=photo.pk).update(
+        thumbnail=photo.thumbnail.name,
+        content_hash=file_hash(photo.image),
+        perceptual_hash=difference_hash(gray),
+        status=PhotoLost.READY,
+        next_attempt_at=None,
+        last_error=''
+    )
+    if not updated:
+        # 处理期间已被比对认领并删除
+        photo.thumbnail.delete(save=False)
+        return None
+    # 列表中的缩略图和状态变了
+    bump_items_version()
+    index_photo(photo.id, photo.image.name, descriptors)
+    return descriptors
+
+
+def run_photo(photo):
+    from django.conf import settings
+    try:
+        process_photo(photo)
+    except Exception as e:
+        max_attempts = getattr(settings, 'FIND_FEATURE_MAX_ATTEMPTS', 3)
+        logger.warning('[特征提取] 图片(ID:%s)第 %d/%d 次处理失败: %s', photo.id, photo.attempts, max_attempts, e)
+        if photo.attempts >= max_attempts:
+            status, next_attempt_at = PhotoLost.FAILED, None
+        else:
+            # 指数退避后重试
+            delay = getattr(settings, 'FIND_FEATURE_RETRY_SECONDS', 30) * 2 ** (photo.attempts - 1)
+            status, next_attempt_at = PhotoLost.PENDING, timezone.now() + timedelta(seconds=delay)
+        PhotoLost.objects.filter(pk=photo.pk).update(status=status, next_attempt_at=next_attempt_at,
+                                                     last_error=str(e)[:255])
+        bump_items_version()
+
+
+def feature_workers(workers):
+    from django.conf import settings
+    lease = getattr(settings, 'FIND_FEATURE_JOB_TIMEOUT', 300)
+    max_attempts = getattr(settings, 'FIND_FEATURE_MAX_ATTEMPTS', 3)
+    return QueueWorkers('特征提取', lambda: claim_next_photo(lease, max_attempts), run_photo, workers,
+                        getattr(settings, 'FIND_FEATURE_POLL_SECONDS', 1.0))
+
+
+_workers = None
+_workers_lock = threading.Lock()
+
+
+def get_feature_workers():
+    """This process's feature worker threads (started on first use), sized by FIND_FEATURE_WORKERS
+    """
+    global _workers
+    with _workers_lock:
+        if _workers is None:
+            from django.conf import settings
+            _workers = feature_workers(getattr(settings, 'FIND_FEATURE_WORKERS', 1))
+        return _workers.start()
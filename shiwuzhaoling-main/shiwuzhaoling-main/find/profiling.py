@@ -0,0 +1,84 @@
+"""Opt-in cProfile dumps of sampled or explicitly requested requests (summarize with manage.py summarize_profiles)"""
+import cProfile
+import hmac
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+from django.core.exceptions import MiddlewareNotUsed
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'HTTP_X_FIND_PROFILE'
+
+
+def profile_filename(request, elapsed):
+    # 文件名带上时间、接口和耗时，按名字即可挑出慢请求
+    endpoint = re.sub(r'[^A-Za-z0-9]+', '-', request.path).strip('-') or 'root'
+    stamp = time.strftime('%Y%m%dT%H%M%S')
+    return f'{stamp}-{request.method}-{endpoint}-{int(elapsed * 1000)}ms-{os.getpid()}.prof'
+
+
+def prune_profiles(directory, keep):
+    dumps = sorted((entry for entry in os.scandir(directory) if entry.name.endswith('.prof')),
+                   key=lambda entry: entry.stat().st_mtime)
+    for entry in dumps[:max(0, len(dumps) - keep)]:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+class ProfilingMiddleware:
+    """Run a request's view under cProfile and write the stats to FIND_PROFILE_DIR
+
+    A request is profiled when it carries `X-Find-Profile: <FIND_PROFILE_TOKEN>` or is picked by
+    FIND_PROFILE_SAMPLE_RATE; with neither configured Django drops the middleware at startup.
+    Only one request per process is profiled at a time (the profiler hook is process-wide),
+    others run normally, and work handed to compare job threads is not included.
+    """
+
+    def __init__(self, get_response):
+        from django.conf import settings
+        self.get_response = get_response
+        self.token = getattr(settings, 'FIND_PROFILE_TOKEN', None)
+        self.sample_rate = getattr(settings, 'FIND_PROFILE_SAMPLE_RATE', 0)
+        self.directory = getattr(settings, 'FIND_PROFILE_DIR', None)
+        self.min_seconds = getattr(settings, 'FIND_PROFILE_MIN_SECONDS', 0)
+        self.keep = getattr(settings, 'FIND_PROFILE_KEEP', 200)
+        if not self.directory or not (self.token or self.sample_rate):
+            raise MiddlewareNotUsed
+        self._lock = threading.Lock()
+
+    def wants_profile(self, request):
+        header = request.META.get(PROFILE_HEADER)
+        if header and self.token:
+            return hmac.compare_digest(header.encode(), str(self.token).encode())
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def __call__(self, request):
+        if not self.wants_profile(request) or not self._lock.acquire(blocking=False):
+            return self.get_response(request)
+        try:
+            profiler = cProfile.Profile()
+            start = time.perf_counter()
+            response = profiler.runcall(self.get_response, request)
+            elapsed = time.perf_counter() - start
+        finally:
+            self._lock.release()
+        if elapsed >= self.min_seconds:
+            self.save(profiler, request, elapsed)
+        return response
+
+    def save(self, profiler, request, elapsed):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(str(self.directory), profile_filename(request, elapsed))
+            profiler.dump_stats(path)
+            prune_profiles(self.directory, self.keep)
+            logger.info('[性能分析] %s %s 耗时 %.3fs，已写入 %s', request.method, request.path, elapsed, path)
+        except OSError as e:
+            logger.warning('[性能分析] 写入失败: %s', e)
@@ -1,4 +1,4 @@
-from numpy import all, any, array, arctan2, cos, sin, exp, dot, log, logical_and, roll, sqrt, stack, trace, unravel_index, pi, deg2rad, rad2deg, where, zeros, floor, full, nan, isnan, round, float32
+from numpy import all, any, arange, argsort, array, bincount, concatenate, dtype, int32, lexsort, maximum, minimum, nonzero, repeat, tile, unique, arctan2, cos, sin, exp, dot, log, logical_and, roll, sqrt, stack, trace, unravel_index, pi, deg2rad, rad2deg, where, zeros, floor, full, nan, isnan, round, float32
 from numpy.linalg import det, lstsq, norm
 import cv2
 from functools import cmp_to_key
@@ -7,6 +7,9 @@ import logging
 logger = logging.getLogger(__name__)
 float_tolerance = 1e-7
 
+# Keypoints travel through the pipeline as one structured array (same fields and float32 precision as cv2.KeyPoint)
+KEYPOINT_DTYPE = dtype([('x', float32), ('y', float32), ('size', float32), ('angle', float32), ('response', float32), ('octave', int32), ('class_id', int32)])
+
 def computeKeypointsAndDescriptors(image, sigma=1.6, num_intervals=3, assumed_blur=0.5, image_border_width=5):
     """计算输入图像的SIFT关键点和描述符"""
     image = image.astype('float32')
@@ -19,7 +22,17 @@ def computeKeypointsAndDescriptors(image, sigma=1.6, num_intervals=3, assumed_bl
     keypoints = removeDuplicateKeypoints(keypoints)
     keypoints = convertKeypointsToInputImageSize(keypoints)
     descriptors = generateDescriptors(keypoints, gaussian_images)
-    return keypoints, descriptors
+    return arrayToKeypoints(keypoints), descriptors
+
+def keypointsToArray(keypoints):
+    """Convert a list of cv2.KeyPoint into a KEYPOINT_DTYPE array
+    """
+    return array([(keypoint.pt[0], keypoint.pt[1], keypoint.size, keypoint.angle, keypoint.response, keypoint.octave, keypoint.class_id) for keypoint in keypoints], dtype=KEYPOINT_DTYPE)
+
+def arrayToKeypoints(keypoints):
+    """Convert a KEYPOINT_DTYPE array into a list of cv2.KeyPoint
+    """
+    return [cv2.KeyPoint(*fields) for fields in zip(*(keypoints[name].tolist() for name in KEYPOINT_DTYPE.names))]
 
 #########################
 # Image pyramid related #
@@ -94,6 +107,63 @@ def findScaleSpaceExtrema(gaussian_images, dog_images, num_intervals, sigma, ima
     threshold = floor(0.5 * contrast_threshold / num_intervals * 255)  # from OpenCV implementation
     keypoints = []
 
+    for octave_index, dog_images_in_octave in enumerate(dog_images):
+        records = []
+        localized_image_indices = []
+        for image_index, (first_image, second_image, third_image) in enumerate(zip(dog_images_in_octave, dog_images_in_octave[1:], dog_images_in_octave[2:])):
+            # candidates come back in row-major order, i.e. the order of the pixel-by-pixel scan
+            for i, j in findExtremumCandidates(first_image, second_image, third_image, threshold, image_border_width):
+                localization_result = localizeExtremumViaQuadraticFit(int(i), int(j), image_index + 1, octave_index, num_intervals, dog_images_in_octave, sigma, contrast_threshold, image_border_width)
+                if localization_result is not None:
+                    record, localized_image_index = localization_result
+                    records.append(record)
+                    localized_image_indices.append(localized_image_index)
+        localized_keypoints = array(records, dtype=KEYPOINT_DTYPE)
+        localized_image_indices = array(localized_image_indices, dtype=int)
+
+        # orientations are assigned one Gaussian layer at a time, then put back in detection order
+        oriented_parts, source_parts = [], []
+        for localized_image_index in unique(localized_image_indices):
+            positions = nonzero(localized_image_indices == localized_image_index)[0]
+            oriented, source = computeOrientationsForKeypoints(localized_keypoints[positions], octave_index, gaussian_images[octave_index][localized_image_index])
+            oriented_parts.append(oriented)
+            source_parts.append(positions[source])
+        if oriented_parts:
+            keypoints.append(concatenate(oriented_parts)[argsort(concatenate(source_parts), kind='stable')])
+    return concatenate(keypoints) if keypoints else zeros(0, dtype=KEYPOINT_DTYPE)
+
+def findExtremumCandidates(first_image, second_image, third_image, threshold, image_border_width):
+    """Return (row, col) of every pixel that isPixelAnExtremum would accept, testing whole layers at once
+    """
+    height, width = second_image.shape
+    # max / min over the 3x3 neighbourhood of each pixel, computed for all three layers at once
+    cube = stack([first_image, second_image, third_image])
+    neighbourhood_max = cube[:, 1:-1, 1:-1].copy()
+    neighbourhood_min = cube[:, 1:-1, 1:-1].copy()
+    for di in (0, 1, 2):
+        for dj in (0, 1, 2):
+            shifted = cube[:, di:height - 2 + di, dj:width - 2 + dj]
+            maximum(neighbourhood_max, shifted, out=neighbourhood_max)
+            minimum(neighbourhood_min, shifted, out=neighbourhood_min)
+    neighbourhood_max = neighbourhood_max.max(axis=0)
+    neighbourhood_min = neighbourhood_min.min(axis=0)
+
+    # the center takes part in its own max / min, so >= / <= matches the reference comparison
+    center = second_image[1:-1, 1:-1]
+    is_extremum = ((center > threshold) & (center >= neighbourhood_max)) | \
+                  ((center < -threshold) & (center <= neighbourhood_min))
+    border = image_border_width - 1
+    mask = zeros(is_extremum.shape, dtype=bool)
+    mask[border:height - 1 - image_border_width, border:width - 1 - image_border_width] = True
+    rows, cols = nonzero(is_extremum & mask)
+    return list(zip(rows + 1, cols + 1))
+
+def findScaleSpaceExtremaReference(gaussian_images, dog_images, num_intervals, sigma, image_border_width, contrast_threshold=0.04):
+    """Pixel-by-pixel version of findScaleSpaceExtrema, kept as the reference the vectorized detector is tested against
+    """
+    threshold = floor(0.5 * contrast_threshold / num_intervals * 255)
+    keypoints = []
+
     for octave_index, dog_images_in_octave in enumerate(dog_images):
         for image_index, (first_image, second_image, third_image) in enumerate(zip(dog_images_in_octave, dog_images_in_octave[1:], dog_images_in_octave[2:])):
             # (i, j) is the center of the 3x3 array
@@ -102,8 +172,9 @@ def findScaleSpaceExtrema(gaussian_images, dog_images, num_intervals, sigma, ima
                     if isPixelAnExtremum(first_image[i-1:i+2, j-1:j+2], second_image[i-1:i+2, j-1:j+2], third_image[i-1:i+2, j-1:j+2], threshold):
                         localization_result = localizeExtremumViaQuadraticFit(i, j, image_index + 1, octave_index, num_intervals, dog_images_in_octave, sigma, contrast_threshold, image_border_width)
                         if localization_result is not None:
-                            cv2.keypoint, localized_image_index = localization_result
-                            keypoints_with_orientations = computeKeypointsWithOrientations(cv2.keypoint, octave_index, gaussian_images[octave_index][localized_image_index])
+                            record, localized_image_index = localization_result
+                            keypoint = cv2.KeyPoint(*record)
+                            keypoints_with_orientations = computeKeypointsWithOrientations(keypoint, octave_index, gaussian_images[octave_index][localized_image_index])
                             for keypoint_with_orientation in keypoints_with_orientations:
                                 keypoints.append(keypoint_with_orientation)
     return keypoints
@@ -165,13 +236,13 @@ def localizeExtremumViaQuadraticFit(i, j, image_index, octave_index, num_interva
         xy_hessian_trace = trace(xy_hessian)
         xy_hessian_det = det(xy_hessian)
         if xy_hessian_det > 0 and eigenvalue_ratio * (xy_hessian_trace ** 2) < ((eigenvalue_ratio + 1) ** 2) * xy_hessian_det:
-            # Contrast check passed -- construct and return OpenCV KeyPoint object
-            keypoint = cv2.KeyPoint()
-            keypoint.pt = ((j + extremum_update[0]) * (2 ** octave_index), (i + extremum_update[1]) * (2 ** octave_index))
-            keypoint.octave = octave_index + image_index * (2 ** 8) + int(round((extremum_update[2] + 0.5) * 255)) * (2 ** 16)
-            keypoint.size = sigma * (2 ** ((image_index + extremum_update[2]) / float32(num_intervals))) * (2 ** (octave_index + 1))  # octave_index + 1 because the input image was doubled
-            keypoint.response = abs(functionValueAtUpdatedExtremum)
-            return keypoint, image_index
+            # Contrast check passed -- return a keypoint record in KEYPOINT_DTYPE field order (angle and class_id default to -1 like cv2.KeyPoint)
+            x = (j + extremum_update[0]) * (2 ** octave_index)
+            y = (i + extremum_update[1]) * (2 ** octave_index)
+            octave = octave_index + image_index * (2 ** 8) + int(round((extremum_update[2] + 0.5) * 255)) * (2 ** 16)
+            size = sigma * (2 ** ((image_index + extremum_update[2]) / float32(num_intervals))) * (2 ** (octave_index + 1))  # octave_index + 1 because the input image was doubled
+            response = abs(functionValueAtUpdatedExtremum)
+            return (x, y, size, -1, response, octave, -1), image_index
     return None
 
 def computeGradientAtCenterPixel(pixel_array):
@@ -209,9 +280,8 @@ def computeHessianAtCenterPixel(pixel_array):
 #########################
 
 def computeKeypointsWithOrientations(keypoint, octave_index, gaussian_image, radius_factor=3, num_bins=36, peak_ratio=0.8, scale_factor=1.5):
-    """Compute orientations for each keypoint
+    """Compute orientations for each keypoint (single-keypoint reference for computeOrientationsForKeypoints)
     """
-    logger.debug('Computing keypoint orientations...')
     keypoints_with_orientations = []
     image_shape = gaussian_image.shape
 
@@ -254,6 +324,70 @@ def computeKeypointsWithOrientations(keypoint, octave_index, gaussian_image, rad
             keypoints_with_orientations.append(new_keypoint)
     return keypoints_with_orientations
 
+def computeGradientLayer(gaussian_image, num_bins):
+    """Gradient magnitude and orientation-histogram bin of every interior pixel of a Gaussian image
+    """
+    dx = gaussian_image[1:-1, 2:] - gaussian_image[1:-1, :-2]
+    dy = gaussian_image[:-2, 1:-1] - gaussian_image[2:, 1:-1]
+    gradient_magnitude = sqrt(dx * dx + dy * dy)
+    gradient_orientation = rad2deg(arctan2(dy, dx))
+    histogram_index = round(gradient_orientation * num_bins / 360.).astype(int) % num_bins
+    return gradient_magnitude, histogram_index
+
+def computeOrientationsForKeypoints(keypoints, octave_index, gaussian_image, radius_factor=3, num_bins=36, peak_ratio=0.8, scale_factor=1.5):
+    """Compute orientations for many keypoints of the same Gaussian image at once
+
+    Takes a KEYPOINT_DTYPE array and returns the oriented keypoints plus, for each of them, the index
+    of the input keypoint it came from; per input keypoint these equal what computeKeypointsWithOrientations produces.
+    """
+    logger.debug('Computing keypoint orientations...')
+    if len(keypoints) == 0:
+        return keypoints.copy(), zeros(0, dtype=int)
+    image_shape = gaussian_image.shape
+    gradient_magnitude, histogram_index = computeGradientLayer(gaussian_image, num_bins)
+
+    # per-keypoint parameters use exactly the scalar arithmetic of computeKeypointsWithOrientations
+    centers, radii, weight_factors = [], [], []
+    for x, y, size in zip(keypoints['x'].tolist(), keypoints['y'].tolist(), keypoints['size'].tolist()):
+        scale = scale_factor * size / float32(2 ** (octave_index + 1))
+        radii.append(int(round(radius_factor * scale)))
+        weight_factors.append(-0.5 / (scale ** 2))
+        centers.append((int(round(y / float32(2 ** octave_index))), int(round(x / float32(2 ** octave_index)))))
+    centers, radii, weight_factors = array(centers), array(radii), array(weight_factors)
+
+    max_radius = radii.max()
+    offsets = arange(-max_radius, max_radius + 1)
+    rows = repeat(offsets, len(offsets))[None, :]
+    cols = tile(offsets, len(offsets))[None, :]
+    region_y = centers[:, 0:1] + rows
+    region_x = centers[:, 1:2] + cols
+    valid = (abs(rows) <= radii[:, None]) & (abs(cols) <= radii[:, None]) & \
+            (region_y > 0) & (region_y < image_shape[0] - 1) & (region_x > 0) & (region_x < image_shape[1] - 1)
+    weights = exp(weight_factors[:, None] * (rows ** 2 + cols ** 2).astype(weight_factors.dtype))
+
+    sample_keypoint = nonzero(valid)[0]
+    sample_y, sample_x = region_y[valid] - 1, region_x[valid] - 1
+    contributions = weights[valid] * gradient_magnitude[sample_y, sample_x]
+    raw_histogram = bincount(sample_keypoint * num_bins + histogram_index[sample_y, sample_x], weights=contributions, minlength=len(keypoints) * num_bins).reshape(len(keypoints), num_bins)
+
+    smooth_histogram = (6 * raw_histogram + 4 * (roll(raw_histogram, 1, axis=1) + roll(raw_histogram, -1, axis=1)) + roll(raw_histogram, 2, axis=1) + roll(raw_histogram, -2, axis=1)) / 16.
+    left_values = roll(smooth_histogram, 1, axis=1)
+    right_values = roll(smooth_histogram, -1, axis=1)
+    is_peak = (smooth_histogram > left_values) & (smooth_histogram > right_values) & \
+              (smooth_histogram >= peak_ratio * smooth_histogram.max(axis=1, keepdims=True))
+    peak_keypoints, peak_indices = nonzero(is_peak)
+    peak_values = smooth_histogram[peak_keypoints, peak_indices]
+    left_values, right_values = left_values[peak_keypoints, peak_indices], right_values[peak_keypoints, peak_indices]
+    # Quadratic peak interpolation, see computeKeypointsWithOrientations
+    interpolated_peak_indices = (peak_indices + 0.5 * (left_values - right_values) / (left_values - 2 * peak_values + right_values)) % num_bins
+    orientations = 360. - interpolated_peak_indices * 360. / num_bins
+    orientations[abs(orientations - 360.) < float_tolerance] = 0
+
+    keypoints_with_orientations = keypoints[peak_keypoints]
+    keypoints_with_orientations['angle'] = orientations
+    keypoints_with_orientations['class_id'] = -1
+    return keypoints_with_orientations, peak_keypoints
+
 ##############################
 # Duplicate keypoint removal #
 ##############################
@@ -277,6 +411,20 @@ def compareKeypoints(keypoint1, keypoint2):
 
 def removeDuplicateKeypoints(keypoints):
     """Sort keypoints and remove duplicate keypoints
+
+    Sorts with the ordering of compareKeypoints (lexsort takes its primary key last) and keeps a
+    keypoint only if it differs from its predecessor in position, size or angle.
+    """
+    if len(keypoints) < 2:
+        return keypoints
+
+    keypoints = keypoints[lexsort((-keypoints['class_id'], -keypoints['octave'], -keypoints['response'], keypoints['angle'], -keypoints['size'], keypoints['y'], keypoints['x']))]
+    is_new = (keypoints['x'][1:] != keypoints['x'][:-1]) | (keypoints['y'][1:] != keypoints['y'][:-1]) | \
+             (keypoints['size'][1:] != keypoints['size'][:-1]) | (keypoints['angle'][1:] != keypoints['angle'][:-1])
+    return keypoints[concatenate(([True], is_new))]
+
+def removeDuplicateKeypointsReference(keypoints):
+    """cv2.KeyPoint version of removeDuplicateKeypoints, kept as the reference it is tested against
     """
     if len(keypoints) < 2:
         return keypoints
@@ -298,38 +446,148 @@ def removeDuplicateKeypoints(keypoints):
 #############################
 
 def convertKeypointsToInputImageSize(keypoints):
-    """Convert keypoint point, size, and octave to input image size
+    """Convert keypoint point, size, and octave to input image size (in place)
     """
-    converted_keypoints = []
-    for keypoint in keypoints:
-        keypoint.pt = tuple(0.5 * array(keypoint.pt))
-        keypoint.size *= 0.5
-        keypoint.octave = (keypoint.octave & ~255) | ((keypoint.octave - 1) & 255)
-        converted_keypoints.append(keypoint)
-    return converted_keypoints
+    keypoints['x'] *= 0.5
+    keypoints['y'] *= 0.5
+    keypoints['size'] *= 0.5
+    keypoints['octave'] = (keypoints['octave'] & ~255) | ((keypoints['octave'] - 1) & 255)
+    return keypoints
 
 #########################
 # Descriptor generation #
 #########################
 
-def unpackOctave(keypoint):
-    """Compute octave, layer, and scale from a keypoint
+def unpackOctave(packed_octave):
+    """Compute octave, layer, and scale from a keypoint's packed octave value
     """
-    octave = keypoint.octave & 255
-    layer = (keypoint.octave >> 8) & 255
+    octave = packed_octave & 255
+    layer = (packed_octave >> 8) & 255
     if octave >= 128:
         octave = octave | -128
     scale = 1 / float32(1 << octave) if octave >= 0 else float32(1 << -octave)
     return octave, layer, scale
 
-def generateDescriptors(keypoints, gaussian_images, window_width=4, num_bins=8, scale_multiplier=3, descriptor_max_value=0.2):
+def generateDescriptors(keypoints, gaussian_images, window_width=4, num_bins=8, scale_multiplier=3, descriptor_max_value=0.2, max_batch_samples=1 << 22):
     """Generate descriptors for each keypoint
+
+    Keypoints are grouped by the Gaussian image they were found in; the sample windows of a whole
+    group are gathered as arrays and the histograms are accumulated with a single weighted bincount.
     """
     logger.debug('Generating descriptors...')
+    descriptors = zeros((len(keypoints), window_width * window_width * num_bins), dtype='float32')
+
+    groups = {}
+    for keypoint_index, packed_octave in enumerate(keypoints['octave'].tolist()):
+        octave, layer, scale = unpackOctave(packed_octave)
+        groups.setdefault((octave, layer, scale), []).append(keypoint_index)
+
+    for (octave, layer, scale), keypoint_indices in groups.items():
+        gaussian_image = gaussian_images[octave + 1, layer]
+        num_rows, num_cols = gaussian_image.shape
+        # per-keypoint parameters use exactly the scalar arithmetic of the reference implementation
+        points, angles, hist_widths, half_widths = [], [], [], []
+        group = keypoints[keypoint_indices]
+        for x, y, size, angle in zip(group['x'].tolist(), group['y'].tolist(), group['size'].tolist(), group['angle'].tolist()):
+            points.append(round(scale * array((x, y))).astype('int'))
+            angles.append(360. - angle)
+            hist_width = scale_multiplier * 0.5 * scale * size
+            half_width = int(round(hist_width * sqrt(2) * (window_width + 1) * 0.5))
+            hist_widths.append(hist_width)
+            half_widths.append(int(min(half_width, sqrt(num_rows ** 2 + num_cols ** 2))))
+        points, angles = array(points), array(angles, dtype='float64')
+        hist_widths, half_widths = array(hist_widths, dtype='float64'), array(half_widths)
+
+        # keypoints with similar windows share a padded sample grid; batches are capped at max_batch_samples
+        order = argsort(half_widths, kind='stable')
+        start = 0
+        while start < len(order):
+            end = start + 1
+            while end < len(order) and (end + 1 - start) * (2 * half_widths[order[end]] + 1) ** 2 <= max_batch_samples:
+                end += 1
+            batch = order[start:end]
+            histograms = accumulateDescriptorHistograms(gaussian_image, points[batch], angles[batch], hist_widths[batch], half_widths[batch], window_width, num_bins)
+            descriptors[array(keypoint_indices)[batch]] = normalizeDescriptorVectors(histograms[:, 1:-1, 1:-1, :].reshape(len(batch), -1), descriptor_max_value)
+            start = end
+    return descriptors
+
+def accumulateDescriptorHistograms(gaussian_image, points, angles, hist_widths, half_widths, window_width, num_bins):
+    """Return the (num_keypoints, window_width + 2, window_width + 2, num_bins) histogram tensors of a batch of keypoints
+    """
+    num_rows, num_cols = gaussian_image.shape
+    num_keypoints = len(points)
+    max_half_width = half_widths.max()
+    offsets = arange(-max_half_width, max_half_width + 1)
+    # row-major sample grid, the same visiting order as the reference double loop
+    rows = repeat(offsets, len(offsets))[None, :]
+    cols = tile(offsets, len(offsets))[None, :]
+    bins_per_degree = num_bins / 360.
+    cos_angles = cos(deg2rad(angles))[:, None]
+    sin_angles = sin(deg2rad(angles))[:, None]
+    hist_widths = hist_widths[:, None]
+    weight_multiplier = -0.5 / ((0.5 * window_width) ** 2)
+
+    row_rot = cols * sin_angles + rows * cos_angles
+    col_rot = cols * cos_angles - rows * sin_angles
+    row_bin = (row_rot / hist_widths) + 0.5 * window_width - 0.5
+    col_bin = (col_rot / hist_widths) + 0.5 * window_width - 0.5
+    window_row = points[:, 1:2] + rows
+    window_col = points[:, 0:1] + cols
+    valid = (abs(rows) <= half_widths[:, None]) & (abs(cols) <= half_widths[:, None]) & \
+            (row_bin > -1) & (row_bin < window_width) & (col_bin > -1) & (col_bin < window_width) & \
+            (window_row > 0) & (window_row < num_rows - 1) & (window_col > 0) & (window_col < num_cols - 1)
+
+    sample_keypoint = nonzero(valid)[0]
+    row_rot, col_rot, row_bin, col_bin = row_rot[valid], col_rot[valid], row_bin[valid], col_bin[valid]
+    window_row, window_col = window_row[valid], window_col[valid]
+    dx = gaussian_image[window_row, window_col + 1] - gaussian_image[window_row, window_col - 1]
+    dy = gaussian_image[window_row - 1, window_col] - gaussian_image[window_row + 1, window_col]
+    gradient_magnitude = sqrt(dx * dx + dy * dy)
+    gradient_orientation = rad2deg(arctan2(dy, dx)) % 360
+    weight = exp(weight_multiplier * ((row_rot / hist_widths[sample_keypoint, 0]) ** 2 + (col_rot / hist_widths[sample_keypoint, 0]) ** 2))
+    magnitude = weight * gradient_magnitude
+    orientation_bin = (gradient_orientation - angles[sample_keypoint]) * bins_per_degree
+
+    # Smoothing via trilinear interpolation, see generateDescriptorsReference
+    row_bin_floor, col_bin_floor, orientation_bin_floor = floor(row_bin).astype(int), floor(col_bin).astype(int), floor(orientation_bin).astype(int)
+    row_fraction, col_fraction, orientation_fraction = row_bin - row_bin_floor, col_bin - col_bin_floor, orientation_bin - orientation_bin_floor
+    orientation_bin_floor[orientation_bin_floor < 0] += num_bins
+    orientation_bin_floor[orientation_bin_floor >= num_bins] -= num_bins
+
+    c1 = magnitude * row_fraction
+    c0 = magnitude * (1 - row_fraction)
+    c11 = c1 * col_fraction
+    c10 = c1 * (1 - col_fraction)
+    c01 = c0 * col_fraction
+    c00 = c0 * (1 - col_fraction)
+
+    side = window_width + 2
+    flat_indices, flat_weights = [], []
+    for row_offset, col_offset, corner in ((1, 1, c00), (1, 2, c01), (2, 1, c10), (2, 2, c11)):
+        base_index = ((sample_keypoint * side + row_bin_floor + row_offset) * side + col_bin_floor + col_offset) * num_bins
+        flat_indices += [base_index + orientation_bin_floor, base_index + (orientation_bin_floor + 1) % num_bins]
+        flat_weights += [corner * (1 - orientation_fraction), corner * orientation_fraction]
+    histograms = bincount(concatenate(flat_indices), weights=concatenate(flat_weights), minlength=num_keypoints * side * side * num_bins)
+    return histograms.reshape(num_keypoints, side, side, num_bins)
+
+def normalizeDescriptorVectors(descriptor_vectors, descriptor_max_value):
+    """Threshold, normalize and saturate a batch of raw descriptor vectors (OpenCV convention)
+    """
+    threshold = norm(descriptor_vectors, axis=1, keepdims=True) * descriptor_max_value
+    descriptor_vectors = minimum(descriptor_vectors, threshold)
+    descriptor_vectors /= maximum(norm(descriptor_vectors, axis=1, keepdims=True), float_tolerance)
+    descriptor_vectors = round(512 * descriptor_vectors)
+    descriptor_vectors[descriptor_vectors < 0] = 0
+    descriptor_vectors[descriptor_vectors > 255] = 255
+    return descriptor_vectors
+
+def generateDescriptorsReference(keypoints, gaussian_images, window_width=4, num_bins=8, scale_multiplier=3, descriptor_max_value=0.2):
+    """Keypoint-by-keypoint version of generateDescriptors, kept as the reference the batched implementation is tested against
+    """
     descriptors = []
 
     for keypoint in keypoints:
-        octave, layer, scale = unpackOctave(keypoint)
+        octave, layer, scale = unpackOctave(keypoint.octave)
         gaussian_image = gaussian_images[octave + 1, layer]
         num_rows, num_cols = gaussian_image.shape
         point = round(scale * array(keypoint.pt)).astype('int')
@@ -1 +1,565 @@
-from django.test import TestCase
+import contextlib
+import os
+import tempfile
+from datetime import timedelta
+from unittest import mock
+
+import cv2
+import numpy as np
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from . import descriptor_index, jobs, matching, metrics, pipeline, sift_utils, views
+from .arena import DescriptorArena, reset_descriptor_arenas
+from .cache import ImageCache
+from .descriptor_index import DescriptorIndex
+from .list_cache import bump_items_version
+from .models import CompareJob, PhotoLost, User, UserToken
+from .tokens import TokenCache, get_token_cache, invalidate_token, lookup_user
+from .profiling import ProfilingMiddleware
+from .matching import cascade_best_match, dense_best_match, dense_scores, score_candidates_batch
+
+
+def make_test_image(size=96, seed=0):
+    rng = np.random.default_rng(seed)
+    image = np.zeros((size, size), dtype=np.uint8)
+    for _ in range(12):
+        center = tuple(int(v) for v in rng.integers(8, size - 8, 2))
+        cv2.circle(image, center, int(rng.integers(2, 8)), int(rng.integers(60, 255)), -1)
+    return cv2.GaussianBlur(image, (0, 0), 1.0).astype('float32')
+
+
+def build_pyramid(image, sigma=1.6, num_intervals=3, assumed_blur=0.5):
+    base_image = sift_utils.generateBaseImage(image, sigma, assumed_blur)
+    num_octaves = sift_utils.computeNumberOfOctaves(base_image.shape)
+    gaussian_kernels = sift_utils.generateGaussianKernels(sigma, num_intervals)
+    gaussian_images = sift_utils.generateGaussianImages(base_image, num_octaves, gaussian_kernels)
+    return gaussian_images, sift_utils.generateDoGImages(gaussian_images)
+
+
+class ScaleSpaceExtremaTests(SimpleTestCase):
+    def test_vectorized_detector_matches_reference(self):
+        gaussian_images, dog_images = build_pyramid(make_test_image())
+
+        expected = sift_utils.findScaleSpaceExtremaReference(gaussian_images, dog_images, 3, 1.6, 5)
+        actual = sift_utils.arrayToKeypoints(sift_utils.findScaleSpaceExtrema(gaussian_images, dog_images, 3, 1.6, 5))
+
+        self.assertGreater(len(expected), 0)
+        self.assertEqual(len(actual), len(expected))
+        for keypoint, reference in zip(actual, expected):
+            np.testing.assert_allclose(keypoint.pt, reference.pt, atol=1e-4)
+            self.assertAlmostEqual(keypoint.size, reference.size, places=4)
+            self.assertAlmostEqual(keypoint.angle, reference.angle, places=3)
+            self.assertAlmostEqual(keypoint.response, reference.response, places=6)
+            self.assertEqual(keypoint.octave, reference.octave)
+
+
+class DescriptorGenerationTests(SimpleTestCase):
+    def test_batched_descriptors_match_reference(self):
+        gaussian_images, dog_images = build_pyramid(make_test_image())
+        keypoints = sift_utils.findScaleSpaceExtrema(gaussian_images, dog_images, 3, 1.6, 5)
+        keypoints = sift_utils.convertKeypointsToInputImageSize(sift_utils.removeDuplicateKeypoints(keypoints))
+
+        expected = sift_utils.generateDescriptorsReference(sift_utils.arrayToKeypoints(keypoints), gaussian_images)
+        # a tiny batch budget forces every keypoint into its own batch
+        for max_batch_samples in (1 << 22, 1):
+            actual = sift_utils.generateDescriptors(keypoints, gaussian_images, max_batch_samples=max_batch_samples)
+            self.assertEqual(actual.shape, expected.shape)
+            np.testing.assert_array_equal(actual, expected)
+
+
+class KeypointArrayTests(SimpleTestCase):
+    def test_lexsort_dedup_matches_reference(self):
+        gaussian_images, dog_images = build_pyramid(make_test_image())
+        keypoints = sift_utils.findScaleSpaceExtrema(gaussian_images, dog_images, 3, 1.6, 5)
+        # duplicate every keypoint so there is something to remove
+        keypoints = np.concatenate([keypoints, keypoints[::-1]])
+
+        expected = sift_utils.removeDuplicateKeypointsReference(sift_utils.arrayToKeypoints(keypoints))
+        actual = sift_utils.removeDuplicateKeypoints(keypoints)
+
+        self.assertEqual(len(actual), len(expected))
+        np.testing.assert_array_equal(actual, sift_utils.keypointsToArray(expected))
+
+    def test_keypoint_conversion_round_trip(self):
+        keypoints = [cv2.KeyPoint(1.5, 2.25, 3.0, 45.0, 0.01, 0x10203, 7), cv2.KeyPoint(4.0, 5.0, 6.0)]
+
+        converted = sift_utils.arrayToKeypoints(sift_utils.keypointsToArray(keypoints))
+
+        for keypoint, original in zip(converted, keypoints):
+            self.assertEqual((keypoint.pt, keypoint.size, keypoint.angle, keypoint.response, keypoint.octave, keypoint.class_id),
+                             (original.pt, original.size, original.angle, original.response, original.octave, original.class_id))
+
+
+class DenseMatcherTests(SimpleTestCase):
+    def assert_same_scores(self, queries, candidates, norm):
+        expected = score_candidates_batch(queries, candidates, norm)
+        actual = dense_scores(queries, candidates, norm)
+        self.assertEqual(actual, expected)
+
+    def test_l2_scores_match_bfmatcher(self):
+        rng = np.random.default_rng(0)
+        # small value range so nearest neighbours tie now and then; one single-row candidate has no second neighbour
+        candidates = [(i, f'{i}.jpg', rng.integers(0, 8, (n, 128)).astype(np.float32))
+                      for i, n in enumerate([40, 1, 25, 60, 3])]
+        queries = [rng.integers(0, 8, (n, 128)).astype(np.float32) for n in (30, 12)]
+        self.assert_same_scores(queries, candidates, cv2.NORM_L2)
+        # one candidate per block
+        with mock.patch.object(matching, 'DENSE_BLOCK_ELEMENTS', 1):
+            self.assert_same_scores(queries, candidates, cv2.NORM_L2)
+        self.assert_same_scores([query.astype(np.uint8) for query in queries],
+                                [(i, image, d.astype(np.uint8)) for i, image, d in candidates], cv2.NORM_L2)
+
+    def test_hamming_scores_match_bfmatcher(self):
+        rng = np.random.default_rng(1)
+        candidates = [(i, f'{i}.jpg', rng.integers(0, 256, (n, 32), dtype=np.uint8)) for i, n in enumerate([50, 20, 2])]
+        queries = [rng.integers(0, 256, (40, 32), dtype=np.uint8)]
+        self.assert_same_scores(queries, candidates, cv2.NORM_HAMMING)
+
+
+class CascadeTests(SimpleTestCase):
+    def test_exact_cascade_matches_full_scan(self):
+        rng = np.random.default_rng(2)
+        candidates = [(i, f'{i}.jpg', rng.integers(0, 64, (80, 128)).astype(np.float32)) for i in range(40)]
+        for target in (3, 17, 38):
+            # a noisy copy of part of one candidate, so scores spread out and most candidates can be pruned
+            query = candidates[target][2][:60] + rng.integers(-2, 3, (60, 128))
+            stats = {}
+            # a tiny block makes pruning kick in after the first few candidates
+            with mock.patch.object(matching, 'CASCADE_BLOCK', 2):
+                result = cascade_best_match(query, candidates, subset_size=8, stats=stats)
+            self.assertEqual(result, dense_best_match(query, candidates))
+            self.assertEqual(result[2], target)
+            self.assertEqual(stats['scanned'] + stats['pruned'] + stats['stopped_early'], len(candidates))
+            self.assertGreater(stats['pruned'], 0)
+
+
+class MetricsTests(SimpleTestCase):
+    def test_histogram_renders_cumulative_buckets(self):
+        histogram = metrics.Histogram('test_seconds', 'Test latency', ['stage'], buckets=(0.1, 1))
+        metrics.REGISTRY.remove(histogram)
+        for value in (0.05, 0.5, 0.5, 3):
+            histogram.observe(value, stage='match')
+        self.assertEqual(histogram.samples(), [
+            'test_seconds_bucket{stage="match",le="0.1"} 1',
+            'test_seconds_bucket{stage="match",le="1"} 3',
+            'test_seconds_bucket{stage="match",le="+Inf"} 4',
+            'test_seconds_sum{stage="match"} 4.05',
+            'test_seconds_count{stage="match"} 4',
+        ])
+
+    def test_nested_traces_join_the_outer_request(self):
+        with metrics.compare_trace('test') as outer:
+            with metrics.compare_trace('test') as inner, metrics.stage('match'):
+                metrics.count('scanned', 3)
+            self.assertIs(inner, outer)
+            metrics.count('scanned', 2)
+        self.assertIsNone(metrics.current_trace())
+        self.assertEqual(dict(outer.counts), {'scanned': 5})
+        self.assertIn('match', outer.stages)
+        self.assertIn('find_compare_seconds_count{endpoint="test",result="unknown"}', metrics.render())
+
+
+class ProfilingMiddlewareTests(SimpleTestCase):
+    def test_disabled_without_token_or_sampling(self):
+        with override_settings(FIND_PROFILE_TOKEN=None, FIND_PROFILE_SAMPLE_RATE=0):
+            with self.assertRaises(MiddlewareNotUsed):
+                ProfilingMiddleware(lambda request: HttpResponse())
+
+    def test_dumps_only_requests_with_the_token(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(FIND_PROFILE_TOKEN='secret', FIND_PROFILE_SAMPLE_RATE=0, FIND_PROFILE_DIR=directory):
+            middleware = ProfilingMiddleware(lambda request: HttpResponse('ok'))
+            factory = RequestFactory()
+            middleware(factory.get('/api/items/', HTTP_X_FIND_PROFILE='wrong'))
+            response = middleware(factory.get('/api/items/', HTTP_X_FIND_PROFILE='secret'))
+            self.assertEqual(response.content, b'ok')
+            dumps = os.listdir(directory)
+            self.assertEqual(len(dumps), 1)
+            self.assertIn('-GET-api-items-', dumps[0])
+
+
+LOCMEM_CACHES = {alias: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': alias}
+                 for alias in ('default', 'find', 'find-state')}
+
+
+class SandboxedTestCase(TestCase):
+    """TestCase whose caches, media files and descriptor arena live in a throwaway directory, not the checkout"""
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        sandbox = override_settings(CACHES=LOCMEM_CACHES, MEDIA_ROOT=os.path.join(directory.name, 'media'),
+                                    FIND_DESCRIPTOR_ARENA_DIR=os.path.join(directory.name, 'arena'))
+        sandbox.enable()
+        self.addCleanup(sandbox.disable)
+        # the arena singleton would otherwise keep the previous test's directory
+        reset_descriptor_arenas()
+        self.addCleanup(reset_descriptor_arenas)
+
+
+class ItemsPaginationTests(SandboxedTestCase):
+    def setUp(self):
+        super().setUp()
+        # several rows share a created_at, so the id tie-break decides the page boundaries
+        now = timezone.now()
+        for i in range(7):
+            photo = PhotoLost.objects.create(image=f'photo_lost/{i}.jpg', phone='13800000000')
+            PhotoLost.objects.filter(pk=photo.pk).update(created_at=now - timedelta(minutes=i // 3))
+        bump_items_version()
+
+    def test_pages_cover_every_item_once_newest_first(self):
+        expected = list(PhotoLost.objects.order_by('-created_at', '-id').values_list('id', flat=True))
+        seen, cursor = [], None
+        while True:
+            params = {'limit': 3, **({'cursor': cursor} if cursor else {})}
+            body = self.client.get('/api/items/', params).json()
+            self.assertLessEqual(len(body['data']), 3)
+            seen.extend(item['id'] for item in body['data'])
+            cursor = body['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(seen, expected)
+
+    def test_rejects_a_malformed_cursor(self):
+        self.assertEqual(self.client.get('/api/items/', {'cursor': 'not-a-cursor'}).status_code, 400)
+
+
+
+class ImageCacheTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.paths = {}
+        for name in 'abc':
+            self.paths[name] = os.path.join(directory.name, f'{name}.jpg')
+            open(self.paths[name], 'wb').close()
+
+    def test_evicts_least_recently_used_within_the_byte_budget(self):
+        cache = ImageCache(250)
+        cache.put(self.paths['a'], 'gray', np.zeros(100, dtype=np.uint8))
+        cache.put(self.paths['b'], 'gray', np.ones(100, dtype=np.uint8))
+        self.assertIsNotNone(cache.get(self.paths['a'], 'gray'))
+        cache.put(self.paths['c'], 'gray', np.zeros(100, dtype=np.uint8))
+
+        self.assertIsNone(cache.get(self.paths['b'], 'gray'))
+        self.assertIsNotNone(cache.get(self.paths['a'], 'gray'))
+        self.assertIsNone(cache.get(self.paths['a'], 'descriptors'))
+        self.assertEqual(cache.stats(), {'entries': 2, 'bytes': 200, 'max_bytes': 250,
+                                         'hits': 2, 'misses': 2, 'evictions': 1})
+
+    def test_an_item_larger_than_the_budget_is_not_cached(self):
+        cache = ImageCache(250)
+        cache.put(self.paths['a'], 'gray', np.zeros(100, dtype=np.uint8))
+        cache.put(self.paths['b'], 'gray', np.zeros(300, dtype=np.uint8))
+        self.assertIsNone(cache.get(self.paths['b'], 'gray'))
+        self.assertIsNotNone(cache.get(self.paths['a'], 'gray'))
+        self.assertEqual((len(cache), cache.size, cache.evictions), (1, 100, 0))
+
+    def test_a_replaced_file_is_not_served_stale(self):
+        cache = ImageCache(1000)
+        path = self.paths['a']
+        cache.put(path, 'gray', np.zeros(100, dtype=np.uint8))
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertIsNone(cache.get(path, 'gray'))
+
+        cache.put(path, 'gray', np.ones(100, dtype=np.uint8))
+        np.testing.assert_array_equal(cache.get(path, 'gray'), np.ones(100, dtype=np.uint8))
+        cache.invalidate(path)
+        self.assertIsNone(cache.get(path, 'gray'))
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+class DescriptorIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+        # 200 rows per photo, so a 500-row buffer freezes three photos into each segment
+        self.float_photos = {photo_id: self.rng.uniform(0, 100, (200, 128)).astype(np.float32) for photo_id in range(1, 7)}
+
+    def float_index(self, photo_ids=range(1, 7)):
+        index = DescriptorIndex(buffer_size=500)
+        for photo_id in photo_ids:
+            index.add(photo_id, self.float_photos[photo_id])
+        return index
+
+    def top_vote(self, index, query):
+        votes = index.search(query)
+        return max(votes, key=votes.get) if votes else None
+
+    def test_noisy_copy_votes_for_its_photo(self):
+        index = self.float_index()
+        query = self.float_photos[4] + self.rng.normal(0, 1, self.float_photos[4].shape).astype(np.float32)
+        self.assertEqual(self.top_vote(index, query), 4)
+
+    def test_noisy_binary_copy_votes_for_its_photo(self):
+        photos = {photo_id: self.rng.integers(0, 256, (200, 32), dtype=np.uint8) for photo_id in range(1, 7)}
+        index = DescriptorIndex(buffer_size=500, binary=True)
+        for photo_id, descriptors in photos.items():
+            index.add(photo_id, descriptors)
+        # flip 8 of the 256 bits of every descriptor
+        bits = np.unpackbits(photos[2], axis=1)
+        for row in bits:
+            row[self.rng.choice(256, 8, replace=False)] ^= 1
+        self.assertEqual(self.top_vote(index, np.packbits(bits, axis=1)), 2)
+
+    def test_removed_id_can_come_back_from_a_segment(self):
+        index = self.float_index(range(1, 4))
+        index.remove(2)
+        self.assertNotIn(2, index)
+        self.assertNotIn(2, index.search(self.float_photos[2]))
+
+        replacement = self.rng.uniform(0, 100, (150, 128)).astype(np.float32)
+        index.add(2, replacement)
+        np.testing.assert_array_equal(index.get_descriptors(2), replacement)
+        self.assertEqual(index.descriptor_count(2), 150)
+        self.assertEqual(self.top_vote(index, replacement), 2)
+        self.assertNotIn(2, index.search(self.float_photos[2]))
+
+    def test_ranking_skips_photos_removed_after_the_search(self):
+        index = self.float_index(range(1, 4))
+        votes = index.search(np.concatenate([self.float_photos[2], self.float_photos[3][:50]]))
+        index.remove(2)
+        self.assertEqual(views.rank_by_votes(index, votes, 250), [3])
+
+    def test_sync_drops_and_loads_ids_without_rebuilding(self):
+        index = self.float_index(range(1, 4))
+        loaded = []
+
+        def load(photo_ids):
+            loaded.extend(photo_ids)
+            return ((photo_id, self.float_photos[photo_id]) for photo_id in photo_ids)
+
+        with mock.patch.object(descriptor_index, '_Segment', side_effect=AssertionError('segment rebuilt')):
+            index.sync({2, 3, 4}, load)
+        self.assertEqual(loaded, [4])
+        self.assertEqual(index.photo_ids(), {2, 3, 4})
+        self.assertEqual(self.top_vote(index, self.float_photos[3]), 3)
+        self.assertNotIn(1, index.search(self.float_photos[1]))
+
+
+class DescriptorArenaTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        rng = np.random.default_rng(0)
+        self.descriptors = {photo_id: rng.integers(0, 256, (5 + photo_id, 32), dtype=np.uint8) for photo_id in range(1, 5)}
+
+    def test_append_and_tombstone(self):
+        arena = DescriptorArena(self.directory)
+        for photo_id in (1, 2):
+            arena.add(photo_id, f'{photo_id}.jpg', self.descriptors[photo_id])
+        np.testing.assert_array_equal(arena.get(2, '2.jpg'), self.descriptors[2])
+        # the same id under another image name is a different photo
+        self.assertIsNone(arena.get(2, 'other.jpg'))
+
+        arena.remove(1)
+        self.assertIsNone(arena.get(1, '1.jpg'))
+        np.testing.assert_array_equal(arena.get(2, '2.jpg'), self.descriptors[2])
+
+    def test_compaction_keeps_live_rows(self):
+        arena = DescriptorArena(self.directory)
+        for photo_id, descriptors in self.descriptors.items():
+            arena.add(photo_id, f'{photo_id}.jpg', descriptors)
+        arena.compact(live_ids={2, 4})
+        self.assertEqual(arena.dead_rows, 0)
+        self.assertEqual(arena.total_rows, len(self.descriptors[2]) + len(self.descriptors[4]))
+        self.assertIsNone(arena.get(1, '1.jpg'))
+        np.testing.assert_array_equal(arena.get(4, '4.jpg'), self.descriptors[4])
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'data-0.bin')))
+
+    def test_second_reader_follows_a_generation_swap(self):
+        writer = DescriptorArena(self.directory)
+        for photo_id in (1, 2, 3):
+            writer.add(photo_id, f'{photo_id}.jpg', self.descriptors[photo_id])
+        reader = DescriptorArena(self.directory)
+        reader.refresh()
+
+        # the writer compacts and deletes the generation the reader has records for but has not mapped yet
+        writer.remove(1)
+        writer.remove(3)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'data-0.bin')))
+        np.testing.assert_array_equal(reader.get(2, '2.jpg'), self.descriptors[2])
+        self.assertIsNone(reader.get(1, '1.jpg'))
+
+        writer.add(4, '4.jpg', self.descriptors[4])
+        np.testing.assert_array_equal(reader.get(4, '4.jpg'), self.descriptors[4])
+
+
+class ListCacheTests(SandboxedTestCase):
+    def test_not_modified_until_the_table_version_changes(self):
+        PhotoLost.objects.create(image='photo_lost/a.jpg', phone='13800000000')
+        bump_items_version()
+        first = self.client.get('/api/items/')
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(len(first.json()['data']), 1)
+
+        revalidated = self.client.get('/api/items/', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(revalidated['ETag'], first['ETag'])
+
+        PhotoLost.objects.create(image='photo_lost/b.jpg', phone='13800000000')
+        # unchanged version: the cached body is served even though the table has another row
+        self.assertEqual(len(self.client.get('/api/items/').json()['data']), 1)
+        bump_items_version()
+        changed = self.client.get('/api/items/', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], first['ETag'])
+        self.assertEqual(len(changed.json()['data']), 2)
+
+
+class TokenCacheTests(SandboxedTestCase):
+    def setUp(self):
+        super().setUp()
+        get_token_cache().clear()
+        self.token = self.client.post('/api/register/', {
+            'username': 'owner', 'password': 'secret', 'phone_number': '13800000000'}).json()['token']
+
+    def test_repeated_requests_skip_the_token_query(self):
+        self.assertEqual(self.client.get('/api/my-items/', HTTP_AUTHORIZATION=self.token).status_code, 200)
+        with self.assertNumQueries(0):
+            # the token is cached, and so is the (unchanged) list response
+            self.assertEqual(self.client.get('/api/my-items/', HTTP_AUTHORIZATION=self.token).status_code, 200)
+
+    def test_login_invalidates_the_previous_token(self):
+        self.client.get('/api/my-items/', HTTP_AUTHORIZATION=self.token)
+        new_token = self.client.post('/api/login/', {'username': 'owner', 'password': 'secret'}).json()['token']
+        self.assertEqual(self.client.get('/api/my-items/', HTTP_AUTHORIZATION=self.token).status_code, 401)
+        self.assertEqual(self.client.get('/api/my-items/', HTTP_AUTHORIZATION=new_token).status_code, 200)
+
+    def test_login_in_another_process_invalidates_this_processs_cached_token(self):
+        self.client.get('/api/my-items/', HTTP_AUTHORIZATION=self.token)
+        self.assertIsNotNone(get_token_cache().get(self.token))
+        # the other process has its own in-process cache and shares only the Django cache with this one
+        with mock.patch('find.tokens.get_token_cache', return_value=TokenCache(60, 100)):
+            self.client.post('/api/login/', {'username': 'owner', 'password': 'secret'})
+        self.assertIsNotNone(get_token_cache().get(self.token))
+        self.assertEqual(self.client.get('/api/my-items/', HTTP_AUTHORIZATION=self.token).status_code, 401)
+
+    def test_rotation_during_a_database_lookup_is_not_cached_as_current(self):
+        rotated = []
+
+        def rotate_after_token_select(execute, sql, params, many, context):
+            result = execute(sql, params, many, context)
+            if not rotated and sql.startswith('SELECT') and 'user_token' in sql:
+                # another process logs in again right after this lookup read the token row
+                rotated.append(True)
+                token_obj = UserToken.objects.get(token=self.token)
+                UserToken.objects.filter(pk=token_obj.pk).update(token='rotated')
+                invalidate_token(self.token, token_obj.user_id)
+            return result
+
+        with connection.execute_wrapper(rotate_after_token_select):
+            lookup_user(self.token)
+        self.assertTrue(rotated)
+        self.assertEqual(self.client.get('/api/my-items/', HTTP_AUTHORIZATION=self.token).status_code, 401)
+
+
+class HandOverTests(SandboxedTestCase):
+    def test_only_one_of_two_concurrent_claims_wins(self):
+        photo = PhotoLost.objects.create(image='photo_lost/a.jpg', phone='13800000000')
+
+        @contextlib.contextmanager
+        def claimed_meanwhile(name):
+            # another compare deletes the row after this one loaded it
+            PhotoLost.objects.filter(pk=photo.pk).delete()
+            yield
+
+        with mock.patch.object(views.metrics, 'stage', claimed_meanwhile):
+            self.assertIsNone(views.hand_over(photo.image.name, '/media/'))
+
+    def test_claim_deletes_the_image_and_thumbnail_files(self):
+        photo = PhotoLost.objects.create(image=SimpleUploadedFile('a.jpg', b'jpeg'), phone='13800000000',
+                                         thumbnail=SimpleUploadedFile('a.jpg', b'thumb'))
+        paths = [photo.image.path, photo.thumbnail.path]
+        self.assertTrue(all(os.path.exists(path) for path in paths))
+        self.assertIsNotNone(views.hand_over(photo.image.name, '/media/'))
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+
+    def test_claim_returns_the_owner(self):
+        photo = PhotoLost.objects.create(image='photo_lost/a.jpg', phone='13800000000')
+        self.assertEqual(views.hand_over(photo.image.name, '/media/')['phone'], '13800000000')
+        self.assertFalse(PhotoLost.objects.exists())
+        self.assertIsNone(views.hand_over(photo.image.name, '/media/'))
+
+
+class CompareJobClaimTests(SandboxedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='owner', password='secret', phone='13800000000')
+
+    def test_orphaned_job_is_claimed_again_until_the_attempts_run_out(self):
+        job = CompareJob.objects.create(job_id='a' * 32, user=self.user, photo=b'jpeg', photo_name='a.jpg')
+        for attempt in (1, 2):
+            self.assertEqual(jobs.claim_next_job(600, max_attempts=2).pk, job.pk)
+            # the worker died mid-run: the job looks stale to the next claim
+            CompareJob.objects.filter(pk=job.pk).update(started_at=timezone.now() - timedelta(hours=1))
+
+        self.assertIsNone(jobs.claim_next_job(600, max_attempts=2))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.result['code']), (CompareJob.FAILED, 2, 500))
+        self.assertIsNone(job.photo)
+
+
+@override_settings(FIND_FEATURE_RETRY_SECONDS=30)
+class FeaturePipelineTests(SandboxedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.photo = PhotoLost.objects.create(image='photo_lost/a.jpg', phone='13800000000')
+
+    def expire_lease(self):
+        PhotoLost.objects.filter(pk=self.photo.pk).update(next_attempt_at=timezone.now() - timedelta(seconds=1))
+
+    def test_a_leased_photo_is_claimed_again_only_after_the_lease_expires(self):
+        photo = pipeline.claim_next_photo(300)
+        self.assertEqual((photo.pk, photo.status, photo.attempts), (self.photo.pk, PhotoLost.PROCESSING, 1))
+        self.assertGreater(photo.next_attempt_at, timezone.now())
+        self.assertIsNone(pipeline.claim_next_photo(300))
+
+        self.expire_lease()
+        self.assertEqual(pipeline.claim_next_photo(300).attempts, 2)
+
+    def test_an_expired_lease_on_the_last_attempt_fails_the_photo(self):
+        for _ in range(2):
+            self.assertIsNotNone(pipeline.claim_next_photo(300, max_attempts=2))
+            self.expire_lease()
+        self.assertIsNone(pipeline.claim_next_photo(300, max_attempts=2))
+        self.photo.refresh_from_db()
+        self.assertEqual((self.photo.status, self.photo.attempts), (PhotoLost.FAILED, 2))
+
+    def test_failures_back_off_then_fail(self):
+        with mock.patch.object(pipeline, 'process_photo', side_effect=OSError('unreadable')):
+            for attempt, delay in ((1, 30), (2, 60)):
+                photo = pipeline.claim_next_photo(300)
+                self.assertEqual(photo.attempts, attempt)
+                before = timezone.now()
+                pipeline.run_photo(photo)
+                photo.refresh_from_db()
+                self.assertEqual((photo.status, photo.last_error), (PhotoLost.PENDING, 'unreadable'))
+                self.assertAlmostEqual((photo.next_attempt_at - before).total_seconds(), delay, delta=5)
+                # not claimable while backing off
+                self.assertIsNone(pipeline.claim_next_photo(300))
+                self.expire_lease()
+
+            pipeline.run_photo(pipeline.claim_next_photo(300))
+        self.photo.refresh_from_db()
+        self.assertEqual((self.photo.status, self.photo.next_attempt_at), (PhotoLost.FAILED, None))
+        self.assertIsNone(pipeline.claim_next_photo(300))
+
+    @override_settings(FIND_FEATURE_ON_DEMAND_AFTER=60)
+    def test_matchable_photos_include_stragglers_only_after_the_grace_period(self):
+        old = timezone.now() - timedelta(minutes=5)
+        ready = PhotoLost.objects.create(image='photo_lost/ready.jpg', status=PhotoLost.READY)
+        straggler = PhotoLost.objects.create(image='photo_lost/straggler.jpg', status=PhotoLost.PROCESSING)
+        failed = PhotoLost.objects.create(image='photo_lost/failed.jpg', status=PhotoLost.FAILED)
+        PhotoLost.objects.filter(pk__in=[straggler.pk, failed.pk]).update(created_at=old)
+
+        # self.photo was just uploaded and is still pending
+        self.assertEqual(set(views.matchable_photos().values_list('id', flat=True)), {ready.pk, straggler.pk})
+        with override_settings(FIND_FEATURE_ON_DEMAND_AFTER=None):
+            self.assertEqual(set(views.matchable_photos().values_list('id', flat=True)), {ready.pk})
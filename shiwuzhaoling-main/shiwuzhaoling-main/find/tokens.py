@@ -0,0 +1,163 @@
+"""Token -> user lookups for verify_token, cached in process and in a shared Django cache"""
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from . import metrics
+from .models import UserToken
+
+TOKEN_LOOKUPS = metrics.Counter('find_token_lookups_total', 'verify_token lookups by where the token was resolved',
+                                ['source'])
+
+
+class TokenCache:
+    """LRU of token -> (user, generation) entries that expire ttl seconds after they were stored"""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, token):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return value
+
+    def put(self, token, value):
+        with self._lock:
+            self._entries[token] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, token):
+        with self._lock:
+            self._entries.pop(token, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_token_cache():
+    """This process's token cache, sized by FIND_TOKEN_CACHE_SECONDS and FIND_TOKEN_CACHE_SIZE
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            from django.conf import settings
+            _cache = TokenCache(getattr(settings, 'FIND_TOKEN_CACHE_SECONDS', 5),
+                                getattr(settings, 'FIND_TOKEN_CACHE_SIZE', 10000))
+        return _cache
+
+
+def get_shared_cache():
+    from django.conf import settings
+    from django.core.cache import caches
+    alias = getattr(settings, 'FIND_TOKEN_SHARED_CACHE', 'default')
+    return caches[alias] if alias else None
+
+
+def shared_key(token):
+    # 缓存键里不出现 token 原文
+    return 'find:token:' + hashlib.sha256(token.encode()).hexdigest()
+
+
+def generation_key(user_id):
+    return f'find:token-generation:{user_id}'
+
+
+def get_generation_cache(shared):
+    # 代数一旦被淘汰，轮换前缓存的旧 token 会重新生效，因此放在不淘汰的 FIND_STATE_CACHE(未配置时用共享缓存)
+    from django.conf import settings
+    from django.core.cache import caches
+    alias = getattr(settings, 'FIND_STATE_CACHE', None)
+    return caches[alias] if alias and shared is not None else shared
+
+
+def current_generation(shared, user_id):
+    generations = get_generation_cache(shared)
+    return generations.get(generation_key(user_id)) if generations is not None else None
+
+
+def lookup_user(token):
+    """The user owning token, or None when the token is unknown
+    """
+    cache = get_token_cache()
+    if cache.ttl <= 0:
+        TOKEN_LOOKUPS.inc(source='database')
+        token_obj = UserToken.objects.select_related('user').filter(token=token).first()
+        return token_obj.user if token_obj is not None else None
+
+    # 缓存的条目带着用户的 token 代数；任一进程轮换该用户的 token 后代数改变，各进程缓存的旧条目随之失效
+    shared = get_shared_cache()
+    entry = cache.get(token)
+    if entry is not None:
+        user, generation = entry
+        if current_generation(shared, user.pk) == generation:
+            TOKEN_LOOKUPS.inc(source='local')
+            return user
+        cache.invalidate(token)
+
+    if shared is not None:
+        entry = shared.get(shared_key(token))
+        if entry is not None:
+            user, generation = entry
+            if current_generation(shared, user.pk) == generation:
+                TOKEN_LOOKUPS.inc(source='shared')
+                cache.put(token, entry)
+                return user
+
+    # 无效 token 不缓存，随机 token 撑不满缓存
+    generation = None
+    if shared is not None:
+        # 代数必须在确认 token 有效的查询之前读取：查询之后才发生的轮换会改变代数，缓存的条目随之失效
+        user_id = UserToken.objects.filter(token=token).values_list('user_id', flat=True).first()
+        if user_id is None:
+            TOKEN_LOOKUPS.inc(source='invalid')
+            return None
+        generation = current_generation(shared, user_id)
+    token_obj = UserToken.objects.select_related('user').filter(token=token).first()
+    if token_obj is None:
+        TOKEN_LOOKUPS.inc(source='invalid')
+        return None
+    TOKEN_LOOKUPS.inc(source='database')
+    entry = (token_obj.user, generation)
+    cache.put(token, entry)
+    if shared is not None:
+        from django.conf import settings
+        shared.set(shared_key(token), entry, getattr(settings, 'FIND_TOKEN_SHARED_CACHE_SECONDS', 300))
+    return token_obj.user
+
+
+def invalidate_token(token, user_id=None):
+    """Forget a token that was rotated or revoked, here and in the shared cache
+
+    Passing the owner's user_id also moves the user's token generation on, so other processes
+    drop their cached entry on its next use. Without a shared cache they keep accepting the
+    token for up to FIND_TOKEN_CACHE_SECONDS.
+    """
+    get_token_cache().invalidate(token)
+    shared = get_shared_cache()
+    if shared is not None:
+        shared.delete(shared_key(token))
+        if user_id is not None:
+            # 写入随机值而不是自增，并发轮换时代数也一定与之前不同
+            get_generation_cache(shared).set(generation_key(user_id), uuid.uuid4().hex, timeout=None)
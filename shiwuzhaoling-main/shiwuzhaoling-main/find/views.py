@@ -1,12 +1,36 @@
+import base64
+import io
+import logging
 import os
 import cv2
 import uuid
+import tempfile
+from contextlib import contextmanager
 import numpy as np
+from datetime import datetime, timedelta
 from django.conf import settings
-from django.http import JsonResponse
+from django.db.models import Q
+from django.utils import timezone
+from django.http import HttpResponse, JsonResponse
 from django.contrib.auth.hashers import make_password, check_password
-from PIL import Image
-from .models import PhotoLost, User, UserToken
+from .models import PhotoLost, User, UserToken, CompareJob
+from .features import (get_feature_backend, current_feature_tag, load_gray_image, get_decode_options,
+                       extract_descriptors, serialize_descriptors, deserialize_descriptors)
+from .codecs import LOSSLESS_CODECS, get_descriptor_codec
+from .descriptor_index import get_descriptor_index
+from .vocabulary import get_embedding_shortlist
+from .matching import find_best_match, score_candidates, score_candidates_batch, score_all
+from .cache import get_image_cache
+from .arena import get_descriptor_arena
+from .jobs import FINISHED, get_compare_workers, wait_for_job, queue_position, purge_finished_jobs
+from .pipeline import get_feature_workers
+from .list_cache import cached_list, bump_items_version
+from .tokens import lookup_user, invalidate_token
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+ALLOWED_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']
 
 
 def verify_token(request):
@@ -19,11 +43,11 @@ def verify_token(request):
     else:
         token = raw_token.strip()
 
-    try:
-        token_obj = UserToken.objects.get(token=token)
-        return token_obj.user, None
-    except UserToken.DoesNotExist:
+    # 缓存 token 对应的用户(find/tokens.py)，命中时不查数据库
+    user = lookup_user(token)
+    if user is None:
         return None, JsonResponse({'code': 401, 'msg': '无效的token'}, status=401)
+    return user, None
 
 
 def validate_photo(request):
@@ -35,171 +59,424 @@ def validate_photo(request):
     if not photo_file.name:
         return None, JsonResponse({'code': 400, 'msg': '照片文件名为空'}, status=400)
 
-    allowed_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']
     file_ext = os.path.splitext(photo_file.name)[1].lower()
-    if file_ext not in allowed_extensions:
+    if file_ext not in ALLOWED_EXTENSIONS:
         return None, JsonResponse({'code': 400, 'msg': '不支持的图片格式'}, status=400)
 
     return photo_file, None
 
 
+def validate_photos(request):
+    photo_files = request.FILES.getlist('photos')
+    if not photo_files:
+        return None, JsonResponse({'code': 400, 'msg': '未上传照片'}, status=400)
+
+    max_photos = getattr(settings, 'FIND_BATCH_MAX_PHOTOS', 6)
+    if len(photo_files) > max_photos:
+        return None, JsonResponse({'code': 400, 'msg': f'一次最多上传{max_photos}张照片'}, status=400)
+
+    for photo_file in photo_files:
+        if not photo_file.name:
+            return None, JsonResponse({'code': 400, 'msg': '照片文件名为空'}, status=400)
+        if os.path.splitext(photo_file.name)[1].lower() not in ALLOWED_EXTENSIONS:
+            return None, JsonResponse({'code': 400, 'msg': '不支持的图片格式'}, status=400)
+
+    return photo_files, None
+
+
+@contextmanager
+def open_uploaded_image(photo_file):
+    """Yield something load_gray_image can read for an upload, without writing it under MEDIA_ROOT
+
+    Uploads Django keeps in memory are read from their buffer in place, uploads it already
+    spooled to disk are read from that (uniquely named) file, anything else is copied into a
+    SpooledTemporaryFile that only touches disk above FIND_UPLOAD_SPOOL_BYTES.
+    """
+    if hasattr(photo_file, 'temporary_file_path'):
+        yield photo_file.temporary_file_path()
+        return
+
+    buffer = getattr(photo_file, 'file', None)
+    if isinstance(buffer, io.BytesIO):
+        buffer.seek(0)
+        yield buffer
+        return
+
+    limit = getattr(settings, 'FIND_UPLOAD_SPOOL_BYTES', 10 * 1024 * 1024)
+    with tempfile.SpooledTemporaryFile(max_size=limit) as spooled:
+        for chunk in photo_file.chunks():
+            spooled.write(chunk)
+        spooled.seek(0)
+        yield spooled
+
+
+SIMILARITY_THRESHOLD = 0.1
+
+
+def extract_upload_descriptors(photo_file):
+    file_size = photo_file.size
+    if not file_size:
+        logger.info('[图片对比] 文件为空')
+        return None
+
+    with metrics.stage('decode'), open_uploaded_image(photo_file) as source:
+        uploaded_gray = load_gray_image(source, **get_decode_options())
+
+    backend = get_feature_backend()
+    with metrics.stage('extract'):
+        descriptors = extract_descriptors(uploaded_gray, backend)
+
+    logger.debug('[图片对比] 文件大小: %d bytes, 预处理后尺寸: %dx%d, 特征点(%s): %s', file_size,
+                 uploaded_gray.shape[1], uploaded_gray.shape[0], backend.name,
+                 len(descriptors) if descriptors is not None else '无法提取')
+    return descriptors
+
+
 def pic_check(photo_file):
-    temp_path = None
-    try:
-        print("=" * 50)
-        print("[图片对比] 开始处理")
-        
-        temp_dir = os.path.join(settings.MEDIA_ROOT, 'temp')
-        os.makedirs(temp_dir, exist_ok=True)
-        temp_path = os.path.join(temp_dir, photo_file.name)
-        print(f"[图片对比] 临时文件路径: {temp_path}")
-
-        with open(temp_path, 'wb+') as destination:
-            for chunk in photo_file.chunks():
-                destination.write(chunk)
-
-        file_size = os.path.getsize(temp_path)
-        print(f"[图片对比] 文件大小: {file_size} bytes")
-        if file_size == 0:
-            print("[图片对比] 文件为空，返回失败")
+    with metrics.compare_trace('compare') as trace:
+        try:
+            desc1 = extract_upload_descriptors(photo_file)
+            if desc1 is None:
+                trace.result = 'no_features'
+                return [0, "null"]
+
+            shortlist = get_embedding_shortlist() if getattr(settings, 'FIND_SHORTLIST_K', 0) else None
+            if getattr(settings, 'FIND_ANN_INDEX', False):
+                max_similarity, best_match_path, best_match_id = match_with_index(desc1)
+            elif shortlist is not None:
+                max_similarity, best_match_path, best_match_id = match_with_shortlist(desc1, shortlist)
+            else:
+                max_similarity, best_match_path, best_match_id = match_exhaustive(desc1)
+
+            logger.info('[图片对比] 最高相似度: %.4f, 最佳匹配ID: %s, 最佳匹配路径: %s',
+                        max_similarity, best_match_id, best_match_path)
+
+            if max_similarity > SIMILARITY_THRESHOLD:
+                trace.result = 'match'
+                return [1, best_match_path]
+            trace.result = 'no_match'
             return [0, "null"]
 
-        pil_img = Image.open(temp_path)
-        print(f"[图片对比] 原始图片尺寸: {pil_img.width}x{pil_img.height}")
-        
-        max_size = 600
-        if pil_img.width > max_size or pil_img.height > max_size:
-            scale = max_size / max(pil_img.width, pil_img.height)
-            new_width = int(pil_img.width * scale)
-            new_height = int(pil_img.height * scale)
-            pil_img = pil_img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            print(f"[图片对比] 缩放后尺寸: {new_width}x{new_height}")
-
-        if pil_img.mode == 'RGBA':
-            pil_img = pil_img.convert('RGB')
-            print("[图片对比] 转换RGBA为RGB")
-
-        uploaded_img = cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR)
-        uploaded_gray = cv2.cvtColor(uploaded_img, cv2.COLOR_BGR2GRAY)
-        print("[图片对比] 图片预处理完成")
-
-        print("[图片对比] 开始提取上传图片的特征点...")
-        sift = cv2.SIFT_create(nfeatures=500)
-        kp1, desc1 = sift.detectAndCompute(uploaded_gray, None)
-
-        if desc1 is None or len(kp1) == 0:
-            print("[图片对比] 无法提取特征点，返回失败")
+        except Exception as e:
+            logger.exception('[图片对比] 发生错误: %s', e)
+            trace.result = 'error'
             return [0, "null"]
 
-        print(f"[图片对比] 上传图片特征点数量: {len(kp1)}")
 
-        database_images = get_database_images()
-        print(f"[图片对比] 数据库中共有 {len(database_images)} 张图片")
-        if not database_images:
-            print("[图片对比] 数据库为空，返回失败")
-            return [0, "null"]
+def match_exhaustive(desc1, database_images=None):
+    with metrics.stage('load'):
+        candidates = load_candidates(database_images)
+    if not candidates:
+        return 0, None, None
 
-        best_match_path = None
-        max_similarity = 0
-        best_match_id = None
-        
-        bf = cv2.BFMatcher(cv2.NORM_L2)
+    stats = {}
+    with metrics.stage('match'):
+        best = find_best_match(desc1, candidates, get_feature_backend().norm, stats=stats)
+    metrics.count('scanned', stats.get('scanned', len(candidates)))
+    metrics.count('pruned', stats.get('pruned', 0))
+    metrics.count('stopped_early', stats.get('stopped_early', 0))
+    return best
 
-        print("[图片对比] 开始遍历数据库图片进行对比...")
-        for idx, product in enumerate(database_images):
-            image_url = product.get("image", "")
-            if not image_url:
-                continue
-
-            db_img_path = os.path.join(settings.MEDIA_ROOT, image_url)
-            if not os.path.exists(db_img_path):
-                print(f"[图片对比] 图片{idx+1}: 文件不存在 - {db_img_path}")
-                continue
 
+def load_candidates(database_images=None):
+    """(photo_id, image, descriptors) for every stored photo that has descriptors
+    """
+    if database_images is None:
+        database_images = get_database_images()
+    if not database_images:
+        logger.info('[图片对比] 数据库为空，返回失败')
+        return []
+
+    with_image = [product for product in database_images if product.get("image")]
+    metrics.count('skipped', len(database_images) - len(with_image))
+    candidates = []
+    for product, desc2 in iter_stored_descriptors(with_image):
+        if desc2 is None:
+            logger.debug('[图片对比] 图片(ID:%s): 无法提取特征点，跳过', product.get('id'))
+            metrics.count('skipped')
+            continue
+        candidates.append((product['id'], product['image'], desc2))
+    return candidates
+
+
+def iter_stored_descriptors(products):
+    """Yield (product, descriptors) for database rows: shared arena or process cache first, then the table
+    """
+    feature_tag = current_feature_tag()
+    arena = get_descriptor_arena()
+    if arena is not None:
+        arena.refresh()
+    found = {}
+    for product in products:
+        if (product.get('feature_version'), product.get('feature_codec')) == feature_tag:
             try:
-                db_pil_img = Image.open(db_img_path)
-
-                if db_pil_img.width > max_size or db_pil_img.height > max_size:
-                    scale = max_size / max(db_pil_img.width, db_pil_img.height)
-                    new_width = int(db_pil_img.width * scale)
-                    new_height = int(db_pil_img.height * scale)
-                    db_pil_img = db_pil_img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-
-                if db_pil_img.mode == 'RGBA':
-                    db_pil_img = db_pil_img.convert('RGB')
-
-                db_img = cv2.cvtColor(np.array(db_pil_img), cv2.COLOR_RGB2BGR)
-                db_gray = cv2.cvtColor(db_img, cv2.COLOR_BGR2GRAY)
-
-                kp2, desc2 = sift.detectAndCompute(db_gray, None)
-
-                if desc2 is None or len(kp2) == 0:
-                    print(f"[图片对比] 图片{idx+1}(ID:{product.get('id')}): 无法提取特征点，跳过")
-                    continue
-
-                matches = bf.knnMatch(desc1, desc2, k=2)
-                
-                good_matches = []
-                for match_pair in matches:
-                    if len(match_pair) == 2:
-                        m, n = match_pair
-                        if m.distance < 0.75 * n.distance:
-                            good_matches.append(m)
-                
-                min_features = min(len(kp1), len(kp2))
-                if min_features > 0:
-                    similarity = len(good_matches) / min_features
-                else:
-                    similarity = 0
-                    
-                print(f"[图片对比] 图片{idx+1}(ID:{product.get('id')}): 特征点={len(kp2)}, 匹配={len(good_matches)}, 相似度={similarity:.4f}")
-
-                if similarity > max_similarity:
-                    max_similarity = similarity
-                    best_match_path = image_url
-                    best_match_id = product.get('id')
-
+                descriptors = lookup_descriptors(product['id'], product['image'], arena)
             except Exception as e:
-                print(f"[图片对比] 图片{idx+1}处理失败: {e}")
+                # 共享区读取失败时退回数据库，不影响本次比对
+                logger.warning('[图片对比] 图片(ID:%s)读取共享描述符失败: %s', product.get('id'), e)
                 continue
+            if descriptors is not None:
+                found[product['id']] = descriptors
 
-        print("[图片对比] 对比完成")
-        print(f"[图片对比] 最高相似度: {max_similarity:.4f}")
-        print(f"[图片对比] 最佳匹配ID: {best_match_id}")
-        print(f"[图片对比] 最佳匹配路径: {best_match_path}")
-        
-        similarity_threshold = 0.1
-        if max_similarity > similarity_threshold:
-            print(f"[图片对比] 结果: 匹配成功 (相似度 {max_similarity:.4f} > 阈值 {similarity_threshold})")
-            print("=" * 50)
-            return [1, best_match_path]
-        else:
-            print(f"[图片对比] 结果: 匹配失败 (相似度 {max_similarity:.4f} <= 阈值 {similarity_threshold})")
-            print("=" * 50)
-            return [0, "null"]
+    # 未命中的描述符一次性从数据库取回
+    missing = [product['id'] for product in products if product['id'] not in found]
+    blobs = dict(PhotoLost.objects.filter(pk__in=missing).values_list('id', 'descriptors')) if missing else {}
 
-    except Exception as e:
-        print(f"[图片对比] 发生错误: {str(e)}")
-        print("=" * 50)
-        return [0, "null"]
-    finally:
-        if temp_path and os.path.exists(temp_path):
+    for product in products:
+        descriptors = found.get(product['id'])
+        if descriptors is None:
+            product['descriptors'] = blobs.get(product['id'])
             try:
-                os.remove(temp_path)
-                print(f"[图片对比] 已删除临时文件: {temp_path}")
+                descriptors = load_stored_descriptors(product)
             except Exception as e:
-                print(f"[图片对比] 删除临时文件失败: {e}")
+                logger.warning('[图片对比] 图片(ID:%s)处理失败: %s', product.get('id'), e)
+                metrics.count('skipped')
+                continue
+        yield product, descriptors
+
 
+def lookup_descriptors(photo_id, image_name, arena=None):
+    if arena is not None:
+        return arena.get(photo_id, image_name)
+    return get_image_cache().get(stored_image_path(image_name), descriptor_cache_kind())
 
-def get_database_images():
-    database_images = list(PhotoLost.objects.values('id', 'image', 'created_at'))
+
+def remember_descriptors(photo_id, image_name, descriptors):
+    # 有共享描述符区时写入共享区，所有 worker 进程都能读到；否则放进本进程的缓存
+    arena = get_descriptor_arena()
+    if arena is not None:
+        arena.add(photo_id, image_name, descriptors)
+    else:
+        get_image_cache().put(stored_image_path(image_name), descriptor_cache_kind(), descriptors)
+
+
+def match_with_shortlist(desc1, shortlist):
+    with metrics.stage('load'):
+        sync_with_table(shortlist)
+    with metrics.stage('match'):
+        shortlist_k = getattr(settings, 'FIND_SHORTLIST_K', 20)
+        candidate_ids = shortlist.shortlist(desc1, shortlist_k)
+    logger.debug('[图片对比] 全局向量初筛: %d 张中选出 %d 张候选', len(shortlist), len(candidate_ids))
+    return match_exhaustive(desc1, get_database_images(candidate_ids))
+
+
+def rank_by_votes(index, votes, query_size):
+    """Voted photo ids, best share of matching descriptors first
+    """
+    counts = {photo_id: index.descriptor_count(photo_id) for photo_id in votes}
+    # 搜索之后可能已被其他请求认领并移出索引(数量为 0)，不再参与排序
+    return sorted((photo_id for photo_id in votes if counts[photo_id]),
+                  key=lambda photo_id: votes[photo_id] / min(query_size, counts[photo_id]), reverse=True)
+
+
+def match_with_index(desc1):
+    with metrics.stage('load'):
+        index = sync_with_table(get_descriptor_index())
+    if not len(index):
+        logger.info('[图片对比] 数据库为空，返回失败')
+        return 0, None, None
+
+    with metrics.stage('match'):
+        votes = index.search(desc1)
+
+        # 投票只用于筛选候选，最终相似度仍按原比率测试精确计算
+        ranked = rank_by_votes(index, votes, len(desc1))
+        rerank = getattr(settings, 'FIND_ANN_RERANK', 5)
+        logger.debug('[图片对比] 索引 %d 张, 近邻投票命中 %d 张, 前%d名: %s', len(index), len(votes), rerank,
+                     [(photo_id, votes[photo_id]) for photo_id in ranked[:rerank]])
+
+        candidates = [(photo_id, None, index.get_descriptors(photo_id)) for photo_id in ranked[:rerank]]
+        candidates = [candidate for candidate in candidates if candidate[2] is not None]
+        max_similarity, _, best_match_id = score_candidates(desc1, candidates, verbose=True, norm=get_feature_backend().norm)
+    metrics.count('scanned', len(candidates))
+
+    if best_match_id is None:
+        return 0, None, None
+    best_match_path = PhotoLost.objects.filter(pk=best_match_id).values_list('image', flat=True).first()
+    if best_match_path is None:
+        return 0, None, None
+    return max_similarity, best_match_path, best_match_id
+
+
+def matchable_photos():
+    """Rows pic_check compares against: ready ones, plus stragglers the pipeline has not finished
+    within FIND_FEATURE_ON_DEMAND_AFTER seconds, whose descriptors are then computed on demand
+    """
+    ready = Q(status=PhotoLost.READY)
+    after = getattr(settings, 'FIND_FEATURE_ON_DEMAND_AFTER', 60)
+    if after is not None:
+        ready |= Q(status__in=(PhotoLost.PENDING, PhotoLost.PROCESSING),
+                   created_at__lte=timezone.now() - timedelta(seconds=after))
+    return PhotoLost.objects.filter(ready)
+
+
+def pic_check_batch(photo_files):
+    """Rank stored photos against several uploads of the same item in a single pass
+
+    Returns [(similarity, [similarity per upload], image, photo_id)] best first, where similarity is
+    the best view's score; uploads without features are skipped.
+    """
+    queries = []
+    for photo_file in photo_files:
+        try:
+            descriptors = extract_upload_descriptors(photo_file)
+        except Exception as e:
+            logger.warning('[批量对比] 图片 %s 处理失败: %s', photo_file.name, e)
+            continue
+        if descriptors is not None:
+            queries.append(descriptors)
+    if not queries:
+        logger.info('[批量对比] %d 张图片都没有可用的特征点，返回失败', len(photo_files))
+        return []
+
+    shortlist = get_embedding_shortlist() if getattr(settings, 'FIND_SHORTLIST_K', 0) else None
+    if getattr(settings, 'FIND_ANN_INDEX', False):
+        scored = score_with_index(queries)
+    elif shortlist is not None:
+        with metrics.stage('load'):
+            sync_with_table(shortlist)
+            shortlist_k = getattr(settings, 'FIND_SHORTLIST_K', 20)
+            # 各张图片的候选取并集，再一起做一遍比率测试
+            candidate_ids = list(dict.fromkeys(photo_id for query in queries for photo_id in shortlist.shortlist(query, shortlist_k)))
+            candidates = load_candidates(get_database_images(candidate_ids))
+        logger.debug('[批量对比] 全局向量初筛: %d 张中选出 %d 张候选', len(shortlist), len(candidate_ids))
+        with metrics.stage('match'):
+            scored = score_all(queries, candidates, get_feature_backend().norm)
+    else:
+        with metrics.stage('load'):
+            candidates = load_candidates()
+        with metrics.stage('match'):
+            scored = score_all(queries, candidates, get_feature_backend().norm)
+    metrics.count('scanned', len(scored))
+
+    # 融合：取各角度中的最高相似度，相同时按相似度之和排序
+    ranking = sorted(((max(similarities), similarities, image, photo_id) for photo_id, image, similarities in scored),
+                     key=lambda item: (item[0], sum(item[1])), reverse=True)
+    if ranking:
+        logger.info('[批量对比] %d 张图片, 最高相似度: %.4f, 最佳匹配ID: %s', len(queries), ranking[0][0], ranking[0][3])
+    return ranking
+
+
+def score_with_index(queries):
+    with metrics.stage('load'):
+        index = sync_with_table(get_descriptor_index())
+    if not len(index):
+        return []
+
+    with metrics.stage('match'):
+        # 所有图片的描述符合在一起做一次近邻查询，票数按图片累加
+        stacked = np.concatenate(queries)
+        votes = index.search(stacked)
+        ranked = rank_by_votes(index, votes, len(stacked))
+        rerank = getattr(settings, 'FIND_ANN_RERANK', 5) * len(queries)
+        logger.debug('[批量对比] 索引 %d 张, 近邻投票命中 %d 张图片，前%d名做精确比对', len(index), len(votes), rerank)
+
+        images = dict(PhotoLost.objects.filter(pk__in=ranked[:rerank]).values_list('id', 'image'))
+        candidates = [(photo_id, images[photo_id], index.get_descriptors(photo_id)) for photo_id in ranked[:rerank] if photo_id in images]
+        candidates = [candidate for candidate in candidates if candidate[2] is not None]
+        return score_candidates_batch(queries, candidates, get_feature_backend().norm)
+
+
+def get_database_images(photo_ids=None):
+    queryset = matchable_photos()
+    if photo_ids is not None:
+        queryset = queryset.filter(pk__in=photo_ids)
+    # 描述符体积大，按需单独读取(见 load_stored_descriptors)，优先走内存缓存
+    database_images = list(queryset.values('id', 'image', 'created_at', 'feature_version', 'feature_codec'))
     return database_images
 
 
+def stored_image_path(image_name):
+    return os.path.join(settings.MEDIA_ROOT, image_name)
+
+
+def descriptor_cache_kind():
+    # 按后端和存储格式区分缓存，切换 FIND_FEATURE_BACKEND / FIND_DESCRIPTOR_CODEC 后不会读到另一种描述符
+    backend = get_feature_backend()
+    return f'descriptors:{backend.name}:{get_descriptor_codec(backend).tag}'
+
+
+def load_stored_gray(db_img_path):
+    cache = get_image_cache()
+    keep_gray = getattr(settings, 'FIND_IMAGE_CACHE_GRAY', False)
+    gray = cache.get(db_img_path, 'gray') if keep_gray else None
+    if gray is None:
+        gray = load_gray_image(db_img_path, **get_decode_options())
+        if keep_gray:
+            cache.put(db_img_path, 'gray', gray)
+    return gray
+
+
+def load_stored_descriptors(product):
+    db_img_path = stored_image_path(product['image'])
+    backend = get_feature_backend()
+    codec = get_descriptor_codec(backend)
+    stored_codec = product.get('feature_codec')
+    if product.get('feature_version') == backend.feature_version and (stored_codec == codec.tag or stored_codec in LOSSLESS_CODECS):
+        if 'descriptors' in product:
+            data = product['descriptors']
+        else:
+            data = PhotoLost.objects.filter(pk=product['id']).values_list('descriptors', flat=True).first()
+        descriptors = deserialize_descriptors(data)
+        if stored_codec == codec.tag:
+            remember_descriptors(product['id'], product['image'], descriptors)
+            return descriptors
+        # 存储格式变了但旧数据无损：直接转码，不必重新解码原图
+        if descriptors is not None:
+            descriptors = codec.encode(descriptors)
+    else:
+        # 历史数据或特征版本过期：从原图重新提取并回写，之后的对比直接读取
+        if not os.path.exists(db_img_path):
+            logger.warning('[图片对比] 图片(ID:%s): 文件不存在 - %s', product.get('id'), db_img_path)
+            metrics.count('missing_file')
+            return None
+        descriptors = extract_descriptors(load_stored_gray(db_img_path), backend, codec)
+
+    PhotoLost.objects.filter(pk=product['id']).update(
+        descriptors=serialize_descriptors(descriptors) if descriptors is not None else None,
+        feature_version=backend.feature_version,
+        feature_codec=codec.tag
+    )
+    remember_descriptors(product['id'], product['image'], descriptors)
+    return descriptors
+
+
+def load_descriptors_by_id(photo_ids):
+    products = list(PhotoLost.objects.filter(pk__in=photo_ids).values('id', 'image', 'feature_version', 'feature_codec'))
+    for product, descriptors in iter_stored_descriptors(products):
+        yield product['id'], descriptors
+
+
+def sync_with_table(structure):
+    # 其他进程(其他worker、clear_photolost命令)的增删在这里增量同步，不会整体重建
+    structure.sync(matchable_photos().values_list('id', flat=True), load_descriptors_by_id)
+    return structure
+
+
+def index_photo(photo_id, image_name, descriptors):
+    remember_descriptors(photo_id, image_name, descriptors)
+    if getattr(settings, 'FIND_ANN_INDEX', False):
+        get_descriptor_index().add(photo_id, descriptors)
+    shortlist = get_embedding_shortlist()
+    if shortlist is not None:
+        shortlist.add(photo_id, descriptors)
+
+
+def unindex_photo(photo_id, image_name):
+    get_image_cache().invalidate(stored_image_path(image_name))
+    arena = get_descriptor_arena()
+    if arena is not None:
+        arena.remove(photo_id)
+    get_descriptor_index().remove(photo_id)
+    shortlist = get_embedding_shortlist()
+    if shortlist is not None:
+        shortlist.remove(photo_id)
+
+
 def calculate_similarity(desc1, desc2):
     try:
         if desc1 is None or desc2 is None or len(desc1) == 0 or len(desc2) == 0:
-            print("描述符为空，无法计算相似度")
+            logger.debug('描述符为空，无法计算相似度')
             return 0
 
         if isinstance(desc1, list):
@@ -208,8 +485,7 @@ def calculate_similarity(desc1, desc2):
             desc2 = np.array(desc2, dtype=np.float32)
 
         if len(desc1.shape) != 2 or len(desc2.shape) != 2:
-            print(
-                f"描述符维度不正确: desc1={desc1.shape if hasattr(desc1, 'shape') else 'N/A'}, desc2={desc2.shape if hasattr(desc2, 'shape') else 'N/A'}")
+            logger.warning('描述符维度不正确: desc1=%s, desc2=%s', getattr(desc1, 'shape', 'N/A'), getattr(desc2, 'shape', 'N/A'))
             return 0
 
         bf = cv2.BFMatcher(cv2.NORM_L2, crossCheck=False)
@@ -226,14 +502,13 @@ def calculate_similarity(desc1, desc2):
         min_features = min(len(desc1), len(desc2))
         if min_features > 0:
             similarity = len(good_matches) / min_features
-            print(f"良好匹配数: {len(good_matches)}, 特征点数: {len(desc1)}/{len(desc2)}, 相似度: {similarity:.4f}")
+            logger.debug('良好匹配数: %d, 特征点数: %d/%d, 相似度: %.4f', len(good_matches), len(desc1), len(desc2), similarity)
             return similarity
         else:
             return 0
 
     except Exception as e:
-        print(f"相似度计算出错: {e}")
-        traceback.print_exc()
+        logger.exception('相似度计算出错: %s', e)
         return 0
 
 
@@ -254,6 +529,9 @@ def upload_photo(request):
             image=photo_file,
             phone=user.phone
         )
+        bump_items_version()
+        # 特征、缩略图和哈希由后台 worker 计算(find/pipeline.py)，完成后才参与比对
+        get_feature_workers().notify()
         return JsonResponse({
             'code': 200,
             'msg': '上传成功',
@@ -261,11 +539,12 @@ def upload_photo(request):
                 'id': photo_lost.id,
                 'image_path': photo_lost.image.name,
                 'phone': photo_lost.phone,
+                'status': photo_lost.status,
                 'created_at': photo_lost.created_at.strftime('%Y-%m-%d %H:%M:%S')
             }
         })
     except Exception as e:
-        print(f"上传照片失败: {str(e)}")
+        logger.exception('上传照片失败: %s', e)
         return JsonResponse({'code': 500, 'msg': f'上传失败: {str(e)}'}, status=500)
 
 
@@ -281,31 +560,174 @@ def compare_photo(request):
     if error_response:
         return error_response
 
-    try:
-        result = pic_check(photo_file)
+    body, status = run_compare(photo_file, request.build_absolute_uri(settings.MEDIA_URL))
+    return JsonResponse(body, status=status)
+
+
+def run_compare(photo_file, media_base):
+    """Match an upload and hand over the best stored photo; returns (response body, HTTP status)
+
+    Shared by the synchronous /api/compare/ and the compare job workers.
+    """
+    with metrics.compare_trace('compare') as trace:
+        try:
+            result = pic_check(photo_file)
+
+            if result[0] == 1:
+                data = hand_over(result[1], media_base)
+                if data is not None:
+                    return {'code': 200, 'msg': '比对成功', 'data': data}, 200
+                trace.result = 'claimed'
+            return {'code': 400, 'msg': '比对失败'}, 200
+        except Exception as e:
+            logger.exception('比对照片失败: %s', e)
+            trace.result = 'error'
+            return {'code': 500, 'msg': f'比对失败: {str(e)}'}, 500
+
+
+def hand_over(matched_path, media_base):
+    """Remove the matched photo from the pool and return its details, or None if another compare claimed it first
+    """
+    photo_lost = PhotoLost.objects.filter(image=matched_path).defer('descriptors').first()
+    if photo_lost is None:
+        # 并发比对时已被其他请求认领
+        return None
+    image_url = media_base + photo_lost.image.name if photo_lost.image else ''
+    data = {
+        'id': photo_lost.id,
+        'image_url': image_url,
+        'phone': photo_lost.phone,
+        'created_at': photo_lost.created_at.strftime('%Y-%m-%d %H:%M:%S')
+    }
+    with metrics.stage('delete'):
+        # 删除本身就是认领：并发比对到同一张图片时只有一个请求能删掉这一行
+        deleted, _ = PhotoLost.objects.filter(pk=photo_lost.pk).delete()
+        if not deleted:
+            return None
+        bump_items_version()
+        unindex_photo(photo_lost.pk, matched_path)
+        # 只有认领成功的请求删除图片文件
+        if photo_lost.image:
+            photo_lost.image.delete(save=False)
+        if photo_lost.thumbnail:
+            photo_lost.thumbnail.delete(save=False)
+    return data
+
+
+def compare_photo_batch(request):
+    if request.method != 'POST':
+        return JsonResponse({'code': 400, 'msg': '请求方法错误'}, status=400)
 
-        if result[0] == 1:
-            matched_path = result[1]
-            photo_lost = PhotoLost.objects.get(image=matched_path)
+    user, error_response = verify_token(request)
+    if error_response:
+        return error_response
+
+    photo_files, error_response = validate_photos(request)
+    if error_response:
+        return error_response
+
+    with metrics.compare_trace('compare_batch') as trace:
+        try:
+            ranking = pic_check_batch(photo_files)
             media_base = request.build_absolute_uri(settings.MEDIA_URL)
-            image_url = media_base + photo_lost.image.name if photo_lost.image else ''
-            response_data = {
-                'code': 200,
-                'msg': '比对成功',
-                'data': {
-                    'id': photo_lost.id,
-                    'image_url': image_url,
-                    'phone': photo_lost.phone,
-                    'created_at': photo_lost.created_at.strftime('%Y-%m-%d %H:%M:%S')
-                }
+            top = getattr(settings, 'FIND_BATCH_RANKING_SIZE', 5)
+            # 排名只给出图片和相似度，联系电话只随认领成功的物品返回
+            data = {
+                'ranking': [{
+                    'id': photo_id,
+                    'image_url': media_base + image if image else '',
+                    'similarity': round(similarity, 4),
+                    'similarities': [round(value, 4) for value in similarities],
+                } for similarity, similarities, image, photo_id in ranking[:top] if similarity > 0]
             }
-            photo_lost.delete()
-            return JsonResponse(response_data)
-        else:
-            return JsonResponse({'code': 400, 'msg': '比对失败'})
+            trace.result = 'no_match'
+            if ranking and ranking[0][0] > SIMILARITY_THRESHOLD:
+                matched = hand_over(ranking[0][2], media_base)
+                if matched is not None:
+                    trace.result = 'match'
+                    data.update(matched)
+                    data['similarity'] = round(ranking[0][0], 4)
+                    return JsonResponse({'code': 200, 'msg': '比对成功', 'data': data})
+                trace.result = 'claimed'
+            return JsonResponse({'code': 400, 'msg': '比对失败', 'data': data})
+        except Exception as e:
+            logger.exception('批量比对失败: %s', e)
+            trace.result = 'error'
+            return JsonResponse({'code': 500, 'msg': f'比对失败: {str(e)}'}, status=500)
+
+
+def compare_job_data(job):
+    data = {
+        'job_id': job.job_id,
+        'status': job.status,
+        'position': queue_position(job),
+    }
+    if job.status in FINISHED:
+        data['result'] = job.result
+    return data
+
+
+def submit_compare_job(request):
+    if request.method != 'POST':
+        return JsonResponse({'code': 400, 'msg': '请求方法错误'}, status=400)
+
+    user, error_response = verify_token(request)
+    if error_response:
+        return error_response
+
+    photo_file, error_response = validate_photo(request)
+    if error_response:
+        return error_response
+
+    try:
+        purge_finished_jobs(getattr(settings, 'FIND_COMPARE_JOB_TTL', 24 * 3600))
+        job = CompareJob.objects.create(
+            job_id=uuid.uuid4().hex,
+            user=user,
+            photo=photo_file.read(),
+            photo_name=photo_file.name,
+            media_base=request.build_absolute_uri(settings.MEDIA_URL)
+        )
+        get_compare_workers().notify()
+        return JsonResponse({'code': 200, 'msg': '已提交', 'data': compare_job_data(job)})
     except Exception as e:
-        print(f"比对照片失败: {str(e)}")
-        return JsonResponse({'code': 500, 'msg': f'比对失败: {str(e)}'}, status=500)
+        logger.exception('提交比对任务失败: %s', e)
+        return JsonResponse({'code': 500, 'msg': f'提交失败: {str(e)}'}, status=500)
+
+
+def get_compare_job(request, job_id):
+    if request.method != 'GET':
+        return JsonResponse({'code': 400, 'msg': '请求方法错误'}, status=400)
+
+    user, error_response = verify_token(request)
+    if error_response:
+        return error_response
+
+    job = CompareJob.objects.filter(job_id=job_id, user=user).defer('photo').first()
+    if job is None:
+        return JsonResponse({'code': 404, 'msg': '任务不存在'}, status=404)
+
+    # ?wait=秒数：任务未完成时挂起等待(长轮询)，最长 FIND_COMPARE_LONG_POLL_SECONDS；默认为 0，立即返回
+    try:
+        wait = float(request.GET.get('wait', 0))
+    except ValueError:
+        wait = 0
+    wait = min(max(wait, 0), getattr(settings, 'FIND_COMPARE_LONG_POLL_SECONDS', 0))
+    if wait:
+        job = wait_for_job(job, wait)
+
+    return JsonResponse({'code': 200, 'msg': '获取成功', 'data': compare_job_data(job)})
+
+
+def compare_metrics(request):
+    if request.method != 'GET':
+        return JsonResponse({'code': 400, 'msg': '请求方法错误'}, status=400)
+
+    token = getattr(settings, 'FIND_METRICS_TOKEN', None)
+    if token and request.META.get('HTTP_AUTHORIZATION') != f'Bearer {token}':
+        return JsonResponse({'code': 401, 'msg': '无效的token'}, status=401)
+
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 def user_register(request):
@@ -360,42 +782,92 @@ def user_login(request):
     if not check_password(password, user.password):
         return JsonResponse({'code': 401, 'msg': '用户名或密码错误'})
 
+    old_token = UserToken.objects.filter(user=user).values_list('token', flat=True).first()
     token_obj, _ = UserToken.objects.update_or_create(
         user=user,
         defaults={'token': str(uuid.uuid4()).replace('-', '')}
     )
+    # 重新登录后旧 token 失效，不能再从缓存中认证
+    if old_token:
+        invalidate_token(old_token, user.pk)
 
     return JsonResponse({'code': 200, 'msg': '登录成功', 'token': token_obj.token})
 
 
+def encode_cursor(item):
+    return base64.urlsafe_b64encode(f"{item['created_at'].isoformat()},{item['id']}".encode()).decode()
+
+
+def decode_cursor(cursor):
+    created_at, photo_id = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit(',', 1)
+    created_at = datetime.fromisoformat(created_at)
+    if timezone.is_naive(created_at) and settings.USE_TZ:
+        raise ValueError('cursor without timezone')
+    return created_at, int(photo_id)
+
+
+def paginate_items(request, queryset):
+    """One page of queryset, newest first, after the ?cursor= of the previous page; returns (items, next_cursor, error_response)
+
+    Keyset pagination on (created_at, id) (see the photo_lost indexes): every page costs an index
+    range scan of ?limit= rows, however deep it is and however large the table grows.
+    """
+    default_size = getattr(settings, 'FIND_ITEMS_PAGE_SIZE', 20)
+    try:
+        limit = int(request.GET.get('limit', default_size))
+    except ValueError:
+        limit = default_size
+    limit = min(max(limit, 1), getattr(settings, 'FIND_ITEMS_MAX_PAGE_SIZE', 100))
+
+    cursor = request.GET.get('cursor')
+    if cursor:
+        try:
+            created_at, photo_id = decode_cursor(cursor)
+        except (ValueError, UnicodeDecodeError):
+            return None, None, JsonResponse({'code': 400, 'msg': '无效的cursor'}, status=400)
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=photo_id))
+
+    # 多取一条判断是否还有下一页
+    items = list(queryset.order_by('-created_at', '-id')[:limit + 1])
+    next_cursor = encode_cursor(items[limit - 1]) if len(items) > limit else None
+    return items[:limit], next_cursor, None
+
+
+def item_data(item, media_base):
+    image_path = item['image'] or ''
+    image_url = media_base + image_path if image_path else ''
+    created_at = item['created_at']
+    if created_at:
+        if timezone.is_aware(created_at):
+            created_at = timezone.localtime(created_at)
+        created_at_str = created_at.strftime('%Y-%m-%d %H:%M:%S')
+    else:
+        created_at_str = ''
+    return {
+        'id': item['id'],
+        'image_url': image_url,
+        'thumbnail_url': media_base + item['thumbnail'] if item['thumbnail'] else image_url,
+        'created_at': created_at_str,
+    }
+
+
 def get_items(request):
     if request.method != 'GET':
         return JsonResponse({'code': 400, 'msg': '请求方法错误'}, status=400)
 
-    items = PhotoLost.objects.all().order_by('-created_at').values('id', 'image', 'created_at')
+    return cached_list(request, 'items', lambda: list_items(request))
 
-    media_base = request.build_absolute_uri(settings.MEDIA_URL)
 
-    from django.utils import timezone
-
-    data = []
-    for item in items:
-        image_path = item['image'] or ''
-        image_url = media_base + image_path if image_path else ''
-        created_at = item['created_at']
-        if created_at:
-            if timezone.is_aware(created_at):
-                created_at = timezone.localtime(created_at)
-            created_at_str = created_at.strftime('%Y-%m-%d %H:%M:%S')
-        else:
-            created_at_str = ''
-        data.append({
-            'id': item['id'],
-            'image_url': image_url,
-            'created_at': created_at_str,
-        })
+def list_items(request):
+    items, next_cursor, error_response = paginate_items(
+        request, PhotoLost.objects.values('id', 'image', 'thumbnail', 'created_at'))
+    if error_response:
+        return error_response
+
+    media_base = request.build_absolute_uri(settings.MEDIA_URL)
+    data = [item_data(item, media_base) for item in items]
 
-    return JsonResponse({'code': 200, 'msg': '获取成功', 'data': data})
+    return JsonResponse({'code': 200, 'msg': '获取成功', 'data': data, 'next_cursor': next_cursor})
 
 
 def get_my_items(request):
@@ -406,27 +878,16 @@ def get_my_items(request):
     if error_response:
         return error_response
 
-    items = PhotoLost.objects.filter(phone=user.phone).order_by('-created_at').values('id', 'image', 'created_at')
+    return cached_list(request, f'user:{user.id}', lambda: list_my_items(request, user), private=True)
 
-    media_base = request.build_absolute_uri(settings.MEDIA_URL)
 
-    from django.utils import timezone
-
-    data = []
-    for item in items:
-        image_path = item['image'] or ''
-        image_url = media_base + image_path if image_path else ''
-        created_at = item['created_at']
-        if created_at:
-            if timezone.is_aware(created_at):
-                created_at = timezone.localtime(created_at)
-            created_at_str = created_at.strftime('%Y-%m-%d %H:%M:%S')
-        else:
-            created_at_str = ''
-        data.append({
-            'id': item['id'],
-            'image_url': image_url,
-            'created_at': created_at_str,
-        })
+def list_my_items(request, user):
+    items, next_cursor, error_response = paginate_items(
+        request, PhotoLost.objects.filter(phone=user.phone).values('id', 'image', 'thumbnail', 'created_at', 'status'))
+    if error_response:
+        return error_response
+
+    media_base = request.build_absolute_uri(settings.MEDIA_URL)
+    data = [dict(item_data(item, media_base), status=item['status']) for item in items]
 
-    return JsonResponse({'code': 200, 'msg': '获取成功', 'data': data})
+    return JsonResponse({'code': 200, 'msg': '获取成功', 'data': data, 'next_cursor': next_cursor})
@@ -0,0 +1,170 @@
+import os
+import threading
+
+import cv2
+import numpy as np
+
+from .features import FEATURE_BACKENDS
+
+
+class Vocabulary:
+    """Visual-word vocabulary (k-means centres over one feature backend's descriptors) with idf weights
+
+    Binary descriptors are clustered as unpacked 0/1 vectors, see FeatureBackend.as_float. `space`
+    names the descriptor space it was trained in (DescriptorCodec.space), e.g. 'sift' or 'sift/pca64-..'.
+    """
+
+    def __init__(self, centers, idf, backend='sift', space=None):
+        self.centers = np.ascontiguousarray(centers, dtype=np.float32)
+        self.idf = np.asarray(idf, dtype=np.float32)
+        self.backend = backend
+        self.space = space or backend
+        self._center_norms = np.einsum('ij,ij->i', self.centers, self.centers)
+
+    def __len__(self):
+        return len(self.centers)
+
+    @classmethod
+    def train(cls, samples, size, descriptor_sets, iterations=20, attempts=1, backend='sift', space=None):
+        """Cluster the sampled descriptors into `size` words and derive idf from how many photos use each word
+        """
+        samples = np.ascontiguousarray(FEATURE_BACKENDS[backend].as_float(samples))
+        size = min(size, len(samples))
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, iterations, 1e-3)
+        _, _, centers = cv2.kmeans(samples, size, None, criteria, attempts, cv2.KMEANS_PP_CENTERS)
+        vocabulary = cls(centers, np.ones(size, dtype=np.float32), backend, space)
+        document_frequency = np.zeros(size)
+        for descriptors in descriptor_sets:
+            document_frequency[np.unique(vocabulary.assign(descriptors))] += 1
+        vocabulary.idf = np.log((len(descriptor_sets) + 1) / (document_frequency + 1)).astype(np.float32) + 1
+        return vocabulary
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            # 早期的词典文件没有记录后端，都是 SIFT
+            backend = str(data['backend']) if 'backend' in data.files else 'sift'
+            space = str(data['space']) if 'space' in data.files else backend
+            return cls(data['centers'], data['idf'], backend, space)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'wb') as f:
+            np.savez(f, centers=self.centers, idf=self.idf, backend=self.backend, space=self.space)
+
+    def assign(self, descriptors):
+        descriptors = FEATURE_BACKENDS[self.backend].as_float(descriptors)
+        distances = self._center_norms[None, :] - 2 * descriptors @ self.centers.T
+        return distances.argmin(axis=1)
+
+    def embed(self, descriptors):
+        """Bag-of-visual-words tf-idf vector, L2-normalised so a dot product is the cosine similarity
+        """
+        histogram = np.bincount(self.assign(descriptors), minlength=len(self)).astype(np.float32)
+        histogram *= self.idf
+        norm = np.linalg.norm(histogram)
+        return histogram / norm if norm > 0 else histogram
+
+
+class EmbeddingShortlist:
+    """One global vector per stored photo, queried with a single matrix product
+    """
+
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+        self.synced = False
+        self._matrix = np.zeros((16, len(vocabulary)), dtype=np.float32)
+        self._ids = []
+        self._rows = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def photo_ids(self):
+        return set(self._rows)
+
+    def add(self, photo_id, descriptors):
+        if descriptors is None or len(descriptors) == 0:
+            return
+        vector = self.vocabulary.embed(descriptors)
+        with self._lock:
+            row = self._rows.get(photo_id)
+            if row is None:
+                row = len(self._ids)
+                if row == len(self._matrix):
+                    self._matrix = np.vstack([self._matrix, np.zeros_like(self._matrix)])
+                self._ids.append(photo_id)
+                self._rows[photo_id] = row
+            self._matrix[row] = vector
+
+    def remove(self, photo_id):
+        with self._lock:
+            row = self._rows.pop(photo_id, None)
+            if row is None:
+                return
+            # move the last row into the hole
+            last = len(self._ids) - 1
+            if row != last:
+                moved = self._ids[last]
+                self._matrix[row] = self._matrix[last]
+                self._ids[row] = moved
+                self._rows[moved] = row
+            self._ids.pop()
+
+    def sync(self, photo_ids, load_descriptors):
+        photo_ids = set(photo_ids)
+        with self._lock:
+            for photo_id in self.photo_ids() - photo_ids:
+                self.remove(photo_id)
+            missing = photo_ids - self.photo_ids()
+            if missing:
+                for photo_id, descriptors in load_descriptors(missing):
+                    self.add(photo_id, descriptors)
+            self.synced = True
+
+    def shortlist(self, descriptors, k):
+        """Return the ids of the k stored photos whose global vectors are closest to the query's
+        """
+        query = self.vocabulary.embed(descriptors)
+        with self._lock:
+            count = len(self._ids)
+            if count == 0:
+                return []
+            scores = self._matrix[:count] @ query
+            ids = list(self._ids)
+        if count > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(count)
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [ids[i] for i in top]
+
+
+_shortlist = None
+_shortlist_mtime = None
+_shortlist_lock = threading.Lock()
+
+
+def get_embedding_shortlist():
+    """Shortlist for the vocabulary at FIND_VOCABULARY_PATH, or None while no vocabulary has been trained
+
+    A vocabulary trained for another feature backend or descriptor space is ignored until it is retrained.
+    """
+    global _shortlist, _shortlist_mtime
+    from django.conf import settings
+    from .codecs import get_descriptor_codec
+    from .features import get_feature_backend
+    path = getattr(settings, 'FIND_VOCABULARY_PATH', None)
+    with _shortlist_lock:
+        if not path or not os.path.exists(path):
+            _shortlist = _shortlist_mtime = None
+            return None
+        mtime = os.path.getmtime(path)
+        if _shortlist is None or mtime != _shortlist_mtime:
+            _shortlist = EmbeddingShortlist(Vocabulary.load(path))
+            _shortlist_mtime = mtime
+        backend = get_feature_backend()
+        if _shortlist.vocabulary.space != get_descriptor_codec(backend).space(backend):
+            return None
+        return _shortlist
@@ -27,6 +27,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # 按需性能分析(见 FIND_PROFILE_*)，未配置时不启用
+    'find.profiling.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'shiwuzhaoling.urls'
@@ -117,4 +119,183 @@ CORS_ALLOW_HEADERS = [
     'user-agent',
     'x-csrftoken',
     'x-requested-with',
+    'x-find-profile',
 ]
+
+# 图片比对配置
+# 使用近邻索引(FLANN)投票筛选候选，关闭时逐张暴力匹配
+FIND_ANN_INDEX = True
+FIND_ANN_INDEX_OPTIONS = {
+    'buffer_size': 8192,
+    'max_segments': 8,
+    'trees': 4,
+    'checks': 64,
+    'k': 6,
+}
+# 投票排名前N的候选再做精确比率测试
+FIND_ANN_RERANK = 5
+
+# 全局向量(视觉词袋)初筛：先用一次矩阵乘法选出前K个候选，再做比率测试
+# 词典由 python manage.py train_vocabulary 生成；K为0或词典不存在时不做初筛
+FIND_VOCABULARY_PATH = BASE_DIR / 'data' / 'vocabulary.npz'
+FIND_VOCABULARY_SIZE = 256
+FIND_SHORTLIST_K = 20
+
+# 不走近邻索引时的精确比对方式(两者相似度完全相同)：
+# 'dense' 把候选描述符按块拼成矩阵，用一次矩阵乘法算出距离，再整体做比率测试；'bf' 逐张调用 BFMatcher.knnMatch
+FIND_MATCHER = 'dense'
+
+# 级联比对(仅 'dense')：先用上传图片的 FIND_CASCADE_SUBSET 个特征点给所有候选预打分，按预估分数从高到低完整打分
+# 即使剩余特征点全部匹配也超不过当前最优的候选直接跳过(不影响结果)；
+# 预估分数低于 当前最优 x FIND_CASCADE_PRUNE_MARGIN 的也跳过，最优达到 FIND_CONFIDENT_SIMILARITY 后停止扫描
+# 两者设为 None 时结果与逐张完整比对完全相同；FIND_CASCADE = False 恢复完整扫描
+FIND_CASCADE = True
+FIND_CASCADE_SUBSET = 64
+FIND_CASCADE_PRUNE_MARGIN = 0.5
+FIND_CONFIDENT_SIMILARITY = 0.5
+
+# 'bf' 逐张比对时的进程池：候选图片按块分发给常驻的工作进程
+# 工作进程数 <= 1 时退回串行；候选数不超过一块时也在当前进程内完成
+FIND_MATCH_WORKERS = 4
+FIND_MATCH_CHUNK_SIZE = 32
+
+# 已存图片的内存缓存(LRU，按字节数淘汰)，键为文件路径+修改时间
+FIND_IMAGE_CACHE_BYTES = 256 * 1024 * 1024
+# 是否同时缓存预处理后的灰度图(只在重新提取特征时用到)
+FIND_IMAGE_CACHE_GRAY = False
+
+# 比对上传的图片直接在内存中解码；无法原地读取的上传超过该大小才落到临时文件
+FIND_UPLOAD_SPOOL_BYTES = 10 * 1024 * 1024
+
+# 特征后端：'sift'(128维 float32，L2 距离)，'orb' / 'akaze'(32 字节二进制描述符，汉明距离，近邻索引改用 LSH)
+# 切换后已存图片会在下次使用时按新后端重新提取，词典需要重新训练
+FIND_FEATURE_BACKEND = 'sift'
+
+# 描述符存储格式(数据库、内存缓存和逐张比对都使用该格式)
+# 'raw' 原样 float32；'uint8' 体积为 1/4 且无损(SIFT 的值本来就是 0~255 的整数)，相似度完全不变
+# 'pca16' 投影到 FIND_PCA_COMPONENTS 维后存 float16，需先运行 python manage.py train_descriptor_pca
+# 二进制后端(orb/akaze)始终原样存储；切换格式后，无损格式的旧数据直接转码，其余从原图重新提取
+FIND_DESCRIPTOR_CODEC = 'uint8'
+FIND_PCA_PATH = BASE_DIR / 'data' / 'descriptor_pca.npz'
+FIND_PCA_COMPONENTS = 64
+
+# 共享描述符区：所有 worker 进程只读映射同一份磁盘文件(追加写入，删除留墓碑，过半失效时自动压缩)
+# 增加 worker 不会成倍占用内存，新 worker 启动后无需加载即可比对；设为 None 时各进程各自缓存(Windows 下自动关闭)
+# 定期清理已不在表中的记录：python manage.py compact_descriptor_arena
+FIND_DESCRIPTOR_ARENA_DIR = BASE_DIR / 'data' / 'arena'
+
+# 缩小解码：JPEG 在 DCT 域按 1/2、1/4、1/8 直接解码为灰度，再缩放到 600 像素以内
+# 上传和比对的图片走同一套设置；切换后已存的描述符仍可用，必要时递增 FEATURE_VERSION 全部重算
+FIND_REDUCED_DECODE = False
+# 缩放插值：nearest / box / bilinear / hamming / bicubic / lanczos
+FIND_RESIZE_FILTER = 'lanczos'
+
+# 异步比对：POST /api/compare/jobs/ 立即返回任务ID，后台线程从 compare_job 表领取任务执行
+# 客户端轮询 GET /api/compare/jobs/<任务ID>/，小程序每 1.5 秒短轮询一次
+# 每个进程的 worker 线程数；设为 0 时 web 进程不执行任务，改用 python manage.py run_compare_workers 单独运行
+FIND_COMPARE_WORKERS = 2
+# 空闲 worker 检查其他进程提交的任务的间隔(秒)
+FIND_COMPARE_POLL_SECONDS = 1.0
+# ?wait=秒数 的长轮询最长挂起时间；同步 WSGI 部署下挂起的请求会一直占用 worker，保持为 0(立即返回)，
+# 只有用异步/多线程服务器部署时才调大
+FIND_COMPARE_LONG_POLL_SECONDS = 0
+# 运行超过该时间(秒)的任务视为所在进程已退出，重新排队
+FIND_COMPARE_JOB_TIMEOUT = 600
+# 任务最多被领取的次数，超时重领达到上限后标记为失败
+FIND_COMPARE_MAX_ATTEMPTS = 3
+# 已完成任务的保留时间(秒)
+FIND_COMPARE_JOB_TTL = 24 * 3600
+
+# 上传后的处理流水线：上传接口保存图片后立即返回，后台 worker 提取特征、生成缩略图和哈希，完成后标记为 ready
+# 每个进程的 worker 线程数，web 进程在第一次上传时启动；设为 0 时改用 python manage.py run_feature_workers 单独运行
+# 重启前未处理完的图片在下一次上传时继续处理，比对时也会按 FIND_FEATURE_ON_DEMAND_AFTER 按需提取
+FIND_FEATURE_WORKERS = 1
+FIND_FEATURE_POLL_SECONDS = 1.0
+# 处理失败后按 30s、60s、120s.. 退避重试，达到次数后标记为 failed
+FIND_FEATURE_MAX_ATTEMPTS = 3
+FIND_FEATURE_RETRY_SECONDS = 30
+# 处理超过该时间(秒)视为 worker 已退出，重新排队(计入重试次数)
+FIND_FEATURE_JOB_TIMEOUT = 300
+# 比对只使用 ready 的图片；上传超过该时间(秒)仍未处理完的图片在比对时按需提取特征，设为 None 则不参与比对
+FIND_FEATURE_ON_DEMAND_AFTER = 60
+# 缩略图最长边(像素)
+FIND_THUMBNAIL_SIZE = 256
+
+# 批量比对 POST /api/compare/batch/(字段 photos，可重复)：同一物品的多个角度一次上传，只扫描一遍候选
+# 按各角度中的最高相似度融合排名，超过阈值时认领第一名
+FIND_BATCH_MAX_PHOTOS = 6
+# 返回的排名条数
+FIND_BATCH_RANKING_SIZE = 5
+
+# 比对指标：GET /api/metrics 以 Prometheus 文本格式输出各阶段耗时(decode/extract/load/match/delete)、
+# 总耗时和每次请求的候选数(scanned/pruned/stopped_early/skipped/missing_file)直方图；指标按进程统计，多进程部署时逐个抓取
+# 设置后请求需带 Authorization: Bearer <token>
+FIND_METRICS_TOKEN = None
+
+# 日志：find 的每次比对输出一行汇总(INFO)，逐张候选的明细只在 DEBUG 级别输出
+FIND_LOG_LEVEL = 'INFO'
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'simple': {'format': '%(asctime)s %(levelname)s %(name)s %(message)s'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'simple'},
+    },
+    'loggers': {
+        'find': {'handlers': ['console'], 'level': FIND_LOG_LEVEL, 'propagate': False},
+    },
+}
+
+# 请求性能分析：带请求头 X-Find-Profile: <FIND_PROFILE_TOKEN> 的请求，或按 FIND_PROFILE_SAMPLE_RATE 抽样的请求，
+# 在 cProfile 下执行并写入 FIND_PROFILE_DIR/<时间>-<方法>-<接口>-<耗时>ms-<进程>.prof
+# 汇总最慢的调用路径：python manage.py summarize_profiles [--endpoint api-compare]
+FIND_PROFILE_TOKEN = None
+FIND_PROFILE_SAMPLE_RATE = 0
+FIND_PROFILE_DIR = BASE_DIR / 'data' / 'profiles'
+# 只保留耗时不低于该值(秒)的请求，最多保留 FIND_PROFILE_KEEP 个文件
+FIND_PROFILE_MIN_SECONDS = 0
+FIND_PROFILE_KEEP = 200
+
+# 列表分页：/api/items/ 和 /api/my-items/ 按 ?limit= 每页返回(默认 FIND_ITEMS_PAGE_SIZE，最多 FIND_ITEMS_MAX_PAGE_SIZE)条，
+# 响应中的 next_cursor 作为下一页的 ?cursor=，为 null 时已到最后一页
+FIND_ITEMS_PAGE_SIZE = 20
+FIND_ITEMS_MAX_PAGE_SIZE = 100
+
+# 列表响应缓存：/api/items/ 和 /api/my-items/ 的响应按表版本缓存并带强 ETag，未变化时返回 304
+# 上传、比对认领、后台处理完成和 clear_photolost 会更新版本；其他途径(如 admin)的修改最多 FIND_LIST_CACHE_SECONDS 秒后可见
+# 多进程部署时缓存须为各进程共享(文件、Redis、Memcached)，否则各进程的版本互不相通
+FIND_LIST_CACHE = 'find'
+FIND_LIST_CACHE_SECONDS = 300
+# 表版本和 token 代数存放在 FIND_STATE_CACHE：条目很少，但不能被淘汰(版本丢失会让 ETag 失效，代数丢失会让已轮换的 token 重新生效)
+FIND_STATE_CACHE = 'find-state'
+# default 保持 Django 默认的进程内缓存；find 和 find-state 是各进程共享的文件缓存
+# 文件缓存在每次认证时读一个小文件，多台机器或高并发时换成 Redis 等共享后端，find-state 须配置为不淘汰(如 Redis 的 noeviction)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'find': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'data' / 'cache',
+        # 满了以后删除 1/4 的条目，只会造成缓存未命中
+        'OPTIONS': {'MAX_ENTRIES': 20000, 'CULL_FREQUENCY': 4},
+    },
+    'find-state': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'data' / 'cache-state',
+        'TIMEOUT': None,
+        # 每个用户一个代数加一个表版本，上限远大于实际条目数，永远不会触发淘汰
+        'OPTIONS': {'MAX_ENTRIES': 10 ** 9},
+    },
+}
+
+# token 认证缓存：verify_token 把 token 对应的用户在进程内缓存 FIND_TOKEN_CACHE_SECONDS 秒(最多 FIND_TOKEN_CACHE_SIZE 个)，设为 0 时每次查库
+FIND_TOKEN_CACHE_SECONDS = 5
+FIND_TOKEN_CACHE_SIZE = 10000
+# 同时写入共享的 Django 缓存(CACHES 中的别名)，保留 FIND_TOKEN_SHARED_CACHE_SECONDS 秒，新进程和其他进程也能命中；
+# 重新登录时在共享缓存中更新该用户的 token 代数，所有进程缓存的旧 token 立即失效
+# None 时只用进程内缓存，其他进程的旧 token 最多在 FIND_TOKEN_CACHE_SECONDS 秒后失效
+FIND_TOKEN_SHARED_CACHE = 'find'
+FIND_TOKEN_SHARED_CACHE_SECONDS = 300
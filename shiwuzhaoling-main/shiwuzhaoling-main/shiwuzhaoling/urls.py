@@ -2,12 +2,17 @@ from django.contrib import admin
 from django.urls import path
 from django.conf import settings
 from django.conf.urls.static import static
-from find.views import upload_photo, compare_photo, user_register, user_login, get_items, get_my_items
+from find.views import (upload_photo, compare_photo, compare_photo_batch, submit_compare_job, get_compare_job,
+                        compare_metrics, user_register, user_login, get_items, get_my_items)
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/upload/', upload_photo, name='upload_photo'),
     path('api/compare/', compare_photo, name='compare_photo'),
+    path('api/compare/batch/', compare_photo_batch, name='compare_photo_batch'),
+    path('api/compare/jobs/', submit_compare_job, name='submit_compare_job'),
+    path('api/compare/jobs/<str:job_id>/', get_compare_job, name='get_compare_job'),
+    path('api/metrics', compare_metrics, name='compare_metrics'),
     path('api/register/', user_register, name='user_register'),
     path('api/login/', user_login, name='user_login'),
     path('api/items/', get_items, name='get_items'),
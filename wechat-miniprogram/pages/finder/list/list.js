@@ -5,10 +5,11 @@ Page({
   data: {
     items: [], // 物品列表
     loading: true, // 加载状态
-    hasMore: false, // 是否有更多数据（暂时不需要分页）
-    page: 1, // 当前页码
-    pageSize: 10 // 每页数量
+    hasMore: false, // 是否有更多数据
+    loadingMore: false // 是否正在加载下一页
   },
+
+  nextCursor: null, // 下一页的游标
   
   onLoad() {
     // 页面加载时执行
@@ -28,11 +29,17 @@ Page({
     console.log('下拉刷新');
     this.setData({
       items: [],
-      page: 1,
       hasMore: false
     });
     this.loadItems();
   },
+
+  onReachBottom() {
+    // 上拉加载下一页
+    if (this.data.hasMore && !this.data.loadingMore) {
+      this.loadMore();
+    }
+  },
   
   // 加载物品列表
   async loadItems() {
@@ -48,16 +55,12 @@ Page({
     try {
       this.setData({ loading: true });
 
-      const list = await getItemsList();
-
-      const items = (list || []).map((item) => ({
-        id: item.id,
-        imageUrl: item.image_url || item.imagePath || '',
-        createdAt: item.created_at || item.createdAt || ''
-      }));
+      const { items: list, nextCursor } = await getItemsList();
+      this.nextCursor = nextCursor;
 
       this.setData({
-        items,
+        items: this.formatItems(list),
+        hasMore: !!nextCursor,
         loading: false
       });
 
@@ -70,6 +73,31 @@ Page({
     }
   },
   
+  async loadMore() {
+    try {
+      this.setData({ loadingMore: true });
+      const { items: list, nextCursor } = await getItemsList(this.nextCursor);
+      this.nextCursor = nextCursor;
+      this.setData({
+        items: this.data.items.concat(this.formatItems(list)),
+        hasMore: !!nextCursor,
+        loadingMore: false
+      });
+    } catch (error) {
+      console.error('加载更多物品失败:', error);
+      showError(error.message || '加载失败，请重试');
+      this.setData({ loadingMore: false });
+    }
+  },
+
+  formatItems(list) {
+    return (list || []).map((item) => ({
+      id: item.id,
+      imageUrl: item.image_url || item.imagePath || '',
+      createdAt: item.created_at || item.createdAt || ''
+    }));
+  },
+
   // 跳转到上传页面
   gotoUpload() {
     if (requireLogin()) {
@@ -6,6 +6,7 @@ Page({
   data: {
     photoPath: '', // 拍摄的照片路径
     compareResult: null, // 对比结果
+    compareProgress: '', // 比对任务进度
     cameraContext: null // 相机上下文
   },
   
@@ -145,6 +146,10 @@ Page({
       console.log('开始调用API对比图片...');
       const result = await apiComparePhoto({
         tempFilePath: compressedPath
+      }, (job) => {
+        this.setData({
+          compareProgress: job.status === 'pending' ? `排队中，前面还有${Math.max(job.position - 1, 0)}个任务` : '正在对比，请稍候...'
+        });
       });
       console.log('API返回结果:', result);
       
@@ -170,6 +175,7 @@ Page({
       wx.setStorageSync('myClaims', history);
 
       this.setData({
+        compareProgress: '',
         compareResult: {
           success: true,
           matchedItem
@@ -188,6 +194,7 @@ Page({
       showError(error.message || '对比失败，请重试');
       
       this.setData({
+        compareProgress: '',
         compareResult: {
           success: false,
           message: error.message || '未找到匹配的物品'
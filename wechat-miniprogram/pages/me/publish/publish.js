@@ -1,11 +1,23 @@
 const { getMyItems, showError, requireLogin } = require('../../../utils/api');
 
+// 后台处理状态，ready 之前的物品还不能被比对到
+const STATUS_TEXT = {
+  pending: '等待处理',
+  processing: '处理中',
+  ready: '',
+  failed: '处理失败'
+};
+
 Page({
   data: {
     items: [],
-    loading: true
+    loading: true,
+    hasMore: false,
+    loadingMore: false
   },
 
+  nextCursor: null,
+
   onLoad() {
     this.loadItems();
   },
@@ -14,6 +26,12 @@ Page({
     this.loadItems();
   },
 
+  onReachBottom() {
+    if (this.data.hasMore && !this.data.loadingMore) {
+      this.loadMore();
+    }
+  },
+
   async loadItems() {
     if (!requireLogin()) {
       this.setData({
@@ -26,16 +44,12 @@ Page({
     try {
       this.setData({ loading: true });
 
-      const list = await getMyItems();
-
-      const items = (list || []).map((item) => ({
-        id: item.id,
-        imageUrl: item.image_url || item.imagePath || '',
-        createdAt: item.created_at || item.createdAt || ''
-      }));
+      const { items: list, nextCursor } = await getMyItems();
+      this.nextCursor = nextCursor;
 
       this.setData({
-        items,
+        items: this.formatItems(list),
+        hasMore: !!nextCursor,
         loading: false
       });
     } catch (error) {
@@ -43,5 +57,32 @@ Page({
       showError(error.message || '加载失败，请重试');
       this.setData({ loading: false });
     }
+  },
+
+  async loadMore() {
+    try {
+      this.setData({ loadingMore: true });
+      const { items: list, nextCursor } = await getMyItems(this.nextCursor);
+      this.nextCursor = nextCursor;
+      this.setData({
+        items: this.data.items.concat(this.formatItems(list)),
+        hasMore: !!nextCursor,
+        loadingMore: false
+      });
+    } catch (error) {
+      console.error('加载更多发布失败:', error);
+      showError(error.message || '加载失败，请重试');
+      this.setData({ loadingMore: false });
+    }
+  },
+
+  formatItems(list) {
+    return (list || []).map((item) => ({
+      id: item.id,
+      imageUrl: item.thumbnail_url || item.image_url || item.imagePath || '',
+      createdAt: item.created_at || item.createdAt || '',
+      status: item.status || 'ready',
+      statusText: STATUS_TEXT[item.status] || ''
+    }));
   }
 })
@@ -141,14 +141,12 @@ function uploadPhoto(file) {
 }
 
 /**
- * 对比图片相似度
+ * 提交比对任务
  * @param {Object} file - 图片文件对象
- * @returns {Promise} - 返回对比结果
+ * @returns {Promise} - 返回任务信息(job_id, status, position)
  */
-function comparePhoto(file) {
+function submitCompareJob(file) {
   return new Promise((resolve, reject) => {
-    wx.showLoading({ title: '对比中...', mask: true });
-    
     const token = getToken();
     
     const header = {};
@@ -158,22 +156,18 @@ function comparePhoto(file) {
     }
     
     const uploadTask = wx.uploadFile({
-      url: `${baseUrl}/compare/`,
+      url: `${baseUrl}/compare/jobs/`,
       filePath: file.tempFilePath,
       name: 'photo',
       header: header,
-      timeout: 180000,
+      timeout: 60000,
       success: (res) => {
-        console.log('uploadFile success, statusCode:', res.statusCode);
-        console.log('uploadFile response data:', res.data);
-        wx.hideLoading();
         try {
           const result = JSON.parse(res.data);
-          console.log('parsed result:', result);
           if (result.code === 200) {
-            resolve(result);
+            resolve(result.data);
           } else {
-            reject(new Error(result.msg || result.message || '对比失败'));
+            reject(new Error(result.msg || result.message || '提交失败'));
           }
         } catch (e) {
           console.error('JSON parse error:', e);
@@ -182,7 +176,6 @@ function comparePhoto(file) {
       },
       fail: (err) => {
         console.error('uploadFile fail:', err);
-        wx.hideLoading();
         reject(new Error('网络错误，请稍后重试'));
       }
     });
@@ -194,58 +187,117 @@ function comparePhoto(file) {
 }
 
 /**
- * 获取所有物品列表
- * @returns {Promise} - 返回物品列表
+ * 查询比对任务的当前状态(立即返回)
+ * @param {string} jobId - 任务ID
+ * @returns {Promise} - 返回任务信息，完成后带 result
  */
-function getItemsList() {
+function getCompareJob(jobId) {
   return new Promise((resolve, reject) => {
-    wx.showLoading({ title: '加载中...' });
-    
+    const token = getToken();
+    const header = {};
+
+    if (token) {
+      header['Authorization'] = `Token ${token}`;
+    }
+
     wx.request({
-      url: `${baseUrl}/items/`,
+      url: `${baseUrl}/compare/jobs/${jobId}/`,
       method: 'GET',
+      header: header,
       success: (res) => {
-        wx.hideLoading();
-        if (res.statusCode === 200) {
-          const result = res.data;
-          if (result.code === 200) {
-            resolve(result.data || []);
-          } else {
-            reject(new Error(result.msg || '获取列表失败'));
-          }
+        const result = res.data;
+        if (res.statusCode === 200 && result.code === 200) {
+          resolve(result.data);
         } else {
-          reject(new Error('获取列表失败'));
+          reject(new Error((result && result.msg) || '查询失败'));
         }
       },
       fail: (err) => {
-        wx.hideLoading();
         reject(new Error('网络错误，请稍后重试'));
       }
     });
   });
 }
 
-function getMyItems() {
-  return new Promise((resolve, reject) => {
-    wx.showLoading({ title: '加载中...' });
+// 轮询比对任务的间隔(毫秒)
+const COMPARE_POLL_INTERVAL = 1500;
 
-    const token = getToken();
-    const header = {};
+function sleep(ms) {
+  return new Promise((resolve) => setTimeout(resolve, ms));
+}
 
-    if (token) {
-      header['Authorization'] = `Token ${token}`;
+/**
+ * 对比图片相似度：提交比对任务后轮询结果，不会因比对耗时长而超时
+ * @param {Object} file - 图片文件对象
+ * @param {Function} onProgress - 任务状态变化时回调，参数为任务信息(status, position)
+ * @returns {Promise} - 返回对比结果
+ */
+async function comparePhoto(file, onProgress) {
+  wx.showLoading({ title: '上传中...', mask: true });
+  try {
+    let job = await submitCompareJob(file);
+    const deadline = Date.now() + 10 * 60 * 1000;
+    while (job.status !== 'done' && job.status !== 'failed') {
+      wx.showLoading({
+        title: job.status === 'pending' ? `排队中(第${job.position}位)` : '对比中...',
+        mask: true
+      });
+      if (onProgress) {
+        onProgress(job);
+      }
+      if (Date.now() > deadline) {
+        throw new Error('对比超时，请稍后重试');
+      }
+      // 短轮询：每次查询立即返回，不在服务器上挂起等待占用 worker
+      await sleep(COMPARE_POLL_INTERVAL);
+      job = await getCompareJob(job.job_id);
     }
+    if (onProgress) {
+      onProgress(job);
+    }
+    const result = job.result || {};
+    console.log('比对任务结果:', result);
+    if (result.code === 200) {
+      return result;
+    }
+    throw new Error(result.msg || '对比失败');
+  } finally {
+    wx.hideLoading();
+  }
+}
+
+// 列表响应的 ETag 和内容：再次请求时带上 If-None-Match，未变化时服务器返回 304，直接复用上次的内容
+const listCache = {};
+
+function requestList(path, cursor, header) {
+  const key = `${path}|${cursor || ''}|${header['Authorization'] || ''}`;
+  const cached = listCache[key];
+  const requestHeader = Object.assign({}, header);
+  if (cached) {
+    requestHeader['If-None-Match'] = cached.etag;
+  }
+
+  return new Promise((resolve, reject) => {
+    wx.showLoading({ title: '加载中...' });
 
     wx.request({
-      url: `${baseUrl}/my-items/`,
+      url: `${baseUrl}${path}`,
       method: 'GET',
-      header: header,
+      data: cursor ? { cursor } : {},
+      header: requestHeader,
       success: (res) => {
         wx.hideLoading();
-        if (res.statusCode === 200) {
+        if (res.statusCode === 304 && cached) {
+          resolve(cached.page);
+        } else if (res.statusCode === 200) {
           const result = res.data;
           if (result.code === 200) {
-            resolve(result.data || []);
+            const page = { items: result.data || [], nextCursor: result.next_cursor || null };
+            const etag = res.header && (res.header.ETag || res.header.Etag || res.header.etag);
+            if (etag) {
+              listCache[key] = { etag, page };
+            }
+            resolve(page);
           } else {
             reject(new Error(result.msg || '获取列表失败'));
           }
@@ -261,6 +313,26 @@ function getMyItems() {
   });
 }
 
+/**
+ * 获取物品列表(分页，最新的在前)
+ * @param {string} cursor - 上一页返回的 nextCursor，不传时获取第一页
+ * @returns {Promise} - 返回 { items, nextCursor }，nextCursor 为 null 时已到最后一页
+ */
+function getItemsList(cursor) {
+  return requestList('/items/', cursor, {});
+}
+
+function getMyItems(cursor) {
+  const token = getToken();
+  const header = {};
+
+  if (token) {
+    header['Authorization'] = `Token ${token}`;
+  }
+
+  return requestList('/my-items/', cursor, header);
+}
+
 /**
  * 显示错误提示
  * @param {string} message - 错误信息
@@ -343,6 +415,8 @@ module.exports = {
   getToken,
   clearToken,
   uploadPhoto,
+  submitCompareJob,
+  getCompareJob,
   comparePhoto,
   getItemsList,
   getMyItems,